@@ -3,6 +3,8 @@
 
 #include <QObject>
 #include <QTemporaryFile>
+#include <QFileInfo>
+#include <QDataStream>
 #include <QtTest/QTest>
 #include <QtTest/QSignalSpy>
 #include <QDebug>
@@ -103,6 +105,105 @@ private slots:
         auto dev = deviceFromFile(file.fileName(), options);
     }
 
+    void testPageCache() {
+        QTemporaryFile file;
+        file.open();
+        QByteArray data;
+        for (int j = 0; j < 1024 * 64; ++j) {
+            data += char(j % 251);
+        }
+        file.write(data);
+        file.flush();
+
+        auto dev = deviceFromFile(file.fileName());
+        dev->setPageSize(1024);
+        dev->setCacheSize(1024 * 4);
+        QCOMPARE(dev->getPageSize(), qulonglong(1024));
+
+        // two interleaved readers should not evict each other pages
+        for (int j = 0; j < 10; ++j) {
+            QCOMPARE(dev->read(100 + j, 16), data.mid(100 + j, 16));
+            QCOMPARE(dev->read(50000 + j, 16), data.mid(50000 + j, 16));
+        }
+        CacheStats stats = dev->getCacheStats();
+        QCOMPARE(stats.misses, qulonglong(2));
+        QCOMPARE(stats.hits, qulonglong(18));
+        QCOMPARE(stats.cachedPages, qulonglong(2));
+        QCOMPARE(stats.cachedBytes, qulonglong(2048));
+
+        // reading range crossing page boundary
+        QCOMPARE(dev->read(1000, 100), data.mid(1000, 100));
+
+        // cache should not grow over its size
+        for (int j = 0; j < 16; ++j) {
+            QCOMPARE(dev->read(j * 1024 + 10, 10), data.mid(j * 1024 + 10, 10));
+        }
+        QVERIFY(dev->getCacheStats().cachedBytes <= 1024 * 4);
+
+        // written data should be visible to readers
+        dev->write(20000, "Lorem ipsum");
+        QCOMPARE(dev->read(19995, 20), data.mid(19995, 5) + "Lorem ipsum" + data.mid(20011, 4));
+
+        // large reads bypass cache
+        dev->resetCacheStats();
+        QCOMPARE(dev->read(30000, 10000), data.mid(30000, 10000));
+        QCOMPARE(dev->getCacheStats().misses, qulonglong(0));
+    }
+
+    void testMappedDevice() {
+        QTemporaryFile file;
+        file.open();
+        file.write("Lorem ipsum dolor sit amet");
+        file.flush();
+
+        FileLoadOptions options;
+        options.readOnly = true;
+        auto dev = deviceFromFile(file.fileName(), options);
+        QVERIFY(dev->isMapped());
+        QCOMPARE(dev->readAll(), QByteArray("Lorem ipsum dolor sit amet"));
+        QCOMPARE(dev->read(6, 100), QByteArray("ipsum dolor sit amet"));
+        QCOMPARE(dev->getCacheStats().misses, qulonglong(0));
+
+        DataView view = dev->view(6, 5);
+        QVERIFY(!view.isNull());
+        QCOMPARE(view.data, QByteArray("ipsum"));
+        QByteArray buffer(5, '\0');
+        QCOMPARE(dev->readInto(12, buffer.data(), 5), qulonglong(5));
+        QCOMPARE(buffer, QByteArray("dolor"));
+
+        // data kept after device is destroyed should remain valid, view keeps mapping alive
+        QByteArray detached = detachedData(dev->read(0, 5));
+        dev.reset();
+        QCOMPARE(detached, QByteArray("Lorem"));
+        QCOMPARE(view.data, QByteArray("ipsum"));
+        view = DataView();
+
+        // only loaded range is mapped
+        options.rangeLoad = true;
+        options.rangeStart = 6;
+        options.rangeLength = 5;
+        dev = deviceFromFile(file.fileName(), options);
+        QVERIFY(dev->isMapped());
+        QCOMPARE(dev->readAll(), QByteArray("ipsum"));
+        dev.reset();
+
+        // writes into file with frozen size should be visible through mapping
+        options = FileLoadOptions();
+        options.freezeSize = true;
+        dev = deviceFromFile(file.fileName(), options);
+        QVERIFY(dev->isMapped());
+        dev->write(0, "LOREM");
+        QCOMPARE(dev->read(0, 11), QByteArray("LOREM ipsum"));
+        dev.reset();
+
+        // memory loaded and resizeable devices are not mapped
+        options = FileLoadOptions();
+        options.readOnly = true;
+        options.memoryLoad = true;
+        QVERIFY(!deviceFromFile(file.fileName(), options)->isMapped());
+        QVERIFY(!deviceFromFile(file.fileName())->isMapped());
+    }
+
 private:
     void testDevice(const std::shared_ptr<AbstractDevice> &device, const QByteArray &realData) {
         QCOMPARE(device->getLength(), qulonglong(realData.length()));
@@ -242,6 +343,120 @@ private slots:
         QCOMPARE(exported3->readAll(), chain->readAll());
     }
 
+    void testManySpans() {
+        QByteArray real_data;
+        SpanList spans;
+        for (int j = 0; j < 1000; ++j) {
+            QByteArray span_data(j % 3 + 1, char(j));
+            spans << std::make_shared<DataSpan>(span_data);
+            real_data += span_data;
+        }
+        auto chain = SpanChain::fromSpans(spans);
+
+        for (int j = 0; j < 100; ++j) {
+            int position = (j * 7919) % real_data.length();
+            chain->insertSpan(position, std::make_shared<DataSpan>("xy"));
+            real_data.insert(position, "xy");
+            chain->remove((j * 104729) % (real_data.length() - 5), 5);
+            real_data.remove((j * 104729) % (real_data.length() - 5), 5);
+        }
+
+        QCOMPARE(chain->getLength(), qulonglong(real_data.length()));
+        QCOMPARE(chain->readAll(), real_data);
+        for (int position = 0; position < real_data.length(); position += 13) {
+            qulonglong span_offset;
+            auto span = chain->spanAtOffset(position, &span_offset);
+            QVERIFY(span.get());
+            QCOMPARE(span->read(span_offset, 1), real_data.mid(position, 1));
+        }
+    }
+
+    void testReadIntoAndView() {
+        QTemporaryFile file;
+        file.open();
+        file.write("0123456789");
+        file.flush();
+
+        auto dev = deviceFromFile(file.fileName());
+        auto chain = SpanChain::fromSpans(SpanList()
+                                          << std::make_shared<DataSpan>("Lorem ipsum")
+                                          << std::make_shared<FillSpan>(3, 'x')
+                                          << std::make_shared<DeviceSpan>(dev, 2, 6));
+        QByteArray real_data("Lorem ipsumxxx234567");
+
+        // buffer is larger than data to be read
+        QByteArray buffer(30, '\0');
+        QCOMPARE(chain->readInto(4, buffer.data(), 30), qulonglong(real_data.length() - 4));
+        QCOMPARE(buffer.left(real_data.length() - 4), real_data.mid(4));
+        QCOMPARE(chain->readInto(100, buffer.data(), 10), qulonglong(0));
+
+        // data inside single DataSpan can be viewed
+        DataView view = chain->view(6, 5);
+        QVERIFY(!view.isNull());
+        QCOMPARE(view.data, QByteArray("ipsum"));
+
+        // view should keep data alive after span is removed from chain
+        chain->remove(0, 11);
+        QCOMPARE(view.data, QByteArray("ipsum"));
+
+        // data held by several spans or by FillSpan cannot be viewed
+        QVERIFY(chain->view(1, 4).isNull());
+        QVERIFY(chain->view(0, 2).isNull());
+
+        // device data inside single cached page can be viewed too
+        view = chain->view(4, 3);
+        QVERIFY(!view.isNull());
+        QCOMPARE(view.data, QByteArray("345"));
+    }
+
+    void benchmarkRead_data() {
+        QTest::addColumn<int>("edits");
+        QTest::newRow("10 edits") << 10;
+        QTest::newRow("1000 edits") << 1000;
+        QTest::newRow("100000 edits") << 100000;
+    }
+
+    void benchmarkRead() {
+        // chain with many small spans is what document looks like after many edits. Time of reading one row
+        // should not depend on number of spans.
+        QFETCH(int, edits);
+
+        SpanList spans;
+        for (int j = 0; j < edits; ++j) {
+            spans << std::make_shared<DataSpan>(QByteArray(1, char(j)));
+        }
+        auto chain = SpanChain::fromSpans(spans);
+
+        qulonglong position = 0;
+        QBENCHMARK {
+            chain->read(position, 16);
+            position = (position + 7919) % chain->getLength();
+        }
+    }
+
+    void benchmarkEdit_data() {
+        benchmarkRead_data();
+    }
+
+    void benchmarkEdit() {
+        // chain is grown by edits near its start, so every edit changes offsets of almost all spans. FillSpans are
+        // used because neighbouring DataSpans would be merged.
+        QFETCH(int, edits);
+
+        auto chain = std::make_shared<SpanChain>();
+        qulonglong length = 0;
+        for (int j = 0; j < edits; ++j) {
+            chain->insertSpan(j ? 1 : 0, std::make_shared<FillSpan>(j % 3 + 1, char(j)));
+            length += j % 3 + 1;
+        }
+
+        QBENCHMARK {
+            chain->insertSpan(1, std::make_shared<FillSpan>(2, 'x'));
+            chain->remove(1, 2);
+        }
+        QCOMPARE(chain->getLength(), length);
+    }
+
 private:
     void testChain(const std::shared_ptr<SpanChain> &chain, const QByteArray &real_data) {
         QCOMPARE(chain->getLength(), qulonglong(real_data.length()));
@@ -371,6 +586,133 @@ private slots:
         QVERIFY(std::dynamic_pointer_cast<PrimitiveDeviceSpan>(dev_span->getSpans()[2]).get());
     }
 
+    void testInPlaceSave() {
+        QByteArray data;
+        for (int j = 0; j < 1024 * 1024; ++j) {
+            data.append(char(j % 251));
+        }
+
+        QTemporaryFile file;
+        file.open();
+        file.write(data);
+        file.flush();
+
+        auto file_device = deviceFromFile(file.fileName());
+        auto document = std::make_shared<Document>(file_device);
+        auto history_chain = SpanChain::fromSpans(SpanList()
+                                << std::make_shared<DeviceSpan>(file_device, 0, file_device->getLength()));
+
+        // changes near the end of file: only tail of file should be moved
+        document->insertSpan(data.length() - 100, std::make_shared<DataSpan>("inserted"));
+        document->remove(data.length() - 50, 10);
+        document->writeSpan(10, std::make_shared<DataSpan>("patch"));
+        QByteArray expected = document->readAll();
+
+        document->save();
+        QVERIFY(!document->isModified());
+        QCOMPARE(document->readAll(), expected);
+        QCOMPARE(file_device->getLength(), qulonglong(expected.length()));
+        QCOMPARE(file_device->readAll(), expected);
+        QCOMPARE(history_chain->readAll(), data);
+        QVERIFY(!QFileInfo(file.fileName() + ".mhj").exists());
+
+        // data moved to the left
+        document->remove(data.length() - 200, 30);
+        expected = document->readAll();
+        document->save();
+        QCOMPARE(file_device->readAll(), expected);
+        QVERIFY(!QFileInfo(file.fileName() + ".mhj").exists());
+        QVERIFY(!QFileInfo(file.fileName() + ".mhj.lock").exists());
+    }
+
+    void testInterruptedInPlaceSave() {
+        QByteArray data(1024, 'x');
+
+        QTemporaryFile file;
+        file.open();
+        file.write(data);
+        file.flush();
+
+        {
+            // committed journal of save that writes "done" at the beginning of file and moves nothing
+            QFile journal_file(file.fileName() + ".mhj");
+            journal_file.open(QIODevice::WriteOnly);
+            QDataStream stream(&journal_file);
+            stream << quint32(0x4d484a31) << quint64(0) << quint64(4096) << quint64(data.length())
+                   << quint64(data.length()) << quint32(0) << quint32(1) << quint64(0) << quint64(4);
+            stream.writeRawData("done", 4);
+            stream << quint32(0x434f4d54);
+        }
+
+        // file with incomplete save cannot be opened for reading only, as its data is inconsistent
+        FileLoadOptions read_only_options;
+        read_only_options.readOnly = true;
+        try {
+            auto device = deviceFromFile(file.fileName(), read_only_options);
+            QFAIL("Exception was not thrown");
+        } catch (const DeviceError &err) {
+
+        }
+        QVERIFY(QFileInfo(file.fileName() + ".mhj").exists());
+
+        auto file_device = deviceFromFile(file.fileName());
+        QCOMPARE(file_device->readAll(), QByteArray("done") + data.mid(4));
+        QVERIFY(!QFileInfo(file.fileName() + ".mhj").exists());
+        QVERIFY(!QFileInfo(file.fileName() + ".mhj.lock").exists());
+    }
+
+    void testSaveToAnotherFile() {
+        QByteArray data;
+        for (int j = 0; j < 1024 * 1024; ++j) {
+            data.append(char(j % 251));
+        }
+
+        QTemporaryFile source_file;
+        source_file.open();
+        source_file.write(data);
+        source_file.flush();
+
+        QTemporaryFile target_file;
+        target_file.open();
+        target_file.write("old contents");
+        target_file.flush();
+
+        // file data at offsets other than zero is copied from correct position
+        FileLoadOptions range_options;
+        range_options.rangeLoad = true;
+        range_options.rangeStart = 1000;
+        range_options.rangeLength = data.length() - 2000;
+        auto source_device = deviceFromFile(source_file.fileName(), range_options);
+        auto document = std::make_shared<Document>(source_device);
+
+        // long zero fill is not written, but should read as zeros
+        document->insertSpan(100, std::make_shared<FillSpan>(1024 * 1024, 0));
+        document->insertSpan(0, std::make_shared<FillSpan>(100, 'z'));
+        document->writeSpan(document->getLength() - 10, std::make_shared<DataSpan>("tail"));
+        QByteArray expected = document->readAll();
+
+        auto target_device = deviceFromFile(target_file.fileName());
+        document->save(target_device);
+        QCOMPARE(QFileInfo(target_file.fileName()).size(), qint64(expected.length()));
+        QFile saved_file(target_file.fileName());
+        saved_file.open(QIODevice::ReadOnly);
+        QCOMPARE(saved_file.readAll(), expected);
+        QVERIFY(!QFileInfo(target_file.fileName() + ".mhs").exists());
+        QCOMPARE(source_device->readAll(), data.mid(1000, data.length() - 2000));
+
+#ifdef Q_OS_LINUX
+        // data that is missing from truncated source file cannot be copied, and target file stays unchanged
+        source_file.resize(data.length() / 2);
+        try {
+            document->save(target_device);
+            QFAIL("Exception was not thrown");
+        } catch (const DeviceError &) {
+
+        }
+        QCOMPARE(QFileInfo(target_file.fileName()).size(), qint64(expected.length()));
+#endif
+    }
+
     void test5() {
         QByteArray data("Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do eiusmod tempor "
                         "incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud "
@@ -580,6 +922,128 @@ private slots:
         QVERIFY(!doc->isRangeModified(2, 1));
     }
 
+    void testCoalesceEdits() {
+        QByteArray data("Lorem ipsum dolor sit amet");
+        auto document = std::make_shared<Document>(deviceFromData(data));
+
+        // typing over data byte by byte and past document end produces single undo action and single span
+        for (int j = 0; j < 30; ++j) {
+            document->writeSpan(20 + j, std::make_shared<DataSpan>(QByteArray(1, 'a' + j % 26)));
+        }
+        document->writeSpan(25, std::make_shared<DataSpan>("X"));
+        QCOMPARE(document->readAll(), data.mid(0, 20) + "abcdeXghijklmnopqrstuvwxyzabcd");
+        QCOMPARE(document->exportRange(20, 30, 0)->getSpans().length(), 1);
+
+        document->undo();
+        QCOMPARE(document->readAll(), data);
+        QVERIFY(!document->canUndo());
+        QVERIFY(!document->isModified());
+        document->redo();
+        QCOMPARE(document->readAll(), data.mid(0, 20) + "abcdeXghijklmnopqrstuvwxyzabcd");
+        document->undo();
+
+        // inserts are merged too, but not with writes outside of inserted data
+        document->insertSpan(5, std::make_shared<DataSpan>("12"));
+        document->insertSpan(7, std::make_shared<DataSpan>("34"));
+        document->insertSpan(5, std::make_shared<DataSpan>("0"));
+        document->writeSpan(0, std::make_shared<DataSpan>("l"));
+        QCOMPARE(document->readAll(), QByteArray("lorem01234 ipsum dolor sit amet"));
+        document->undo();
+        QCOMPARE(document->readAll(), QByteArray("Lorem01234 ipsum dolor sit amet"));
+        document->undo();
+        QCOMPARE(document->readAll(), data);
+        QVERIFY(!document->canUndo());
+
+        // in insert mode placeholder byte is inserted and then written for each typed byte: all typing is merged
+        // into single insertion
+        for (int j = 0; j < 10; ++j) {
+            document->insertSpan(5 + j, std::make_shared<DataSpan>(QByteArray(1, '\0')));
+            document->writeSpan(5 + j, std::make_shared<DataSpan>(QByteArray(1, 'a' + j)));
+        }
+        QCOMPARE(document->readAll(), QByteArray("Loremabcdefghij ipsum dolor sit amet"));
+        document->undo();
+        QCOMPARE(document->readAll(), data);
+        QVERIFY(!document->canUndo());
+        document->redo();
+        QCOMPARE(document->readAll(), QByteArray("Loremabcdefghij ipsum dolor sit amet"));
+        document->undo();
+
+        // edits are not merged when merging is disabled
+        document->setCoalesceInterval(0);
+        document->writeSpan(0, std::make_shared<DataSpan>("a"));
+        document->writeSpan(1, std::make_shared<DataSpan>("b"));
+        document->undo();
+        QCOMPARE(document->readAll(), QByteArray("aorem ipsum dolor sit amet"));
+        document->undo();
+        QCOMPARE(document->readAll(), data);
+    }
+
+    void testUndoMemoryBudget() {
+        QByteArray data(1000, 'a');
+        QByteArray written = data, modified = data;
+        for (int j = 0; j < 5; ++j) {
+            written.replace(j * 100, 100, QByteArray(100, 'b' + j));
+            modified.replace(j * 100, 100, QByteArray(100, 'B' + j));
+        }
+
+        // only data that is not in document anymore is counted: written data is referenced by document, but data
+        // overwritten by second pass is kept by history only
+        auto document = std::make_shared<Document>(deviceFromData(data));
+        document->setCoalesceInterval(0);
+        document->setUndoMemoryBudget(300);
+        for (int j = 0; j < 5; ++j) {
+            document->writeSpan(j * 100, std::make_shared<DataSpan>(QByteArray(100, 'b' + j)));
+        }
+        QCOMPARE(document->getUndoMemoryUsage(), qulonglong(0));
+
+        // data of oldest actions is moved to journal and read back on undo
+        for (int j = 0; j < 5; ++j) {
+            document->writeSpan(j * 100, std::make_shared<DataSpan>(QByteArray(100, 'B' + j)));
+        }
+        QCOMPARE(document->readAll(), modified);
+        QVERIFY(document->getUndoMemoryUsage() <= 300);
+        for (int j = 0; j < 5; ++j) {
+            document->undo();
+            QVERIFY(document->getUndoMemoryUsage() <= 300);
+        }
+        QCOMPARE(document->readAll(), written);
+        for (int j = 0; j < 5; ++j) {
+            document->undo();
+        }
+        QCOMPARE(document->readAll(), data);
+        QVERIFY(!document->isModified());
+        for (int j = 0; j < 10; ++j) {
+            document->redo();
+        }
+        QCOMPARE(document->readAll(), modified);
+
+        // inserted data is held by history only after insertion is undone
+        document->insertSpan(0, std::make_shared<DataSpan>(QByteArray(500, 'x')));
+        QVERIFY(document->getUndoMemoryUsage() <= 300);
+        document->undo();
+        QVERIFY(document->getUndoMemoryUsage() <= 300);
+        document->redo();
+        QCOMPARE(document->readAll(), QByteArray(500, 'x') + modified);
+
+        // oldest actions are forgotten when spilling is disabled
+        document = std::make_shared<Document>(deviceFromData(data));
+        document->setCoalesceInterval(0);
+        document->setUndoSpillEnabled(false);
+        document->setUndoMemoryBudget(300);
+        for (int j = 0; j < 5; ++j) {
+            document->writeSpan(j * 100, std::make_shared<DataSpan>(QByteArray(100, 'b' + j)));
+        }
+        for (int j = 0; j < 5; ++j) {
+            document->writeSpan(j * 100, std::make_shared<DataSpan>(QByteArray(100, 'B' + j)));
+        }
+        QCOMPARE(document->getUndoMemoryUsage(), qulonglong(300));
+        for (int j = 0; j < 3; ++j) {
+            document->undo();
+        }
+        QVERIFY(!document->canUndo());
+        QCOMPARE(document->readAll(), modified.mid(0, 200) + written.mid(200));
+    }
+
     void testOpenZeroSizeDevice() {
         auto dev = deviceFromData("");
         auto doc = std::make_shared<Document>(dev);
@@ -715,6 +1179,61 @@ private slots:
         QCOMPARE(finder.findPrevious(7ull), 4ull);
         QCOMPARE(finder.findPrevious(4ull), 3ull);
     }
+
+    void testFindAll() {
+        QByteArray data("abcddeadbeefdead");
+        auto doc = std::make_shared<Document>(deviceFromData(data));
+        BinaryFinder finder(doc, "ad");
+
+        QList<FinderMatch> matches = finder.findAll(0, doc->getLength());
+        QCOMPARE(matches.length(), 2);
+        QCOMPARE(matches[0].position, 6ull);
+        QCOMPARE(matches[0].length, 2);
+        QCOMPARE(matches[1].position, 14ull);
+
+        // matches starting in range are completed with data after it
+        matches = finder.findAll(5, 2);
+        QCOMPARE(matches.length(), 1);
+        QCOMPARE(matches[0].position, 6ull);
+        QVERIFY(finder.findAll(7, 7).isEmpty());
+
+        // data is not cached while searching
+        QTemporaryFile file;
+        file.open();
+        file.write(data);
+        file.flush();
+        auto device = deviceFromFile(file.fileName());
+        BinaryFinder file_finder(std::make_shared<Document>(device), "dead");
+        QCOMPARE(file_finder.findAll(0, data.length()).length(), 2);
+        QCOMPARE(device->getCacheStats().cachedPages, 0ull);
+    }
+
+    void testMultiPattern() {
+        QByteArray data("abcddeadbeef");
+        auto doc = std::make_shared<Document>(deviceFromData(data));
+        MultiPatternFinder finder(doc, QList<QByteArray>() << "dead" << "d" << "beef" << "xyz" << "");
+        QCOMPARE(finder.getMaximalPatternLength(), 4);
+
+        QList<FinderMatch> matches = finder.findAll(0, doc->getLength());
+        QCOMPARE(matches.length(), 5);
+        QCOMPARE(matches[0].position, 3ull);
+        QCOMPARE(matches[0].patternIndex, 1);
+        QCOMPARE(matches[1].position, 4ull);
+        QCOMPARE(matches[1].patternIndex, 0);
+        QCOMPARE(matches[1].length, 4);
+        QCOMPARE(matches[2].position, 4ull);
+        QCOMPARE(matches[2].patternIndex, 1);
+        QCOMPARE(matches[3].position, 7ull);
+        QCOMPARE(matches[3].patternIndex, 1);
+        QCOMPARE(matches[4].position, 8ull);
+        QCOMPARE(matches[4].patternIndex, 2);
+
+        // matches starting in range are completed with data after it
+        matches = finder.findAll(4, 1);
+        QCOMPARE(matches.length(), 2);
+        QCOMPARE(matches[0].patternIndex, 0);
+        QVERIFY(finder.findAll(9, 100).isEmpty());
+    }
 };
 
 
@@ -3,7 +3,9 @@
 
 #include <stdexcept>
 #include <QString>
+#include <QByteArray>
 #include <string>
+#include <memory>
 
 class BaseException : public std::logic_error {
 public:
@@ -14,4 +16,23 @@ public:
 
 extern const qulonglong QULONGLONG_MAX;
 
+
+class DataView {
+public:
+    /** Read-only data that refers to memory of span or device without copying it. Memory is valid while holder
+     *  is alive (memory of mapped devices is valid until device file is closed). Null view means that requested
+     *  data cannot be viewed without copying.
+     **/
+
+    DataView() { }
+    DataView(const QByteArray &data, const std::shared_ptr<const void> &holder) : data(data), holder(holder) {
+
+    }
+
+    bool isNull()const { return data.isNull(); }
+
+    QByteArray data;
+    std::shared_ptr<const void> holder;
+};
+
 #endif // BASE_H
@@ -8,6 +8,10 @@
 #include "base.h"
 
 
+// neighbouring DataSpans are merged only while resulting span is not larger than this
+qulonglong MAXIMAL_MERGED_DATA_SPAN = 1024 * 64; // 64 KB
+
+
 SpanChain::SpanChain() : _length(), _lock(std::make_shared<ReadWriteLock>()) {
 
 }
@@ -53,6 +57,7 @@ void SpanChain::setSpans(const SpanList &spans) {
 
     std::swap(new_list, _spans);
     std::swap(new_length, _length);
+    _updateOffsets();
 }
 
 void SpanChain::_setSpans(const QList<std::shared_ptr<SpanChain::SpanData>> &spans) {
@@ -70,6 +75,7 @@ void SpanChain::_setSpans(const QList<std::shared_ptr<SpanChain::SpanData>> &spa
 
     std::swap(new_list, _spans);
     std::swap(new_length, _length);
+    _updateOffsets();
 }
 
 void SpanChain::clear() {
@@ -106,6 +112,63 @@ QByteArray SpanChain::readAll() const {
     return read(0, this->getLength());
 }
 
+qulonglong SpanChain::readInto(qulonglong offset, char *buffer, qulonglong length, bool use_cache) const {
+    /** Same as SpanChain::read, but copies data into :buffer: instead of allocating new array. Buffer should be
+     *  able to hold :length: bytes. Returns number of bytes actually read. If :use_cache: is false, device data is
+     *  read past device caches, so reading large amounts of data once does not evict pages other readers use.
+     **/
+    ReadLocker locker(_lock);
+
+    if (offset >= _length) {
+        return 0;
+    } else if (_length - offset < length) {
+        length = _length - offset;
+    }
+
+    if (!length) {
+        return 0;
+    }
+
+    qulonglong left_offset, right_offset;
+    SpanList spans = spansInRange(offset, length, &left_offset, &right_offset);
+    qulonglong bytes_read = 0;
+    for (int span_index = 0; span_index < spans.length(); ++span_index) {
+        qulonglong pos = !span_index ? left_offset : 0;
+        qulonglong size = span_index == spans.length() - 1 ? (right_offset - pos) + 1 : spans[span_index]->getLength() - pos;
+        size = std::min(size, length - bytes_read);
+        spans[span_index]->readInto(pos, buffer + bytes_read, size, use_cache);
+        bytes_read += size;
+    }
+    return bytes_read;
+}
+
+DataView SpanChain::view(qulonglong offset, qulonglong length) const {
+    /** Returns view of as much data as possible starting from :offset:, but not more than :length: bytes.
+     *  Data can be viewed without copying only if it is held by single span that supports it (DataSpan, or
+     *  span of mapped or cached device data), otherwise null view is returned.
+     **/
+    ReadLocker locker(_lock);
+
+    if (offset >= _length) {
+        return DataView(QByteArray(""), nullptr);
+    } else if (_length - offset < length) {
+        length = _length - offset;
+    } else if (length > qulonglong(INT_MAX)) {
+        throw std::overflow_error("integer overflow");
+    }
+
+    if (!length) {
+        return DataView(QByteArray(""), nullptr);
+    }
+
+    qulonglong span_offset;
+    auto span = spanAtOffset(offset, &span_offset);
+    if (!span || span->getLength() - span_offset < length) {
+        return DataView();
+    }
+    return span->view(span_offset, length);
+}
+
 SpanList SpanChain::spansInRange(qulonglong offset, qulonglong length, qulonglong *left_offset,
                                  qulonglong *right_offset) const {
     /** Returns list of spans that contain :length: of bytes from :offset:. It is not guarantied that first
@@ -152,18 +215,62 @@ int SpanChain::_findSpanIndex(qulonglong offset, qulonglong *span_offset) const
         return -1;
     }
 
+    // span holding byte at :offset: is last span that starts at or before :offset:. Empty spans can start at same
+    // offset as following span, but they are never last ones with such start offset.
+    auto found = std::upper_bound(_offsets.constBegin(), _offsets.constEnd(), offset);
+    int span_index = int(found - _offsets.constBegin()) - 1;
+    assert(span_index >= 0 && span_index < _spans.length());
+
+    if (span_offset) {
+        *span_offset = offset - _offsets[span_index];
+    }
+    return span_index;
+}
+
+void SpanChain::_updateOffsets(int from_span_index, int changed_count) {
+    /** Updates offset index after _spans list was changed. :from_span_index: is index of first changed span and
+     *  :changed_count: is number of spans starting from it that were inserted or replaced (-1 if all spans from
+     *  :from_span_index: to end of list should be recalculated). Spans after changed ones should be same spans that
+     *  were in list before change, so their offsets are only shifted by change of length instead of asking each
+     *  span for its length again. Offsets of spans before :from_span_index: are not changed.
+     **/
+
+    if (from_span_index < 0) {
+        from_span_index = 0;
+    }
+    from_span_index = std::min(from_span_index, _spans.length());
+    int first_unchanged_index = _spans.length();
+    if (changed_count >= 0) {
+        first_unchanged_index = std::min(from_span_index + changed_count, _spans.length());
+    }
+
+    // move offsets of unchanged spans to their new indexes
+    int count_delta = _spans.length() - _offsets.length();
+    if (first_unchanged_index == _spans.length()) {
+        _offsets.resize(_spans.length());
+    } else if (count_delta > 0) {
+        _offsets.insert(from_span_index, count_delta, 0);
+    } else if (count_delta < 0) {
+        _offsets.remove(from_span_index, -count_delta);
+    }
+    assert(_offsets.length() == _spans.length());
+
     qulonglong current_offset = 0;
-    for (int j = 0; j < _spans.length(); ++j) {
-        if (offset >= current_offset && offset < current_offset + _spans[j]->span->getLength()) {
-            if (span_offset) {
-                *span_offset = offset - current_offset;
-            }
-            return j;
-        }
+    if (from_span_index > 0) {
+        current_offset = _offsets[from_span_index - 1] + _spans[from_span_index - 1]->span->getLength();
+    }
+    for (int j = from_span_index; j < first_unchanged_index; ++j) {
+        _offsets[j] = current_offset;
         current_offset += _spans[j]->span->getLength();
     }
 
-    return -1;
+    if (first_unchanged_index < _spans.length() && _offsets[first_unchanged_index] != current_offset) {
+        // offsets are unsigned, but wrapping arithmetic gives correct result for negative delta too
+        qulonglong delta = current_offset - _offsets[first_unchanged_index];
+        for (int j = first_unchanged_index; j < _spans.length(); ++j) {
+            _offsets[j] += delta;
+        }
+    }
 }
 
 std::shared_ptr<AbstractSpan> SpanChain::spanAtOffset(qulonglong offset, qulonglong *span_offset) const {
@@ -239,7 +346,7 @@ std::shared_ptr<SpanChain> SpanChain::exportRange(qulonglong offset, qulonglong
             if (device_span) {
                 // check if amount of already used memory allows us to convert current device span to DataSpan
                 if (ram_limit < 0 || qulonglong(current_ram) + device_span->getLength() <= qulonglong(ram_limit)) {
-                    QByteArray data = device_span->read(0, device_span->getLength());
+                    QByteArray data = detachedData(device_span->read(0, device_span->getLength()));
                     assert(qulonglong(data.length()) == device_span->getLength());
                     result->_spans[j]->span = std::make_shared<DataSpan>(data);
                     current_ram += data.length();
@@ -284,6 +391,7 @@ void SpanChain::splitSpans(qulonglong offset) {
         auto splitted = _spans[span_index]->span->split(span_offset);
         _spans.replace(span_index, std::make_shared<SpanData>(shared_from_this(), splitted.first, savepoint));
         _spans.insert(span_index + 1, std::make_shared<SpanData>(shared_from_this(), splitted.second, savepoint));
+        _updateOffsets(span_index, 2);
     }
 }
 
@@ -314,6 +422,7 @@ void SpanChain::insertChain(qulonglong offset, const std::shared_ptr<SpanChain>
 
     QList<std::shared_ptr<SpanData>> new_list = _spans;
     qulonglong new_length = _length + chain->getLength();
+    int first_inserted_index = span_index;
 
     for (auto span_data : chain->_spans) {
         new_list.insert(span_index++, std::shared_ptr<SpanData>(new SpanData(shared_from_this(), *span_data)));
@@ -321,6 +430,8 @@ void SpanChain::insertChain(qulonglong offset, const std::shared_ptr<SpanChain>
 
     std::swap(new_list, _spans);
     std::swap(new_length, _length);
+    _updateOffsets(first_inserted_index, span_index - first_inserted_index);
+    _mergeDataSpans(first_inserted_index - 1, span_index);
 }
 
 void SpanChain::remove(qulonglong offset, qulonglong length) {
@@ -344,6 +455,55 @@ void SpanChain::remove(qulonglong offset, qulonglong length) {
         _spans.removeAt(span_index);
     }
     _length -= length;
+    _updateOffsets(span_index, 0);
+    _mergeDataSpans(span_index - 1, span_index);
+}
+
+void SpanChain::replaceSpans(const SpanReplacer &replacer) {
+    /** Replaces each span in chain with span returned by :replacer: for it. Replacement should hold same data as
+     *  replaced span. Savepoints are kept.
+     **/
+    WriteLocker locker(_lock);
+
+    for (int j = 0; j < _spans.length(); ++j) {
+        auto replacement = replacer(_spans[j]->span);
+        if (replacement != _spans[j]->span) {
+            assert(replacement->getLength() == _spans[j]->span->getLength());
+            _spans.replace(j, std::make_shared<SpanData>(shared_from_this(), replacement, _spans[j]->savepoint));
+        }
+    }
+}
+
+void SpanChain::_mergeDataSpans(int first_index, int last_index) {
+    /** Replaces neighbouring DataSpans with same savepoint in range [first_index, last_index] with single span,
+     *  so editing data byte by byte does not leave thousands of tiny spans in chain.
+     **/
+    first_index = std::max(first_index, 0);
+    last_index = std::min(last_index, _spans.length() - 1);
+
+    bool merged = false;
+    int span_index = first_index;
+    while (span_index < last_index) {
+        auto left_data = _spans[span_index], right_data = _spans[span_index + 1];
+        auto left_span = std::dynamic_pointer_cast<DataSpan>(left_data->span);
+        auto right_span = std::dynamic_pointer_cast<DataSpan>(right_data->span);
+        if (left_span && right_span && left_data->savepoint == right_data->savepoint &&
+                left_span->getLength() + right_span->getLength() <= MAXIMAL_MERGED_DATA_SPAN) {
+            auto merged_span = std::make_shared<DataSpan>(left_span->read(0, left_span->getLength()) +
+                                                          right_span->read(0, right_span->getLength()));
+            _spans.replace(span_index, std::make_shared<SpanData>(shared_from_this(), merged_span,
+                                                                  left_data->savepoint));
+            _spans.removeAt(span_index + 1);
+            --last_index;
+            merged = true;
+        } else {
+            ++span_index;
+        }
+    }
+
+    if (merged) {
+        _updateOffsets(first_index, last_index - first_index + 1);
+    }
 }
 
 void SpanChain::_onSpanDissolved(const std::shared_ptr<AbstractSpan> &span, const SpanList &replacement) {
@@ -359,6 +519,7 @@ void SpanChain::_onSpanDissolved(const std::shared_ptr<AbstractSpan> &span, cons
 
     int span_index = span_iter - _spans.constBegin();
     if (span_index >= 0) {
+        int first_changed_index = span_index;
         auto removed_span_data = _spans.takeAt(span_index);
         ++span_index;
         for (int j = 0; j < replacement.length(); ++j, ++span_index) {
@@ -366,6 +527,7 @@ void SpanChain::_onSpanDissolved(const std::shared_ptr<AbstractSpan> &span, cons
             span_data->savepoint = removed_span_data->savepoint;
             _spans.insert(span_index, span_data);
         }
+        _updateOffsets(first_changed_index, replacement.length());
     }
 }
 
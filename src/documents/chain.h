@@ -3,6 +3,7 @@
 
 #include <QObject>
 #include <QList>
+#include <QVector>
 #include <memory>
 #include "readwritelock.h"
 #include "spans.h"
@@ -28,6 +29,8 @@ public:
 
     QByteArray read(qulonglong offset, qulonglong length)const;
     QByteArray readAll()const;
+    qulonglong readInto(qulonglong offset, char *buffer, qulonglong length, bool use_cache=true)const;
+    DataView view(qulonglong offset, qulonglong length)const;
 
     SpanList spansInRange(qulonglong offset, qulonglong length, qulonglong *left_offset=nullptr,
                           qulonglong *right_offset=nullptr)const;
@@ -41,6 +44,7 @@ public:
     void insertSpan(qulonglong offset, const std::shared_ptr<AbstractSpan> &span);
     void insertChain(qulonglong offset, const std::shared_ptr<SpanChain> &chain);
     void remove(qulonglong offset, qulonglong length);
+    void replaceSpans(const SpanReplacer &replacer);
 
     void setCommonSavepoint(int savepoint);
     int spanSavepoint(const std::shared_ptr<AbstractSpan> &span);
@@ -71,10 +75,13 @@ private:
 
     qulonglong _calculateLength(const SpanList &spans);
     int _findSpanIndex(qulonglong offset, qulonglong *span_offset=nullptr)const;
+    void _updateOffsets(int from_span_index=0, int changed_count=-1);
+    void _mergeDataSpans(int first_index, int last_index);
     void _setSpans(const QList<std::shared_ptr<SpanData>> &);
     SpanList _spanDataListToSpans(const QList<std::shared_ptr<SpanData>> &list) const;
 
     QList<std::shared_ptr<SpanData>> _spans;
+    QVector<qulonglong> _offsets; // _offsets[j] is offset of first byte of span _spans[j]
     qulonglong _length;
     std::shared_ptr<ReadWriteLock> _lock;
 };
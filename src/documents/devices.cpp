@@ -2,6 +2,7 @@
 #include <cassert>
 #include <cmath>
 #include <ctime>
+#include <cstring>
 #include <algorithm>
 #include <functional>
 #include <iterator>
@@ -9,13 +10,37 @@
 #include <QBuffer>
 #include <QMutex>
 #include <QDebug>
+#include <QDataStream>
+#include <QElapsedTimer>
+#include <climits>
+#include <limits>
+#include <vector>
+#include <atomic>
+#include <cerrno>
+#ifdef Q_OS_UNIX
+#include <unistd.h>
+#include <fcntl.h>
+#include <sys/file.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#elif QT_VERSION >= 0x050100
+#include <QLockFile>
+#endif
+#ifdef Q_OS_LINUX
+#include <fcntl.h>
+#include <sys/sendfile.h>
+#include <sys/syscall.h>
+#endif
 #include "spans.h"
 #include "document.h"
 
 
 qulonglong DEFAULT_CACHE_SIZE = 1024 * 1024 * 8; // 8 MB
-qulonglong DEFAULT_CACHE_BOUNDARY = 1024 * 1024; // 1 MB
+qulonglong DEFAULT_PAGE_SIZE = 1024 * 64; // 64 KB
 qulonglong MAXIMAL_WRITE_BLOCK = 1024 * 1024 * 64; // 64 MB
+qulonglong MAXIMAL_IN_PLACE_MOVE = 1024 * 1024 * 256; // 256 MB
+qulonglong MAXIMAL_IN_PLACE_MOVE_TIME = 2000; // ms
+qulonglong DEFAULT_IN_PLACE_MOVE_SPEED = 1024 * 1024 * 32; // bytes per second, until speed is measured by first save
 
 
 static QList<AbstractDevice*> _allDevices;
@@ -66,8 +91,8 @@ QString getTempFilename(const QString &base_filename, const QString &suffix) {
 }
 
 AbstractDevice::AbstractDevice(const QUrl &url, LoadOptions *options)
-    : _loadOptions(options), _url(url), _cacheStart(0), _cacheSize(DEFAULT_CACHE_SIZE),
-      _cacheBoundary(DEFAULT_CACHE_BOUNDARY), _lock(std::make_shared<ReadWriteLock>()) {
+    : _loadOptions(options), _url(url), _cacheSize(DEFAULT_CACHE_SIZE), _pageSize(DEFAULT_PAGE_SIZE),
+      _lock(std::make_shared<ReadWriteLock>()) {
     // we cannot process LoadOptions.memoryLoad flag here, because we should encache device contents not on first access,
     // but when device is created. We cannot do this in constructor, as inherited class virtual methods are not available
     // at this moment. LoadOptions.memoryLoad is processed in deviceFromUrl factory function.
@@ -98,27 +123,33 @@ QByteArray AbstractDevice::read(qulonglong position, qulonglong length) const {
         length = this->getLength() - position;
     }
 
-    if (position >= _cacheStart && position < _cacheStart + _cache.length()) {
-        // bytes are cached...
-        qulonglong cache_offset = position - _cacheStart;
-        if (length <= _cacheStart + _cache.length() - position) {
-            // all requested range is in cache
-            return _cache.mid(cache_offset, length);
-        } else {
-            // we should additionally read some data from device. Do not move cache - it can cause problems
-            qulonglong cached_bytes_count = _cache.length() - cache_offset;
-            return _cache.mid(cache_offset, cached_bytes_count) +
-                    _read(_cacheStart + _loadOptions->rangeStart + _cache.length(), length - cached_bytes_count);
-        }
-    } else if (_cacheSize > 0) {
-        // cache is enabled, but we have cache miss. move it.
-        _encache(position, true);
-        // and try again
-        return read(position, length);
-    } else {
-        // cache disabled - we can only read directly from device
+    if (isMapped()) {
+        // mapped data is read without copying, so caching it only wastes memory
+        return _read(position + _loadOptions->rangeStart, length);
+    } else if (_bypassesCache(length)) {
         return _read(position + _loadOptions->rangeStart, length);
     }
+
+    // collect data from cached pages
+    QByteArray result;
+    qulonglong current_position = position, page_size = _pageSize;
+    while (current_position < position + length) {
+        QByteArray page = _cachedPage(current_position / page_size, page_size);
+        qulonglong page_offset = current_position % page_size;
+        if (page_offset >= qulonglong(page.length())) {
+            break;
+        }
+
+        qulonglong chunk_length = std::min(position + length - current_position, page.length() - page_offset);
+        if (current_position == position && chunk_length == length) {
+            // requested range is inside single page, no need to join chunks
+            return page_offset == 0 && chunk_length == qulonglong(page.length()) ? page
+                                                                                 : page.mid(page_offset, chunk_length);
+        }
+        result += page.mid(page_offset, chunk_length);
+        current_position += chunk_length;
+    }
+    return result;
 }
 
 QByteArray AbstractDevice::readAll() const {
@@ -126,29 +157,181 @@ QByteArray AbstractDevice::readAll() const {
     return read(0, this->getLength());
 }
 
-void AbstractDevice::_encache(qulonglong from_position, bool center) const {
+qulonglong AbstractDevice::readInto(qulonglong position, char *buffer, qulonglong length, bool use_cache) const {
+    /** Same as AbstractDevice::read, but copies data into :buffer: instead of allocating new array. Buffer should be
+     *  able to hold :length: bytes. Returns number of bytes actually read. If :use_cache: is false, data is read
+     *  directly from device and cached pages are neither used nor evicted (except for memory-loaded devices that
+     *  keep all data in cache).
+     **/
     ReadLocker locker(_lock);
-    assert(!_cacheBoundary || _cacheBoundary <= _cacheSize);
-
-    qulonglong cache_start;
-    if (center) {
-        cache_start = from_position > _cacheSize / 2 ? from_position - _cacheSize / 2 : qulonglong(0);
-        if (_cacheBoundary) {
-            cache_start -= cache_start % _cacheBoundary;
-            if (cache_start + _cacheSize <= from_position) {
-                // byte at :from_position: is not in cache?
-                cache_start = from_position - from_position % _cacheBoundary;
-            }
+
+    if (position + length < position) {
+        throw std::overflow_error("integer overflow");
+    } else if (!length || position >= this->getLength()) {
+        return 0;
+    } else if (this->getLength() - position < length) {
+        length = this->getLength() - position;
+    }
+
+    if (isMapped() || (!use_cache && !_loadOptions->memoryLoad) || _bypassesCache(length)) {
+        QByteArray data = _read(position + _loadOptions->rangeStart, length);
+        std::memcpy(buffer, data.constData(), data.length());
+        return data.length();
+    }
+
+    // copy data from cached pages
+    qulonglong current_position = position, page_size = _pageSize;
+    while (current_position < position + length) {
+        QByteArray page = _cachedPage(current_position / page_size, page_size);
+        qulonglong page_offset = current_position % page_size;
+        if (page_offset >= qulonglong(page.length())) {
+            break;
         }
-    } else {
-        cache_start = from_position;
-        if (_cacheBoundary) {
-            cache_start -= from_position % _cacheBoundary;
+
+        qulonglong chunk_length = std::min(position + length - current_position, page.length() - page_offset);
+        std::memcpy(buffer + (current_position - position), page.constData() + page_offset, chunk_length);
+        current_position += chunk_length;
+    }
+    return current_position - position;
+}
+
+DataView AbstractDevice::view(qulonglong position, qulonglong length) const {
+    /** Returns view of :length: bytes starting from :position: without copying them. Only data of mapped devices
+     *  or data inside single cached page can be viewed, otherwise null view is returned.
+     **/
+    ReadLocker locker(_lock);
+
+    if (position + length < position || position >= getLength() || getLength() - position < length
+            || length > qulonglong(INT_MAX)) {
+        return DataView();
+    }
+
+    if (isMapped()) {
+        DataView data_view = _mappedView(position + _loadOptions->rangeStart, length);
+        if (!data_view.isNull() || isMapped()) {
+            return data_view;
+        }
+        // file cannot be mapped anymore, so data is viewed from cache
+    }
+
+    qulonglong page_size = _pageSize;
+    if (!getCacheSize() || !length || position / page_size != (position + length - 1) / page_size) {
+        return DataView();
+    }
+
+    // page can be evicted from cache, but data will be alive while view holds a reference to it
+    auto page = std::make_shared<QByteArray>(_cachedPage(position / page_size, page_size));
+    qulonglong page_offset = position % page_size;
+    if (page_offset + length > qulonglong(page->length())) {
+        return DataView();
+    }
+    return DataView(QByteArray::fromRawData(page->constData() + page_offset, int(length)), page);
+}
+
+bool AbstractDevice::_bypassesCache(qulonglong length) const {
+    /** Returns true if :length: bytes should be read directly from device: cache is disabled or data is too large
+     *  to be cached, so caching it would evict all pages other readers use. Memory-loaded devices always keep all
+     *  data in cache.
+     **/
+    QMutexLocker cache_locker(&_cacheMutex);
+    return !_cacheSize || (length > _cacheSize / 2 && !_loadOptions->memoryLoad);
+}
+
+QByteArray AbstractDevice::_cachedPage(qulonglong page_index, qulonglong page_size) const {
+    /** Returns data of page with given index, loading it from device if page is not cached. Page that is
+     *  returned becomes most recently used one. Page is loaded without _cacheMutex locked, so readers of other
+     *  pages are not blocked by device I/O. Should be called with _cacheMutex unlocked and device lock held for
+     *  reading, :page_size: is page size caller has computed :page_index: with.
+     **/
+
+    {
+        QMutexLocker cache_locker(&_cacheMutex);
+        auto page_iter = _cachePages.find(page_index);
+        if (page_iter != _cachePages.end()) {
+            ++_cacheStats.hits;
+            _cacheLru.splice(_cacheLru.begin(), _cacheLru, page_iter->lruPosition);
+            return page_iter->data;
+        }
+        ++_cacheStats.misses;
+    }
+
+    qulonglong page_start = page_index * page_size, device_length = getLength();
+    QByteArray page_data;
+    if (page_start < device_length) {
+        page_data = _read(page_start + _loadOptions->rangeStart, std::min(page_size, device_length - page_start));
+    }
+
+    QMutexLocker cache_locker(&_cacheMutex);
+    auto page_iter = _cachePages.find(page_index);
+    if (page_iter != _cachePages.end()) {
+        // another reader has loaded same page while we were reading it
+        _cacheLru.splice(_cacheLru.begin(), _cacheLru, page_iter->lruPosition);
+        return page_iter->data;
+    }
+
+    CachePage page;
+    page.data = page_data;
+    _cacheLru.push_front(page_index);
+    page.lruPosition = _cacheLru.begin();
+    _cacheStats.cachedBytes += page.data.length();
+    ++_cacheStats.cachedPages;
+    _cachePages.insert(page_index, page);
+
+    _evictPages(page_index);
+
+    return page_data;
+}
+
+void AbstractDevice::_evictPages(qulonglong keep_page_index) const {
+    /** Removes least recently used pages until cache fits into its size. Page with :keep_page_index: is never
+     *  removed. Should be called with _cacheMutex locked.
+     **/
+
+    while (_cacheStats.cachedBytes > _cacheSize && !_cacheLru.empty()) {
+        qulonglong page_index = _cacheLru.back();
+        if (page_index == keep_page_index) {
+            break;
         }
+        _cacheLru.pop_back();
+        _cacheStats.cachedBytes -= _cachePages[page_index].data.length();
+        --_cacheStats.cachedPages;
+        _cachePages.remove(page_index);
+    }
+}
+
+void AbstractDevice::_dropPages(qulonglong first_page_index, qulonglong last_page_index) {
+    /** Removes all cached pages with indexes in range [first_page_index, last_page_index]
+     **/
+
+    QMutexLocker cache_locker(&_cacheMutex);
+
+    for (auto lru_iter = _cacheLru.begin(); lru_iter != _cacheLru.end(); ) {
+        if (*lru_iter >= first_page_index && *lru_iter <= last_page_index) {
+            _cacheStats.cachedBytes -= _cachePages[*lru_iter].data.length();
+            --_cacheStats.cachedPages;
+            _cachePages.remove(*lru_iter);
+            lru_iter = _cacheLru.erase(lru_iter);
+        } else {
+            ++lru_iter;
+        }
+    }
+}
+
+void AbstractDevice::_encache(qulonglong position, qulonglong length) const {
+    /** Loads all pages that hold data in given range into cache.
+     **/
+
+    ReadLocker locker(_lock);
+
+    if (!getCacheSize() || !length || isMapped()) {
+        return;
     }
 
-    _cache = _read(cache_start + _loadOptions->rangeStart, _cacheSize);
-    _cacheStart = cache_start;
+    qulonglong page_size = _pageSize;
+    for (qulonglong page_index = position / page_size; page_index <= (position + length - 1) / page_size;
+                                                                                                ++page_index) {
+        _cachedPage(page_index, page_size);
+    }
 }
 
 qulonglong AbstractDevice::write(qulonglong position, const QByteArray &data) {
@@ -166,9 +349,9 @@ qulonglong AbstractDevice::write(qulonglong position, const QByteArray &data) {
     }
 
     qulonglong bytes_written = _write(position + _loadOptions->rangeStart, data);
-    if (checkRangesIntersect(position, data.length(), _cacheStart, _cache.length())) {
-        // if we write into cached region, invalidate cache
-        _cache = QByteArray();
+    if (!data.isEmpty()) {
+        // invalidate cached pages we have written into
+        _dropPages(position / _pageSize, (position + data.length() - 1) / _pageSize);
     }
     return bytes_written;
 }
@@ -180,6 +363,8 @@ void AbstractDevice::resize(qulonglong new_size) {
         if (_loadOptions->freezeSize || _loadOptions->rangeLoad) {
             throw FrozenSizeError();
         }
+        // last page before resizing can be incomplete, and pages after new end are not valid anymore
+        _dropPages(std::min(new_size, getLength()) / _pageSize, ULLONG_MAX);
         _resize(new_size);
     }
 }
@@ -194,8 +379,37 @@ std::shared_ptr<AbstractSaver> AbstractDevice::createSaver(const std::shared_ptr
 }
 
 void AbstractDevice::setCacheSize(qulonglong size) {
+    /** Sets maximal number of bytes that cached pages can occupy. Zero size disables caching.
+     **/
+    QMutexLocker cache_locker(&_cacheMutex);
     _cacheSize = size;
-    _cacheBoundary = 0;
+    _evictPages(ULLONG_MAX);
+}
+
+void AbstractDevice::setPageSize(qulonglong size) {
+    /** Sets size of pages cache consists of. Changing page size drops all cached pages. Device is locked for
+     *  writing, so readers never compute page indexes with one page size and load pages with another.
+     **/
+    if (!size) {
+        throw OutOfBoundsError();
+    }
+
+    WriteLocker locker(_lock);
+    if (size != _pageSize) {
+        _dropPages(0, ULLONG_MAX);
+        QMutexLocker cache_locker(&_cacheMutex);
+        _pageSize = size;
+    }
+}
+
+CacheStats AbstractDevice::getCacheStats() const {
+    QMutexLocker cache_locker(&_cacheMutex);
+    return _cacheStats;
+}
+
+void AbstractDevice::resetCacheStats() {
+    QMutexLocker cache_locker(&_cacheMutex);
+    _cacheStats.hits = _cacheStats.misses = 0;
 }
 
 QList<std::shared_ptr<PrimitiveDeviceSpan> > AbstractDevice::getSpans() const {
@@ -243,11 +457,18 @@ void StandardSaver::putSpan(const std::shared_ptr<const AbstractSpan> &span) {
         }
         _position += span_data.length();
         span_offset += read_length;
+        _reportProgress(_position);
+    }
+}
+
+void StandardSaver::_reportProgress(qulonglong saved_length) {
+    if (_document->_reportSaveProgress(saved_length) && isCancellable()) {
+        throw SaveCancelledError();
     }
 }
 
 QtProxyDevice::QtProxyDevice(const QUrl &url, LoadOptions *options)
-    : AbstractDevice(url, options), _qdevice(0), _deviceClosed(true) {
+    : AbstractDevice(url, options), _qdevice(0), _deviceClosed(true), _ioMutex(QMutex::Recursive) {
 
 }
 
@@ -260,6 +481,7 @@ void QtProxyDevice::_onDeviceAboutToClose() {
 }
 
 void QtProxyDevice::_ensureOpened() const {
+    QMutexLocker io_locker(&_ioMutex);
     if (_deviceClosed) {
         bool read_only_changed = false;
         QIODevice::OpenMode open_mode = _loadOptions->readOnly ? QIODevice::ReadOnly : QIODevice::ReadWrite;
@@ -288,6 +510,8 @@ void QtProxyDevice::_setQDevice(const std::shared_ptr<QIODevice> &device) {
 }
 
 QByteArray QtProxyDevice::_read(qulonglong position, qulonglong length) const {
+    // readers hold device lock only for reading, so they should not move device position at same time
+    QMutexLocker io_locker(&_ioMutex);
     _ensureOpened();
     if (!_qdevice->seek(position)) {
         throw DeviceError("failed to seek to position");
@@ -296,6 +520,7 @@ QByteArray QtProxyDevice::_read(qulonglong position, qulonglong length) const {
 }
 
 qulonglong QtProxyDevice::_write(qulonglong position, const QByteArray &data) {
+    QMutexLocker io_locker(&_ioMutex);
     _ensureOpened();
     if (!_qdevice->seek(position)) {
         throw DeviceError("failed to seek to position");
@@ -303,20 +528,212 @@ qulonglong QtProxyDevice::_write(qulonglong position, const QByteArray &data) {
     return _qdevice->write(data);
 }
 
+class FileMapping {
+public:
+    /** Region of file mapped into memory. Region is unmapped when last reference to mapping is released, so views
+     *  of mapped data can keep it alive after device has unmapped file.
+     **/
+
+    FileMapping(const uchar *data, qulonglong start, qulonglong length, const std::function<void()> &unmap)
+        : data(data), start(start), length(length), _unmap(unmap) {
+
+    }
+
+    ~FileMapping() {
+        _unmap();
+    }
+
+    const uchar *data;
+    qulonglong start, length; // position of first mapped byte in file and number of mapped bytes
+
+private:
+    std::function<void()> _unmap;
+};
+
 FileDevice::FileDevice(const QString &filename, FileLoadOptions *options)
-                      : QtProxyDevice(QUrl::fromLocalFile(filename), options) {
+                      : QtProxyDevice(QUrl::fromLocalFile(filename), options), _saveInterrupted(false),
+                        _inPlaceMoveSpeed(DEFAULT_IN_PLACE_MOVE_SPEED), _mapped(false) {
     QFileInfo file_info = QFileInfo(filename);
     if (!getFileLoadOptions().forceNew && !file_info.exists()) {
         throw DeviceError(QString("file %1 does not exist").arg(file_info.fileName()));
     }
     _setQDevice(std::make_shared<QFile>(filename));
+    // QFile unmaps all regions when closed, so we should forget mapped address before it happens, even if
+    // file is closed from another thread
+    connect(getQDevice().get(), SIGNAL(aboutToClose()), this, SLOT(_onFileAboutToClose()), Qt::DirectConnection);
+}
+
+FileDevice::~FileDevice() {
+    if (getFileLoadOptions().temporary) {
+        _unmapFile();
+        std::dynamic_pointer_cast<QFile>(getQDevice())->remove();
+    }
 }
 
 bool FileDevice::isFixedSize()const {
     return getFileLoadOptions().freezeSize;
 }
 
+QByteArray FileDevice::_read(qulonglong position, qulonglong length) const {
+    if (_mapped) {
+        auto mapping = _currentMapping();
+        if (mapping) {
+            if (position < mapping->start || position >= mapping->start + mapping->length) {
+                return QByteArray();
+            }
+            length = std::min(length, mapping->start + mapping->length - position);
+            if (length > qulonglong(INT_MAX)) {
+                throw std::overflow_error("integer overflow");
+            }
+            // returned array refers to mapped memory and is valid until file is unmapped. Use detachedData
+            // to get a copy that should outlive device, or view to get data that keeps mapping alive.
+            return QByteArray::fromRawData(reinterpret_cast<const char*>(mapping->data + (position - mapping->start)),
+                                           int(length));
+        }
+    }
+    return _readFile(position, length);
+}
+
+DataView FileDevice::_mappedView(qulonglong position, qulonglong length) const {
+    /** Returns view of mapped data that holds reference to mapping, so viewed memory remains valid after file
+     *  is unmapped or closed.
+     **/
+    auto mapping = _currentMapping();
+    if (!mapping || position < mapping->start || position >= mapping->start + mapping->length
+            || mapping->start + mapping->length - position < length) {
+        return DataView();
+    }
+
+    QByteArray data = QByteArray::fromRawData(reinterpret_cast<const char*>(mapping->data + (position - mapping->start)),
+                                              int(length));
+#ifdef Q_OS_UNIX
+    return DataView(data, mapping);
+#else
+    // region mapped with QFile is unmapped when file is closed whatever references to it are alive
+    return DataView(detachedData(data), nullptr);
+#endif
+}
+
+std::shared_ptr<FileMapping> FileDevice::_currentMapping() const {
+    /** Returns mapping of device data, mapping file again if it was unmapped. Returns nullptr if file cannot be
+     *  mapped anymore.
+     **/
+    QMutexLocker map_locker(&_mapMutex);
+    if (!_mapping && _mapped) {
+        _mapFile();
+    }
+    return _mapping;
+}
+
+QByteArray FileDevice::_readFile(qulonglong position, qulonglong length) const {
+    /** Reads data from file with positional reads that do not move shared file position, so several threads can
+     *  read file at once. Data written through QFile is flushed by _write, so these reads always see it.
+     **/
+#ifdef Q_OS_UNIX
+    if (length > qulonglong(INT_MAX)) {
+        throw std::overflow_error("integer overflow");
+    }
+
+    int handle;
+    {
+        QMutexLocker io_locker(&_ioMutex);
+        _ensureOpened();
+        handle = std::dynamic_pointer_cast<QFile>(_qdevice)->handle();
+    }
+
+    QByteArray result;
+    result.resize(int(length));
+    qulonglong bytes_read = 0;
+    while (bytes_read < length) {
+        ssize_t result_count = ::pread(handle, result.data() + bytes_read, length - bytes_read, position + bytes_read);
+        if (result_count == 0) {
+            break;
+        } else if (result_count < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+            throw DeviceError(QString("failed to read %1: %2").arg(getUrl().toLocalFile(),
+                                                                   QString::fromLocal8Bit(std::strerror(errno))));
+        }
+        bytes_read += result_count;
+    }
+    result.resize(int(bytes_read));
+    return result;
+#else
+    return QtProxyDevice::_read(position, length);
+#endif
+}
+
+qulonglong FileDevice::_write(qulonglong position, const QByteArray &data) {
+    qulonglong bytes_written = QtProxyDevice::_write(position, data);
+    // data buffered by QFile is not visible to positional reads and to other file descriptors
+    QMutexLocker io_locker(&_ioMutex);
+    if (!std::dynamic_pointer_cast<QFile>(_qdevice)->flush()) {
+        throw DeviceError(QString("failed to write %1").arg(getUrl().toLocalFile()));
+    }
+    return bytes_written;
+}
+
+bool FileDevice::_mapFile() const {
+    /** Maps device data (only loaded range for range loads) into memory. If file cannot be mapped, device falls back
+     *  to reading data with QFile and false is returned. Should be called with _mapMutex locked.
+     **/
+
+    _ensureOpened();
+
+    qulonglong map_start = _loadOptions->rangeLoad ? _loadOptions->rangeStart : 0;
+    qulonglong map_length = _loadOptions->rangeLoad ? _loadOptions->rangeLength : _totalLength();
+    if (map_length && map_start <= qulonglong(LLONG_MAX) && map_length <= qulonglong(LLONG_MAX)) {
+#ifdef Q_OS_UNIX
+        // file is mapped directly instead of with QFile::map, because QFile unmaps all regions when it is closed
+        // and mapping should stay valid while views of its data are alive
+        qulonglong page_size = ::sysconf(_SC_PAGESIZE);
+        qulonglong aligned_start = map_start - map_start % page_size;
+        qulonglong aligned_length = map_length + (map_start - aligned_start);
+        if (aligned_length <= qulonglong(std::numeric_limits<size_t>::max())) {
+            void *address = ::mmap(nullptr, size_t(aligned_length), PROT_READ, MAP_SHARED,
+                                   std::dynamic_pointer_cast<QFile>(_qdevice)->handle(), off_t(aligned_start));
+            if (address != MAP_FAILED) {
+                _mapping = std::make_shared<FileMapping>(static_cast<const uchar*>(address) + (map_start - aligned_start),
+                                                         map_start, map_length, [address, aligned_length]() {
+                    ::munmap(address, size_t(aligned_length));
+                });
+            }
+        }
+#else
+        auto file = std::dynamic_pointer_cast<QFile>(_qdevice);
+        uchar *map_data = file->map(qint64(map_start), qint64(map_length));
+        if (map_data) {
+            std::weak_ptr<QFile> weak_file = file;
+            _mapping = std::make_shared<FileMapping>(map_data, map_start, map_length, [weak_file, map_data]() {
+                auto file = weak_file.lock();
+                if (file) {
+                    file->unmap(map_data);
+                }
+            });
+        }
+#endif
+    }
+
+    _mapped = bool(_mapping);
+    return _mapped;
+}
+
+void FileDevice::_unmapFile() {
+    /** Releases device reference to mapping, but device still remains in mapped mode: file will be mapped again
+     *  on next read. Region stays mapped until views of its data are released.
+     **/
+
+    QMutexLocker map_locker(&_mapMutex);
+    _mapping.reset();
+}
+
+void FileDevice::_onFileAboutToClose() {
+    _unmapFile();
+}
+
 void FileDevice::_resize(qulonglong new_size) {
+    _unmapFile();
     _ensureOpened();
     if (!std::dynamic_pointer_cast<QFile>(getQDevice())->resize(new_size)) {
         throw DeviceError(QString("failed to resize file %1 to size %2").arg(getUrl().toLocalFile(),
@@ -324,21 +741,210 @@ void FileDevice::_resize(qulonglong new_size) {
     }
 }
 
+static void syncFile(QFile *file) {
+    /** Flushes buffers and waits until file data is written to disk.
+     **/
+    file->flush();
+#ifdef Q_OS_UNIX
+    ::fsync(file->handle());
+#endif
+}
+
+
+#ifdef Q_OS_LINUX
+
+// maximal number of bytes copied by single copy_file_range or sendfile call
+const qulonglong KERNEL_COPY_BLOCK = 1024 * 1024 * 64; // 64 MB
+// size of buffer used to copy file data when kernel is unable to copy it
+const qulonglong PLAIN_COPY_BLOCK = 1024 * 1024; // 1 MB
+
+
+static bool copyDataRange(int source_fd, qulonglong source_offset, int dest_fd, qulonglong dest_offset,
+                          qulonglong length) {
+    /** Copies :length: bytes between files. Data is copied by kernel with copy_file_range (which shares extents
+     *  instead of copying data on file systems supporting reflinks) or with sendfile, and with pread/pwrite if
+     *  kernel is unable to copy it. Returns false on error, including source file ending before all data is
+     *  copied (errno is set to ENODATA in this case).
+     **/
+    qulonglong copied = 0;
+
+#ifdef SYS_copy_file_range
+    static std::atomic<bool> copy_file_range_available(true);
+    while (copied < length && copy_file_range_available) {
+        loff_t in_offset = source_offset + copied, out_offset = dest_offset + copied;
+        ssize_t result = ::syscall(SYS_copy_file_range, source_fd, &in_offset, dest_fd, &out_offset,
+                                   size_t(std::min(length - copied, KERNEL_COPY_BLOCK)), 0u);
+        if (result > 0) {
+            copied += result;
+        } else if (result == 0) {
+            errno = ENODATA;
+            return false;
+        } else if (errno != EINTR) {
+            if (errno == ENOSYS) {
+                copy_file_range_available = false;
+            } else if (errno != EXDEV && errno != EINVAL && errno != EOPNOTSUPP) {
+                return false;
+            }
+            break;
+        }
+    }
+#endif
+
+    // sendfile writes at current offset of output file
+    if (copied < length && ::lseek(dest_fd, dest_offset + copied, SEEK_SET) >= 0) {
+        while (copied < length) {
+            off_t in_offset = source_offset + copied;
+            ssize_t result = ::sendfile(dest_fd, source_fd, &in_offset,
+                                        size_t(std::min(length - copied, KERNEL_COPY_BLOCK)));
+            if (result > 0) {
+                copied += result;
+            } else if (result == 0) {
+                errno = ENODATA;
+                return false;
+            } else if (errno != EINTR) {
+                break;
+            }
+        }
+    }
+
+    if (copied < length) {
+        std::vector<char> buffer(std::min(length - copied, PLAIN_COPY_BLOCK));
+        while (copied < length) {
+            ssize_t read_count = ::pread(source_fd, buffer.data(), std::min(length - copied, qulonglong(buffer.size())),
+                                         source_offset + copied);
+            if (read_count == 0) {
+                errno = ENODATA;
+                return false;
+            } else if (read_count < 0) {
+                if (errno == EINTR) {
+                    continue;
+                }
+                return false;
+            }
+
+            ssize_t written = 0;
+            while (written < read_count) {
+                ssize_t result = ::pwrite(dest_fd, buffer.data() + written, read_count - written,
+                                          dest_offset + copied + written);
+                if (result < 0) {
+                    if (errno == EINTR) {
+                        continue;
+                    }
+                    return false;
+                }
+                written += result;
+            }
+            copied += read_count;
+        }
+    }
+    return true;
+}
+
+
+static bool copyFileData(int source_fd, qulonglong source_offset, int dest_fd, qulonglong dest_offset,
+                         qulonglong length) {
+    /** Copies :length: bytes between files skipping holes in source file, so sparse files stay sparse. Destination
+     *  range should be already filled with zeros. Returns false on error, including source file that is shorter
+     *  than copied range (errno is set to ENODATA in this case).
+     **/
+    struct stat source_stat;
+    if (::fstat(source_fd, &source_stat) != 0) {
+        return false;
+    } else if (qulonglong(source_stat.st_size) < source_offset + length) {
+        errno = ENODATA;
+        return false;
+    }
+
+    qulonglong source_end = source_offset + length, position = source_offset;
+    while (position < source_end) {
+        qulonglong data_start, data_end;
+        off_t seek_result = ::lseek(source_fd, position, SEEK_DATA);
+        if (seek_result >= 0) {
+            data_start = seek_result;
+            seek_result = ::lseek(source_fd, data_start, SEEK_HOLE);
+            data_end = seek_result >= 0 ? std::min(qulonglong(seek_result), source_end) : source_end;
+        } else if (errno == ENXIO) {
+            // there is no data till end of file
+            break;
+        } else {
+            // file system does not report holes
+            data_start = position;
+            data_end = source_end;
+        }
+
+        if (data_start >= source_end) {
+            break;
+        }
+
+        if (!copyDataRange(source_fd, data_start, dest_fd, dest_offset + (data_start - source_offset),
+                           data_end - data_start)) {
+            return false;
+        }
+        position = data_end;
+    }
+    return true;
+}
+
+#endif
+
+
 class FileSaver : public StandardSaver {
 public:
     FileSaver(const std::shared_ptr<Document> &document, const std::shared_ptr<AbstractDevice> &readDevice,
               const std::shared_ptr<FileDevice> &writeDevice)
-              : StandardSaver(document, readDevice, nullptr), _targetDevice(writeDevice), _tempDevice() {
+              : StandardSaver(document, readDevice, nullptr), _targetDevice(writeDevice), _tempDevice(),
+                _tempHandle(-1) {
         FileLoadOptions temp_file_options;
         temp_file_options.forceNew = true;
         _tempDevice = deviceFromFile(getTempFilename(writeDevice->getUrl().toLocalFile(), "mhs"), temp_file_options);
         _writeDevice = _tempDevice;
     }
 
+    ~FileSaver() {
+        _closeHandles();
+    }
+
+    bool isCancellable()const {
+        // target file is not touched until all data is written to temporary file
+        return true;
+    }
+
+    void putSpan(const std::shared_ptr<const AbstractSpan> &span) {
+        // temporary file is new and was resized to document length in begin(), so it is already filled with zeros
+        // and zero fills can be left as holes.
+        auto fill_span = std::dynamic_pointer_cast<const FillSpan>(span);
+        if (fill_span && fill_span->getFillByte() == 0) {
+            _position += span->getLength();
+            _reportProgress(_position);
+            return;
+        }
+
+#ifdef Q_OS_LINUX
+        auto device_span = std::dynamic_pointer_cast<const PrimitiveDeviceSpan>(span);
+        if (device_span && _copyDeviceSpan(device_span)) {
+            return;
+        }
+#endif
+
+        StandardSaver::putSpan(span);
+    }
+
+    void fail() {
+        // discard temporary file, target file stays unchanged
+        _closeHandles();
+        auto temp_file = std::dynamic_pointer_cast<QFile>(_tempDevice->getQDevice());
+        if (temp_file) {
+            temp_file->remove();
+        }
+    }
+
     void complete() {
         auto target_file = std::dynamic_pointer_cast<QFile>(_targetDevice->getQDevice());
         auto temp_file = std::dynamic_pointer_cast<QFile>(_tempDevice->getQDevice());
 
+        _closeHandles();
+        temp_file->flush();
+
         // remove target file
         target_file->remove();
 
@@ -348,41 +954,742 @@ public:
 
 private:
     std::shared_ptr<FileDevice> _targetDevice, _tempDevice;
+    QHash<QString, int> _sourceHandles;
+    int _tempHandle;
+
+#ifdef Q_OS_LINUX
+    bool _copyDeviceSpan(const std::shared_ptr<const PrimitiveDeviceSpan> &span) {
+        /** Copies data of span that refers to file without reading it into memory. Own descriptors are opened for
+         *  source and temporary files, so positions of QFile objects used by devices are not changed. Returns false
+         *  if span data cannot be copied this way and should be written as usual.
+         **/
+        auto file_device = std::dynamic_pointer_cast<const FileDevice>(span->getDevice());
+        if (!file_device) {
+            return false;
+        }
+
+        int source_handle = _sourceHandle(file_device->getUrl().toLocalFile());
+        int temp_handle = _temporaryHandle();
+        if (source_handle < 0 || temp_handle < 0) {
+            return false;
+        }
+
+        // data written through QFile objects should reach files before they are accessed with own descriptors
+        for (auto device : {file_device->getQDevice(), _tempDevice->getQDevice()}) {
+            auto file = std::dynamic_pointer_cast<QFile>(device);
+            if (file && file->isOpen() && !file->flush()) {
+                return false;
+            }
+        }
+
+        qulonglong source_start = file_device->getLoadOptions().rangeStart + span->getDeviceOffset();
+        qulonglong span_offset = 0;
+        while (span_offset < span->getLength()) {
+            qulonglong copy_length = std::min(span->getLength() - span_offset, MAXIMAL_WRITE_BLOCK);
+            if (!copyFileData(source_handle, source_start + span_offset, temp_handle, _position, copy_length)) {
+                throw DeviceError(QString("failed to write %1: %2").arg(_tempDevice->getUrl().toString(),
+                                                                        QString::fromLocal8Bit(strerror(errno))));
+            }
+            _position += copy_length;
+            span_offset += copy_length;
+            _reportProgress(_position);
+        }
+        return true;
+    }
+
+    int _sourceHandle(const QString &filename) {
+        if (!_sourceHandles.contains(filename)) {
+            _sourceHandles[filename] = ::open(QFile::encodeName(filename).constData(), O_RDONLY | O_CLOEXEC);
+        }
+        return _sourceHandles[filename];
+    }
+
+    int _temporaryHandle() {
+        if (_tempHandle < 0) {
+            _tempHandle = ::open(QFile::encodeName(_tempDevice->getUrl().toLocalFile()).constData(),
+                                 O_WRONLY | O_CLOEXEC);
+        }
+        return _tempHandle;
+    }
+#endif
+
+    void _closeHandles() {
+#ifdef Q_OS_LINUX
+        for (int handle : _sourceHandles) {
+            if (handle >= 0) {
+                ::close(handle);
+            }
+        }
+        if (_tempHandle >= 0) {
+            ::fsync(_tempHandle);
+            ::close(_tempHandle);
+        }
+#endif
+        _sourceHandles.clear();
+        _tempHandle = -1;
+    }
+};
+
+
+// maximal size of block of data moved inside file while it is saved in-place
+qulonglong IN_PLACE_MOVE_BLOCK = 1024 * 1024 * 4; // 4 MB
+
+
+class SpanCollector : public AbstractSaver {
+    /* Saver that writes nothing, but remembers spans passed to it together with their positions.
+     */
+public:
+    struct Entry {
+        qulonglong position;
+        std::shared_ptr<const AbstractSpan> span;
+    };
+
+    SpanCollector() : _position() { }
+
+    void begin() { }
+
+    void putSpan(const std::shared_ptr<const AbstractSpan> &span) {
+        _entries.append(Entry{_position, span});
+        _position += span->getLength();
+    }
+
+    const QList<Entry> &getEntries()const { return _entries; }
+
+private:
+    QList<Entry> _entries;
+    qulonglong _position;
+};
+
+
+class InPlaceSavePlan {
+    /* Describes how document can be saved into its own file without rewriting whole file. Data from file that
+     * stays in document, but at another position, is moved inside file (just like memmove does), and then data
+     * that is not stored in file is written over it. Plan can be built only if data from file keeps its order in
+     * document, which is true when document was modified by inserting, removing and overwriting data.
+     * Moves are ordered so each block of data is read before it is overwritten: data moved to the left is processed
+     * from the beginning of file, and data moved to the right - from the end.
+     */
+public:
+    struct Move {
+        qulonglong source, destination, length;
+
+        qulonglong blockCount(qulonglong block_size)const {
+            return (length + block_size - 1) / block_size;
+        }
+
+        void block(qulonglong block_index, qulonglong block_size, qulonglong *offset, qulonglong *block_length)const {
+            if (destination < source) {
+                *offset = block_index * block_size;
+            } else {
+                // blocks of data moved to the right are enumerated from the end
+                *offset = length - std::min(length, (block_index + 1) * block_size);
+            }
+            *block_length = std::min(block_size, length - block_index * block_size);
+        }
+    };
+
+    struct Patch {
+        qulonglong position;
+        std::shared_ptr<const AbstractSpan> span;
+    };
+
+    typedef std::function<QByteArray(qulonglong, qulonglong)> ReadFunction;
+    typedef std::function<void(qulonglong, const QByteArray &)> WriteFunction;
+    typedef std::function<void(int, qulonglong, const QByteArray &)> BlockFunction;
+
+    InPlaceSavePlan() : oldLength(), newLength() { }
+
+    static std::shared_ptr<InPlaceSavePlan> build(const std::shared_ptr<Document> &document,
+                                                  const std::shared_ptr<const AbstractDevice> &device) {
+        /** Returns plan for saving :document: to :device: it was loaded from, or nullptr if there is no such plan.
+         **/
+        auto collector = std::make_shared<SpanCollector>();
+        document->putSpans(collector);
+
+        auto plan = std::make_shared<InPlaceSavePlan>();
+        plan->oldLength = device->getLength();
+        plan->newLength = document->getLength();
+
+        QList<Move> left_moves, right_moves;
+        qulonglong source_end = 0;
+        for (const SpanCollector::Entry &entry : collector->getEntries()) {
+            qulonglong length = entry.span->getLength();
+            auto device_span = std::dynamic_pointer_cast<const PrimitiveDeviceSpan>(entry.span);
+            if (device_span && device_span->getDevice() == device) {
+                qulonglong source = device_span->getDeviceOffset();
+                if (source < source_end) {
+                    // data from file is reordered or duplicated
+                    return nullptr;
+                }
+                source_end = source + length;
+
+                if (source != entry.position) {
+                    QList<Move> &moves = entry.position < source ? left_moves : right_moves;
+                    if (!moves.isEmpty() && moves.last().source + moves.last().length == source &&
+                            moves.last().destination + moves.last().length == entry.position) {
+                        moves.last().length += length;
+                    } else {
+                        moves.append(Move{source, entry.position, length});
+                    }
+                }
+            } else {
+                plan->patches.append(Patch{entry.position, entry.span});
+            }
+        }
+
+        plan->moves = left_moves;
+        for (int j = right_moves.length() - 1; j >= 0; --j) {
+            plan->moves.append(right_moves[j]);
+        }
+        return plan;
+    }
+
+    qulonglong getMovedLength()const {
+        qulonglong result = 0;
+        for (const Move &move : moves) {
+            result += move.length;
+        }
+        return result;
+    }
+
+    qulonglong getPatchedLength()const {
+        qulonglong result = 0;
+        for (const Patch &patch : patches) {
+            result += patch.span->getLength();
+        }
+        return result;
+    }
+
+    qulonglong getCost()const {
+        // estimated number of bytes written: each moved or patched byte is written to journal and to file
+        return (getMovedLength() + getPatchedLength()) * 2;
+    }
+
+    void executeMoves(int first_move, qulonglong first_block, qulonglong block_size, const ReadFunction &read,
+                      const WriteFunction &write, const BlockFunction &before_write)const {
+        /** Moves data starting from given block. :before_write: is called for each block after it is read, but
+         *  before it is written to its new position.
+         **/
+        for (int move_index = first_move; move_index < moves.length(); ++move_index) {
+            const Move &move = moves[move_index];
+            qulonglong block_count = move.blockCount(block_size);
+            for (qulonglong block_index = move_index == first_move ? first_block : 0; block_index < block_count;
+                 ++block_index) {
+                qulonglong offset, length;
+                move.block(block_index, block_size, &offset, &length);
+                QByteArray data = read(move.source + offset, length);
+                if (qulonglong(data.length()) != length) {
+                    throw DeviceError("failed to read data while saving file in-place");
+                }
+                before_write(move_index, block_index, data);
+                write(move.destination + offset, data);
+            }
+        }
+    }
+
+    qulonglong oldLength, newLength;
+    QList<Move> moves;
+    QList<Patch> patches;
 };
 
 
+static const quint32 JOURNAL_MAGIC = 0x4d484a31, JOURNAL_BLOCK = 0x424c4f4b, JOURNAL_COMMIT = 0x434f4d54;
+
+
+class InPlaceSaveJournal {
+    /* Journal allows completing in-place save interrupted by crash. Before file is changed, journal stores save
+     * plan together with all data that should be written over file data. Each block of data that is moved inside
+     * file is appended to journal before it is written, so it can be written again even if its source was already
+     * overwritten. Journal is removed after save is completed. If file has journal left from interrupted save,
+     * InPlaceSaveJournal::recover completes this save before file is loaded.
+     */
+public:
+    typedef std::function<void(qulonglong)> ResizeFunction;
+
+    InPlaceSaveJournal(const QString &filename) : _filename(filename), _file(journalFilename(filename)),
+            _stream(&_file), _rangeStart(), _blockSize(), _lastMove(-1), _lastBlock(), _lastBlockOffset() {
+
+    }
+
+    static QString journalFilename(const QString &filename) {
+        return filename + ".mhj";
+    }
+
+    qulonglong getRangeStart()const { return _rangeStart; }
+
+    void create(const InPlaceSavePlan &plan, qulonglong range_start, qulonglong block_size) {
+        if (_file.exists()) {
+            // journal of another save is not replayed yet, and it is the only way to restore file data
+            throw DeviceError(QString("file %1 has incomplete save and should be reopened before saving")
+                              .arg(_filename));
+        }
+        if (!_file.open(QIODevice::WriteOnly | QIODevice::Truncate)) {
+            throw DeviceError(QString("failed to create journal file %1").arg(_file.fileName()));
+        }
+
+        try {
+            _stream << JOURNAL_MAGIC << quint64(range_start) << quint64(block_size) << quint64(plan.oldLength)
+                    << quint64(plan.newLength);
+
+            _stream << quint32(plan.moves.length());
+            for (const InPlaceSavePlan::Move &move : plan.moves) {
+                _stream << quint64(move.source) << quint64(move.destination) << quint64(move.length);
+            }
+
+            _stream << quint32(plan.patches.length());
+            for (const InPlaceSavePlan::Patch &patch : plan.patches) {
+                qulonglong length = patch.span->getLength();
+                _stream << quint64(patch.position) << quint64(length);
+                for (qulonglong offset = 0; offset < length; offset += MAXIMAL_WRITE_BLOCK) {
+                    QByteArray data = patch.span->read(offset, std::min(length - offset, MAXIMAL_WRITE_BLOCK));
+                    _stream.writeRawData(data.constData(), data.length());
+                }
+            }
+
+            _commit();
+        } catch (...) {
+            // journal that is not committed is useless
+            remove();
+            throw;
+        }
+    }
+
+    void appendBlock(int move_index, qulonglong block_index, const QByteArray &data) {
+        _stream << JOURNAL_BLOCK << quint32(move_index) << quint64(block_index);
+        _stream.writeRawData(data.constData(), data.length());
+        _commit();
+    }
+
+    bool load();
+    void replay(const InPlaceSavePlan::ReadFunction &read, const InPlaceSavePlan::WriteFunction &write,
+                const ResizeFunction &resize);
+
+    void close() {
+        _file.close();
+        _stream.resetStatus();
+    }
+
+    void remove() {
+        _file.close();
+        _file.remove();
+    }
+
+    static void recover(const QString &filename, bool read_only);
+
+private:
+    QString _filename;
+    QFile _file;
+    QDataStream _stream;
+    qulonglong _rangeStart, _blockSize;
+    InPlaceSavePlan _plan;
+    QList<QPair<qulonglong, qint64>> _patchOffsets; // position in file and offset of data in journal
+    QList<qulonglong> _patchLengths;
+    int _lastMove; // last block that was completely stored in journal, -1 if there is no such block
+    qulonglong _lastBlock;
+    qint64 _lastBlockOffset;
+
+    void _commit() {
+        _stream << JOURNAL_COMMIT;
+        if (_stream.status() != QDataStream::Ok) {
+            throw DeviceError(QString("failed to write journal file %1").arg(_file.fileName()));
+        }
+        syncFile(&_file);
+    }
+};
+
+
+class InPlaceSaveLock {
+    /* Lock file next to journal that is held while journal is written or replayed, so journal of save that is still
+     * in progress (in this or another process) is never replayed. File is locked with flock, so lock of crashed
+     * process is released by system and its journal can be recovered. Where flock is not available, QLockFile is
+     * used if Qt provides it.
+     */
+public:
+    InPlaceSaveLock(const QString &filename) : _filename(InPlaceSaveJournal::journalFilename(filename) + ".lock"),
+            _fd(-1) {
+
+    }
+
+    ~InPlaceSaveLock() {
+        unlock();
+    }
+
+    bool tryLock() {
+#ifdef Q_OS_UNIX
+        QByteArray encoded_filename = QFile::encodeName(_filename);
+        while (_fd < 0) {
+            int fd = ::open(encoded_filename.constData(), O_RDWR | O_CREAT, 0644);
+            if (fd < 0) {
+                throw DeviceError(QString("failed to create lock file %1").arg(_filename));
+            } else if (::flock(fd, LOCK_EX | LOCK_NB) != 0) {
+                ::close(fd);
+                return false;
+            }
+
+            // previous owner removes lock file before releasing lock, so file we have locked can be already removed
+            struct stat fd_stat, file_stat;
+            if (::fstat(fd, &fd_stat) == 0 && ::stat(encoded_filename.constData(), &file_stat) == 0 &&
+                    fd_stat.st_dev == file_stat.st_dev && fd_stat.st_ino == file_stat.st_ino) {
+                _fd = fd;
+            } else {
+                ::close(fd);
+            }
+        }
+        return true;
+#elif QT_VERSION >= 0x050100
+        if (!_lockFile) {
+            _lockFile.reset(new QLockFile(_filename));
+        }
+        return _lockFile->tryLock(0);
+#else
+        return true;
+#endif
+    }
+
+    void unlock() {
+#ifdef Q_OS_UNIX
+        if (_fd >= 0) {
+            ::unlink(QFile::encodeName(_filename).constData());
+            ::close(_fd);
+            _fd = -1;
+        }
+#elif QT_VERSION >= 0x050100
+        _lockFile.reset();
+#endif
+    }
+
+private:
+    QString _filename;
+    int _fd;
+#if !defined(Q_OS_UNIX) && QT_VERSION >= 0x050100
+    std::unique_ptr<QLockFile> _lockFile;
+#endif
+};
+
+
+bool InPlaceSaveJournal::load() {
+    /** Reads journal left by interrupted save. Returns false if there is no journal or if save was interrupted
+     *  before file was changed (such journal is removed).
+     **/
+    if (!_file.exists()) {
+        return false;
+    }
+
+    if (!_file.open(QIODevice::ReadWrite)) {
+        throw DeviceError(QString("failed to complete interrupted save of %1: cannot open journal").arg(_filename));
+    }
+
+    quint32 magic, commit, count;
+    quint64 range_start, block_size, old_length, new_length;
+
+    _stream >> magic >> range_start >> block_size >> old_length >> new_length >> count;
+    _rangeStart = range_start;
+    _blockSize = block_size;
+    _plan.oldLength = old_length;
+    _plan.newLength = new_length;
+    for (quint32 j = 0; j < count && _stream.status() == QDataStream::Ok; ++j) {
+        quint64 source, destination, length;
+        _stream >> source >> destination >> length;
+        _plan.moves.append(InPlaceSavePlan::Move{source, destination, length});
+    }
+    _stream >> count;
+    for (quint32 j = 0; j < count && _stream.status() == QDataStream::Ok; ++j) {
+        quint64 position, length;
+        _stream >> position >> length;
+        _patchOffsets.append(qMakePair(qulonglong(position), _file.pos()));
+        _patchLengths.append(length);
+        if (!_file.seek(_file.pos() + qint64(length))) {
+            break;
+        }
+    }
+    _stream >> commit;
+
+    if (_stream.status() != QDataStream::Ok || magic != JOURNAL_MAGIC || commit != JOURNAL_COMMIT || !block_size) {
+        // save was interrupted before file was changed
+        remove();
+        return false;
+    }
+
+    // find last block that was completely stored in journal before it was written to file
+    qint64 valid_end = _file.pos();
+    while (true) {
+        quint32 marker, move_index;
+        quint64 block_index;
+        _stream >> marker >> move_index >> block_index;
+        if (_stream.status() != QDataStream::Ok || marker != JOURNAL_BLOCK || move_index >= quint32(_plan.moves.length())
+                || block_index >= _plan.moves[move_index].blockCount(_blockSize)) {
+            break;
+        }
+
+        qulonglong offset, length;
+        _plan.moves[move_index].block(block_index, _blockSize, &offset, &length);
+        qint64 data_offset = _file.pos();
+        if (!_file.seek(data_offset + qint64(length))) {
+            break;
+        }
+        _stream >> commit;
+        if (_stream.status() != QDataStream::Ok || commit != JOURNAL_COMMIT) {
+            break;
+        }
+
+        _lastMove = move_index;
+        _lastBlock = block_index;
+        _lastBlockOffset = data_offset;
+        valid_end = _file.pos();
+    }
+
+    // blocks moved while replaying are journaled too, so replay can be interrupted as well
+    _file.resize(valid_end);
+    _file.seek(valid_end);
+    _stream.resetStatus();
+    return true;
+}
+
+void InPlaceSaveJournal::replay(const InPlaceSavePlan::ReadFunction &read, const InPlaceSavePlan::WriteFunction &write,
+                                const ResizeFunction &resize) {
+    /** Completes save described by loaded journal. Functions get positions relative to start of saved range.
+     **/
+    if (_plan.newLength > _plan.oldLength) {
+        resize(_plan.newLength);
+    }
+
+    int first_move = 0;
+    qulonglong first_block = 0;
+    if (_lastMove >= 0) {
+        // last journaled block could be written partially, write it again
+        qulonglong offset, length;
+        _plan.moves[_lastMove].block(_lastBlock, _blockSize, &offset, &length);
+        qint64 valid_end = _file.pos();
+        _file.seek(_lastBlockOffset);
+        write(_plan.moves[_lastMove].destination + offset, _file.read(length));
+        _file.seek(valid_end);
+        first_move = _lastMove;
+        first_block = _lastBlock + 1;
+    }
+
+    _plan.executeMoves(first_move, first_block, _blockSize, read, write,
+                       [this](int move_index, qulonglong block_index, const QByteArray &data) {
+        appendBlock(move_index, block_index, data);
+    });
+
+    for (int j = 0; j < _patchOffsets.length(); ++j) {
+        for (qulonglong offset = 0; offset < _patchLengths[j]; offset += MAXIMAL_WRITE_BLOCK) {
+            _file.seek(_patchOffsets[j].second + offset);
+            write(_patchOffsets[j].first + offset,
+                  _file.read(std::min(_patchLengths[j] - offset, MAXIMAL_WRITE_BLOCK)));
+        }
+    }
+
+    if (_plan.newLength < _plan.oldLength) {
+        resize(_plan.newLength);
+    }
+}
+
+void InPlaceSaveJournal::recover(const QString &filename, bool read_only) {
+    /** Completes in-place save of :filename: that was interrupted by crash, if file has journal of it. Until save
+     *  is completed, file data is inconsistent, so DeviceError is thrown if journal cannot be replayed now: when
+     *  file is opened for reading only or save is still in progress.
+     **/
+    if (!QFileInfo(journalFilename(filename)).exists()) {
+        return;
+    }
+
+    InPlaceSaveLock lock(filename);
+    if (!lock.tryLock()) {
+        throw DeviceError(QString("file %1 is being saved").arg(filename));
+    }
+
+    InPlaceSaveJournal journal(filename);
+    if (!journal.load()) {
+        return;
+    } else if (read_only) {
+        throw DeviceError(QString("file %1 has incomplete save that can be completed only when file is opened "
+                                  "for writing").arg(filename));
+    }
+
+    QFile target(filename);
+    if (!target.open(QIODevice::ReadWrite)) {
+        throw DeviceError(QString("failed to complete interrupted save of %1: cannot open file for writing")
+                          .arg(filename));
+    }
+
+    qulonglong range_start = journal.getRangeStart();
+    journal.replay([&](qulonglong position, qulonglong length) -> QByteArray {
+        if (!target.seek(range_start + position)) {
+            return QByteArray();
+        }
+        return target.read(length);
+    }, [&](qulonglong position, const QByteArray &data) {
+        if (!target.seek(range_start + position) || target.write(data) != data.length()) {
+            throw DeviceError(QString("failed to complete interrupted save of %1: write error").arg(filename));
+        }
+    }, [&](qulonglong length) {
+        target.resize(range_start + length);
+    });
+
+    syncFile(&target);
+    journal.remove();
+}
+
+
 class QuickFileSaver : public StandardSaver {
+    /* Saves document into its own file in-place according to InPlaceSavePlan, so only changed data is written.
+     * Data that should be shifted is moved inside file by blocks of IN_PLACE_MOVE_BLOCK bytes. Plan and moved
+     * blocks are journaled first, so save interrupted by crash is completed next time file is loaded.
+     */
 public:
     QuickFileSaver(const std::shared_ptr<Document> &document, const std::shared_ptr<AbstractDevice> &readDevice,
-                   const std::shared_ptr<FileDevice> &writeDevice)
-        : StandardSaver(document, readDevice, writeDevice) {
+                   const std::shared_ptr<FileDevice> &writeDevice, const std::shared_ptr<InPlaceSavePlan> &plan)
+        : StandardSaver(document, readDevice, writeDevice), _fileDevice(writeDevice), _plan(plan),
+          _fileChanged(false), _recovered(false), _processedLength(),
+          _totalLength(plan->getMovedLength() + plan->getPatchedLength()) {
+
+    }
 
+    bool needsExclusiveAccess()const {
+        // document reads moved data from old positions until save is completed
+        return !_plan->moves.isEmpty();
     }
 
     void begin() {
-        // no need to clear device before saving, but resize file to document size
-        _writeDevice->resize(_document->getLength());
+        QString filename = _fileDevice->getUrl().toLocalFile();
+        _lock.reset(new InPlaceSaveLock(filename));
+        if (!_lock->tryLock()) {
+            throw DeviceError(QString("file %1 is being saved").arg(filename));
+        }
+
+        // journal is not owned until it is created, so journal of another save is never removed on fail
+        std::unique_ptr<InPlaceSaveJournal> journal(new InPlaceSaveJournal(filename));
+        journal->create(*_plan, _fileDevice->getLoadOptions().rangeStart, IN_PLACE_MOVE_BLOCK);
+        _journal = std::move(journal);
+
+        if (_plan->newLength > _plan->oldLength) {
+            _fileChanged = true;
+            _writeDevice->resize(_plan->newLength);
+        }
+
+        QElapsedTimer move_timer;
+        move_timer.start();
+        _plan->executeMoves(0, 0, IN_PLACE_MOVE_BLOCK, [this](qulonglong position, qulonglong length) {
+            return _readData(position, length);
+        }, [this](qulonglong position, const QByteArray &data) {
+            _writeData(position, data);
+        }, [this](int move_index, qulonglong block_index, const QByteArray &data) {
+            _journal->appendBlock(move_index, block_index, data);
+            _addProgress(data.length());
+        });
+
+        qulonglong moved_length = _plan->getMovedLength();
+        if (moved_length >= IN_PLACE_MOVE_BLOCK) {
+            // small moves take too little time to measure speed
+            _fileDevice->_inPlaceMoveSpeed = moved_length * 1000 / qulonglong(std::max(qint64(1), move_timer.elapsed()));
+        }
     }
 
-    void putSpan(const std::shared_ptr<AbstractSpan> &span) {
+    void putSpan(const std::shared_ptr<const AbstractSpan> &span) {
+        // data from this file is already at its place
         auto device_span = std::dynamic_pointer_cast<const PrimitiveDeviceSpan>(span);
-        if (device_span) {
-            _position += span->getLength();
-        } else {
-            StandardSaver::putSpan(span);
+        if (!device_span || device_span->getDevice() != _writeDevice) {
+            for (qulonglong offset = 0; offset < span->getLength(); offset += MAXIMAL_WRITE_BLOCK) {
+                QByteArray data = span->read(offset, std::min(span->getLength() - offset, MAXIMAL_WRITE_BLOCK));
+                _writeData(_position + offset, data);
+                _addProgress(data.length());
+            }
+        }
+        _position += span->getLength();
+    }
+
+    void complete() {
+        if (_plan->newLength < _plan->oldLength) {
+            _writeDevice->resize(_plan->newLength);
         }
+        syncFile(std::dynamic_pointer_cast<QFile>(_fileDevice->getQDevice()).get());
+        _journal->remove();
+        _lock.reset();
+    }
+
+    void fail() {
+        if (_journal && _fileChanged) {
+            // spans of document refer to positions data had before it was moved, so document cannot be used with
+            // partially saved file. Save is completed from journal immediately; if it fails again, journal is kept
+            // for next load, and file cannot be saved until it is reopened.
+            try {
+                _journal->close();
+                if (!_journal->load()) {
+                    throw DeviceError(QString("failed to read journal of %1").arg(_fileDevice->getUrl().toString()));
+                }
+                _journal->replay([this](qulonglong position, qulonglong length) {
+                    return _readData(position, length);
+                }, [this](qulonglong position, const QByteArray &data) {
+                    _writeData(position, data);
+                }, [this](qulonglong length) {
+                    _writeDevice->resize(length);
+                });
+                syncFile(std::dynamic_pointer_cast<QFile>(_fileDevice->getQDevice()).get());
+                _journal->remove();
+                _recovered = true;
+            } catch (const std::exception &err) {
+                qWarning() << "failed to complete in-place save from journal:" << err.what();
+                _fileDevice->_saveInterrupted = true;
+            }
+        } else if (_journal) {
+            _journal->remove();
+        }
+        _lock.reset();
+    }
+
+    bool isRecovered()const {
+        return _recovered;
+    }
+
+private:
+    std::shared_ptr<FileDevice> _fileDevice;
+    std::shared_ptr<InPlaceSavePlan> _plan;
+    std::unique_ptr<InPlaceSaveLock> _lock;
+    std::unique_ptr<InPlaceSaveJournal> _journal;
+    bool _fileChanged, _recovered;
+    qulonglong _processedLength, _totalLength;
+
+    QByteArray _readData(qulonglong position, qulonglong length) {
+        return detachedData(_writeDevice->read(position, length));
+    }
+
+    void _writeData(qulonglong position, const QByteArray &data) {
+        _fileChanged = true;
+        if (_writeDevice->write(position, data) != qulonglong(data.length())) {
+            throw DeviceError(QString("failed to write %1: not all data was written").arg(_writeDevice->getUrl().toString()));
+        }
+    }
+
+    void _addProgress(qulonglong length) {
+        _processedLength += length;
+        _reportProgress(_totalLength ? qulonglong(_document->getLength() * double(_processedLength) / _totalLength) : 0);
     }
 };
 
 std::shared_ptr<AbstractSaver> FileDevice::createSaver(const std::shared_ptr<Document> &document,
                                                        const std::shared_ptr<AbstractDevice> &read_device) {
-    if (read_device.get() == this && document->checkCanQuickSave()) {
-        return std::make_shared<QuickFileSaver>(document, read_device,
-                                                std::dynamic_pointer_cast<FileDevice>(shared_from_this()));
-    } else {
-        return std::make_shared<FileSaver>(document, read_device,
-                                           std::dynamic_pointer_cast<FileDevice>(shared_from_this()));
+    if (_saveInterrupted) {
+        // file data does not match spans referring to it until journal is replayed on next load
+        throw DeviceError(QString("file %1 was saved partially and should be reopened before saving")
+                          .arg(getUrl().toString()));
+    }
+
+    if (read_device.get() == this) {
+        auto plan = InPlaceSavePlan::build(document, shared_from_this());
+        // saving in-place is preferred if it writes less data than rewriting whole file. Document cannot be read
+        // while data is moved inside file, so moving too much data is not allowed, either by total length or by
+        // time it is expected to take. Range of file cannot be saved by rewriting file at all.
+        if (plan && (getLoadOptions().rangeLoad || (plan->getCost() <= document->getLength() &&
+                     plan->getMovedLength() <= MAXIMAL_IN_PLACE_MOVE &&
+                     plan->getMovedLength() * 1000 / _inPlaceMoveSpeed <= MAXIMAL_IN_PLACE_MOVE_TIME))) {
+            return std::make_shared<QuickFileSaver>(document, read_device,
+                                                    std::dynamic_pointer_cast<FileDevice>(shared_from_this()),
+                                                    plan);
+        }
     }
+    return std::make_shared<FileSaver>(document, read_device,
+                                       std::dynamic_pointer_cast<FileDevice>(shared_from_this()));
 }
 
 const FileLoadOptions &FileDevice::getFileLoadOptions() const {
@@ -412,6 +1719,7 @@ void LoadOptions::copyBaseFrom(const LoadOptions &options) {
     readOnly = options.readOnly;
     rangeLoad = options.rangeLoad;
     memoryLoad = options.memoryLoad;
+    freezeSize = options.freezeSize;
     rangeStart = options.rangeStart;
     rangeLength = options.rangeLength;
 }
@@ -451,6 +1759,7 @@ std::shared_ptr<AbstractDevice> deviceFromUrl(const QUrl &url, const LoadOptions
         auto given_file_options = dynamic_cast<const FileLoadOptions*>(&options);
         if (given_file_options) {
             file_options->forceNew = given_file_options->forceNew;
+            file_options->temporary = given_file_options->temporary;
         } else {
             qWarning() << "'options' argument for deviceFromUrl function should be of FileLoadOptions class";
         }
@@ -464,6 +1773,9 @@ std::shared_ptr<AbstractDevice> deviceFromUrl(const QUrl &url, const LoadOptions
             throw DeviceError(QString("file %1 does not exist").arg(local_file_path));
         }
 
+        // complete in-place save that was interrupted by crash before file data is loaded
+        InPlaceSaveJournal::recover(local_file_path, file_options->readOnly);
+
         device = std::shared_ptr<FileDevice>(new FileDevice(local_file_path, file_options.release()));
     } else if (url.scheme().toLower() == "microdata") {
         std::unique_ptr<BufferLoadOptions> buffer_options(new BufferLoadOptions());
@@ -494,11 +1806,20 @@ std::shared_ptr<AbstractDevice> deviceFromUrl(const QUrl &url, const LoadOptions
         throw DeviceError(QString("unknown scheme for device URL: %1").arg(url.toString()));
     }
 
+    auto file_device = std::dynamic_pointer_cast<FileDevice>(device);
+    if (file_device && !file_device->getLoadOptions().memoryLoad && (file_device->getLoadOptions().readOnly ||
+                                                                     file_device->getLoadOptions().freezeSize)) {
+        // size of device data cannot be changed, so it can be read through memory mapping. If mapping fails,
+        // device silently falls back to reading data with QFile.
+        QMutexLocker map_locker(&file_device->_mapMutex);
+        file_device->_mapFile();
+    }
+
     if (device && device->getLoadOptions().memoryLoad) {
         // note that even memory-loaded device will re-read its data from underlying device after cache
         // is invalidated (for example, after writing some data)
         device->setCacheSize(device->getLength());
-        device->_encache(0, false);
+        device->_encache(0, device->getLength());
     }
 
     QMutexLocker locker(&_allDevicesMutex);
@@ -513,6 +1834,14 @@ std::shared_ptr<BufferDevice> deviceFromData(const QByteArray &data, const Buffe
     return std::dynamic_pointer_cast<BufferDevice>(deviceFromUrl(QUrl("microdata://"), buffer_load_options));
 }
 
+QByteArray detachedData(QByteArray data) {
+    /** Returns data that does not share memory with anything else. Data read from mapped devices refers to mapped
+     *  memory, and should be detached before it is stored somewhere for a long time.
+     **/
+    data.detach();
+    return data;
+}
+
 std::shared_ptr<FileDevice> deviceFromFile(const QString &filename, const FileLoadOptions &options) {
     return std::dynamic_pointer_cast<FileDevice>(deviceFromUrl(QUrl::fromLocalFile(filename), options));
 }
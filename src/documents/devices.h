@@ -9,6 +9,9 @@
 #include <QList>
 #include <QIODevice>
 #include <QFile>
+#include <QHash>
+#include <QMutex>
+#include <list>
 #include "readwritelock.h"
 #include "base.h"
 
@@ -18,6 +21,7 @@ class PrimitiveDeviceSpan;
 class DeviceSpan;
 class AbstractSaver;
 class AbstractSpan;
+class FileMapping;
 
 
 class OutOfBoundsError : public BaseException {
@@ -60,11 +64,12 @@ public:
 
 class FileLoadOptions : public LoadOptions {
 public:
-    FileLoadOptions() : LoadOptions(), forceNew(false) {
+    FileLoadOptions() : LoadOptions(), forceNew(false), temporary(false) {
 
     }
 
     bool forceNew;
+    bool temporary; // file is removed when device is destroyed
 };
 
 
@@ -76,6 +81,17 @@ public:
 };
 
 
+class CacheStats {
+public:
+    CacheStats() : hits(), misses(), cachedPages(), cachedBytes() {
+
+    }
+
+    qulonglong hits, misses; // number of page lookups that were served from cache and number of page loads
+    qulonglong cachedPages, cachedBytes;
+};
+
+
 class AbstractDevice : public QObject, public std::enable_shared_from_this<AbstractDevice> {
     Q_OBJECT
     friend class PrimitiveDeviceSpan;
@@ -91,9 +107,12 @@ public:
     virtual bool isReadOnly()const;
     const LoadOptions &getLoadOptions()const { return *_loadOptions; }
     virtual bool isSharedResource()const = 0;
+    virtual bool isMapped()const { return false; }
 
     QByteArray read(qulonglong position, qulonglong length)const;
     QByteArray readAll()const;
+    qulonglong readInto(qulonglong position, char *buffer, qulonglong length, bool use_cache=true)const;
+    DataView view(qulonglong position, qulonglong length)const;
     qulonglong write(qulonglong position, const QByteArray &data);
     virtual void resize(qulonglong new_size);
     virtual std::shared_ptr<AbstractSaver> createSaver(const std::shared_ptr<Document> &editor,
@@ -101,6 +120,10 @@ public:
 
     qulonglong getCacheSize()const { return _cacheSize; }
     void setCacheSize(qulonglong size);
+    qulonglong getPageSize()const { return _pageSize; }
+    void setPageSize(qulonglong size);
+    CacheStats getCacheStats()const;
+    void resetCacheStats();
 
     QList<std::shared_ptr<PrimitiveDeviceSpan>> getSpans()const;
     std::shared_ptr<PrimitiveDeviceSpan> createSpan(qulonglong position, qulonglong length);
@@ -115,18 +138,31 @@ protected:
     virtual qulonglong _write(qulonglong position, const QByteArray &data) = 0;
     virtual qulonglong _totalLength()const = 0;
     virtual void _resize(qulonglong) = 0;
+    virtual DataView _mappedView(qulonglong, qulonglong)const { return DataView(); }
     void _removeSpan(PrimitiveDeviceSpan *span);
 
-    void _encache(qulonglong, bool)const;
+    void _encache(qulonglong position, qulonglong length)const;
 
     std::unique_ptr<LoadOptions> _loadOptions;
 
 private:
+    struct CachePage {
+        QByteArray data;
+        std::list<qulonglong>::iterator lruPosition;
+    };
+
+    bool _bypassesCache(qulonglong length)const;
+    QByteArray _cachedPage(qulonglong page_index, qulonglong page_size)const;
+    void _evictPages(qulonglong keep_page_index)const;
+    void _dropPages(qulonglong first_page_index, qulonglong last_page_index);
+
     QUrl _url;
-    mutable QByteArray _cache;
-    mutable qulonglong _cacheStart;
+    mutable QMutex _cacheMutex;
+    mutable QHash<qulonglong, CachePage> _cachePages;
+    mutable std::list<qulonglong> _cacheLru; // indexes of cached pages, most recently used first
+    mutable CacheStats _cacheStats;
     qulonglong _cacheSize;
-    qulonglong _cacheBoundary;
+    qulonglong _pageSize;
     mutable QList<PrimitiveDeviceSpan*> _spans;
     std::shared_ptr<ReadWriteLock> _lock;
 };
@@ -140,7 +176,10 @@ public:
     virtual void begin() = 0;
     virtual void putSpan(const std::shared_ptr<const AbstractSpan> &span) = 0;
     virtual void fail() { }
+    virtual bool isRecovered()const { return false; } // true if failed save was still completed by fail()
     virtual void complete() { }
+    virtual bool isCancellable()const { return false; }
+    virtual bool needsExclusiveAccess()const { return false; }
 };
 
 
@@ -152,6 +191,8 @@ public:
     void putSpan(const std::shared_ptr<const AbstractSpan> &span);
 
 protected:
+    void _reportProgress(qulonglong saved_length);
+
     qulonglong _position;
     std::shared_ptr<AbstractDevice> _readDevice, _writeDevice;
     std::shared_ptr<Document> _document;
@@ -169,6 +210,7 @@ private slots:
 protected:
     std::shared_ptr<QIODevice> _qdevice;
     mutable bool _deviceClosed;
+    mutable QMutex _ioMutex; // guards device position and opening, as several readers can use device at once
 
     QtProxyDevice(const QUrl &url, LoadOptions *options);
     void _ensureOpened()const;
@@ -182,17 +224,39 @@ protected:
 class FileDevice : public QtProxyDevice {
     Q_OBJECT
     friend std::shared_ptr<AbstractDevice> deviceFromUrl(const QUrl &url, const LoadOptions &options=LoadOptions());
+    friend class QuickFileSaver;
 public:
+    ~FileDevice();
+
     bool isFixedSize() const;
     std::shared_ptr<AbstractSaver> createSaver(const std::shared_ptr<Document> &editor,
                                                const std::shared_ptr<AbstractDevice> &read_device);
     const FileLoadOptions &getFileLoadOptions()const;
     bool isSharedResource()const { return true; }
+    bool isMapped()const { return _mapped; }
+
+private slots:
+    void _onFileAboutToClose();
 
 protected:
     FileDevice(const QString &filename, FileLoadOptions *options);
 
+    QByteArray _read(qulonglong position, qulonglong length)const;
+    qulonglong _write(qulonglong position, const QByteArray &data);
     void _resize(qulonglong new_size);
+    DataView _mappedView(qulonglong position, qulonglong length)const;
+
+private:
+    QByteArray _readFile(qulonglong position, qulonglong length)const;
+    std::shared_ptr<FileMapping> _currentMapping()const;
+    bool _mapFile()const;
+    void _unmapFile();
+
+    bool _saveInterrupted; // in-place save failed after file was changed, file should be reopened to complete it
+    qulonglong _inPlaceMoveSpeed; // bytes per second moved inside file by last in-place save
+    mutable QMutex _mapMutex;
+    mutable bool _mapped; // true if device data is read from memory mapped file
+    mutable std::shared_ptr<FileMapping> _mapping;
 };
 
 
@@ -214,6 +278,8 @@ protected:
 std::shared_ptr<AbstractDevice> deviceFromUrl(const QUrl &url, const LoadOptions &options);
 std::shared_ptr<FileDevice> deviceFromFile(const QString &file, const FileLoadOptions &options=FileLoadOptions());
 std::shared_ptr<BufferDevice> deviceFromData(const QByteArray &data, const BufferLoadOptions &options=BufferLoadOptions());
+QByteArray detachedData(QByteArray data);
+QString getTempFilename(const QString &base_filename, const QString &suffix);
 
 
 #endif // DEVICES_H
@@ -1,25 +1,70 @@
 #include "document.h"
 #include <cassert>
 #include <QDebug>
+#include <QDir>
+#include <QCoreApplication>
 #include "chain.h"
 #include "devices.h"
 #include "spans.h"
 #include <memory>
 
+
+// edits are merged into previous undo action only while it holds less data than this
+qulonglong MAXIMAL_COALESCED_LENGTH = 1024 * 64; // 64 KB
+// default maximal interval (in milliseconds) between edits that are merged into single undo action
+int DEFAULT_COALESCE_INTERVAL = 1000;
+
+
 int generateBranchId() {
     static int _last_branch_id = 0;
     return ++_last_branch_id;
 }
 
+static qulonglong chainPayloadSize(const std::shared_ptr<SpanChain> &chain) {
+    /** Returns number of bytes of data that spans of :chain: hold in memory.
+     **/
+    qulonglong result = 0;
+    for (auto span : chain->getSpans()) {
+        if (std::dynamic_pointer_cast<DataSpan>(span)) {
+            result += span->getLength();
+        }
+    }
+    return result;
+}
+
 class InsertAction : public AbstractUndoAction {
 public:
     InsertAction(const std::shared_ptr<Document> &document, qulonglong position,
                  const std::shared_ptr<SpanChain> &chain, const QString &title=QString())
-        : AbstractUndoAction(document,
-                             title.isEmpty() ? QString("inserting %1 bytes from position %2").arg(chain->getLength()).arg(position)
-                                             : title)
-        , _position(position), _chain(chain) {
+        : AbstractUndoAction(document, title), _position(position), _chain(chain), _generatedTitle(title.isEmpty()),
+          _undone(false) {
+        _updateTitle();
+    }
+
+    qulonglong getLength()const {
+        return _chain->getLength();
+    }
 
+    bool canCoalesce(qulonglong position)const {
+        // data can be inserted inside data inserted by this action or right after it
+        return position >= _position && position - _position <= _chain->getLength();
+    }
+
+    void coalesce(qulonglong position, const std::shared_ptr<SpanChain> &chain) {
+        _chain->insertChain(position - _position, chain);
+        _updateTitle();
+    }
+
+    bool canOverwrite(qulonglong position, qulonglong length)const {
+        // data can be written over data inserted by this action only
+        return position >= _position && position - _position + length <= _chain->getLength();
+    }
+
+    void overwrite(qulonglong position, const std::shared_ptr<SpanChain> &chain) {
+        /** Replaces inserted data with :chain: written over it, so undoing this action removes written data too.
+         **/
+        _chain->remove(position - _position, chain->getLength());
+        _chain->insertChain(position - _position, chain);
     }
 
     void undo() {
@@ -27,6 +72,7 @@ public:
         if (doc) {
             doc->_remove(_position, _chain->getLength(), true, -1);
         }
+        _undone = true;
     }
 
     void redo() {
@@ -34,11 +80,31 @@ public:
         if (doc) {
             doc->_insertChain(_position, _chain, 0, true, 1);
         }
+        _undone = false;
+    }
+
+    qulonglong getPayloadSize()const {
+        // inserted data is referenced by document until insertion is undone
+        return _undone ? chainPayloadSize(_chain) : 0;
+    }
+
+    void replacePayloadSpans(const SpanReplacer &replacer) {
+        if (_undone) {
+            _chain->replaceSpans(replacer);
+        }
     }
 
 private:
     qulonglong _position;
     const std::shared_ptr<SpanChain> _chain;
+    bool _generatedTitle;
+    bool _undone;
+
+    void _updateTitle() {
+        if (_generatedTitle) {
+            _setTitle(QString("inserting %1 bytes from position %2").arg(_chain->getLength()).arg(_position));
+        }
+    }
 };
 
 
@@ -49,7 +115,7 @@ public:
         : AbstractUndoAction(document,
                              title.isEmpty() ? QString("removing %1 bytes from position %2").arg(chain->getLength()).arg(position)
                                              : title)
-        , _position(position), _chain(chain) {
+        , _position(position), _chain(chain), _undone(false) {
 
     }
 
@@ -58,6 +124,7 @@ public:
         if (doc) {
             doc->_insertChain(_position, _chain, 0, true, -1);
         }
+        _undone = true;
     }
 
     void redo() {
@@ -65,11 +132,24 @@ public:
         if (doc) {
             doc->_remove(_position, _chain->getLength(), true, 1);
         }
+        _undone = false;
+    }
+
+    qulonglong getPayloadSize()const {
+        // removed data returns to document when removal is undone
+        return _undone ? 0 : chainPayloadSize(_chain);
+    }
+
+    void replacePayloadSpans(const SpanReplacer &replacer) {
+        if (!_undone) {
+            _chain->replaceSpans(replacer);
+        }
     }
 
 private:
     qulonglong _position;
     std::shared_ptr<SpanChain> _chain;
+    bool _undone;
 };
 
 
@@ -78,11 +158,37 @@ public:
     WriteAction(const std::shared_ptr<Document> &document, qulonglong position,
                 const std::shared_ptr<SpanChain> &overwritten_chain, const std::shared_ptr<SpanChain> &written_chain,
                 const QString &title=QString())
-        : AbstractUndoAction(document,
-                             title.isEmpty() ? QString("writing %1 bytes at position %2").arg(written_chain->getLength()).arg(position)
-                                              : title)
-        , _position(position), _overwrittenChain(overwritten_chain), _writtenChain(written_chain) {
+        : AbstractUndoAction(document, title), _position(position), _overwrittenChain(overwritten_chain),
+          _writtenChain(written_chain), _generatedTitle(title.isEmpty()) {
+        _updateTitle();
+    }
+
+    qulonglong getLength()const {
+        return _writtenChain->getLength();
+    }
 
+    bool canCoalesce(qulonglong position)const {
+        // data can be written over data written by this action or right after it
+        return position >= _position && position - _position <= _writtenChain->getLength();
+    }
+
+    void coalesce(qulonglong position, const std::shared_ptr<SpanChain> &overwritten_chain,
+                  const std::shared_ptr<SpanChain> &written_chain) {
+        /** Extends this action with data :written_chain: written at :position:. :overwritten_chain: is data that
+         *  was replaced; its part that was written by this action is dropped, and the rest is original data
+         *  that should be restored on undo.
+         **/
+        qulonglong offset = position - _position;
+        qulonglong own_length = std::min(_writtenChain->getLength() - offset, written_chain->getLength());
+        if (overwritten_chain->getLength() > own_length) {
+            assert(_overwrittenChain->getLength() == _writtenChain->getLength());
+            _overwrittenChain->insertChain(_overwrittenChain->getLength(),
+                                           overwritten_chain->takeChain(own_length,
+                                                                        overwritten_chain->getLength() - own_length));
+        }
+        _writtenChain->remove(offset, own_length);
+        _writtenChain->insertChain(offset, written_chain);
+        _updateTitle();
     }
 
     void undo() {
@@ -93,9 +199,25 @@ public:
         _do(false);
     }
 
+    qulonglong getPayloadSize()const {
+        // chains are swapped on undo and redo, so written chain is always one that document references
+        return chainPayloadSize(_overwrittenChain);
+    }
+
+    void replacePayloadSpans(const SpanReplacer &replacer) {
+        _overwrittenChain->replaceSpans(replacer);
+    }
+
 private:
     qulonglong _position;
     std::shared_ptr<SpanChain> _overwrittenChain, _writtenChain;
+    bool _generatedTitle;
+
+    void _updateTitle() {
+        if (_generatedTitle) {
+            _setTitle(QString("writing %1 bytes at position %2").arg(_writtenChain->getLength()).arg(_position));
+        }
+    }
 
     void _do(bool undo) {
         auto doc = getDocument();
@@ -209,11 +331,97 @@ QList<int> ComplexAction::alternativeBranchesIds()const {
     return result;
 }
 
+qulonglong ComplexAction::getPayloadSize()const {
+    qulonglong result = 0;
+    for (auto action : getHistory()) {
+        result += action->getPayloadSize();
+    }
+    return result;
+}
+
+void ComplexAction::replacePayloadSpans(const SpanReplacer &replacer) {
+    for (auto action : getHistory()) {
+        action->replacePayloadSpans(replacer);
+    }
+}
+
+qulonglong ComplexAction::getRedoPayloadSize()const {
+    /** Returns payload of sub-actions that can be redone.
+     **/
+    qulonglong result = 0;
+    for (int j = _currentStep + 1; j < _subActions.length(); ++j) {
+        result += _subActions[j]->getPayloadSize();
+    }
+    return result;
+}
+
+std::shared_ptr<AbstractUndoAction> ComplexAction::getUndoStepAction()const {
+    return canUndo() ? _subActions[_currentStep] : nullptr;
+}
+
+std::shared_ptr<AbstractUndoAction> ComplexAction::getRedoStepAction()const {
+    return canRedo() ? _subActions[_currentStep + 1] : nullptr;
+}
+
+int ComplexAction::getHistoryLength()const {
+    int result = _subActions.length();
+    for (const Branch &branch : _branches) {
+        result += branch.actions.length();
+    }
+    return result;
+}
+
+std::shared_ptr<AbstractUndoAction> ComplexAction::getHistoryAction(int index)const {
+    /** Returns sub-action with given index in list returned by ComplexAction::getHistory without building this list.
+     **/
+    for (const Branch &branch : _branches) {
+        if (index < branch.actions.length()) {
+            return branch.actions[index];
+        }
+        index -= branch.actions.length();
+    }
+    return _subActions[index];
+}
+
+QList<std::shared_ptr<AbstractUndoAction>> ComplexAction::getHistory()const {
+    /** Returns all sub-actions from the least to the most likely to be undone or redone: actions of alternate
+     *  branches (oldest branch first) go before actions of current branch.
+     **/
+    QList<std::shared_ptr<AbstractUndoAction>> result;
+    for (const Branch &branch : _branches) {
+        result.append(branch.actions);
+    }
+    result.append(_subActions);
+    return result;
+}
+
+bool ComplexAction::dropOldest(qulonglong *dropped_payload) {
+    /** Forgets oldest alternate branch, or oldest action of current branch if there are no branches. Last done
+     *  action is never dropped. Returns false if there is nothing to drop.
+     **/
+    *dropped_payload = 0;
+    if (!_branches.isEmpty()) {
+        for (auto action : _branches.first().actions) {
+            *dropped_payload += action->getPayloadSize();
+        }
+        _branches.removeFirst();
+        return true;
+    } else if (_currentStep > 0) {
+        *dropped_payload = _subActions.first()->getPayloadSize();
+        _subActions.removeFirst();
+        --_currentStep;
+        return true;
+    }
+    return false;
+}
+
 
 Document::Document(const std::shared_ptr<AbstractDevice> &device) : _spanChain(std::make_shared<SpanChain>()),
     _currentUndoAction(std::make_shared<ComplexAction>(std::shared_ptr<Document>(), "initial state")),
     _undoDisabled(false), _fixedSize(false), _readOnly(false), _currentAtomicOperationIndex(),
-    _savepoint(), _lock(std::make_shared<ReadWriteLock>()) {
+    _savepoint(), _lock(std::make_shared<ReadWriteLock>()), _saving(false), _saveCancellable(false),
+    _saveCancelRequested(false), _saveLength(), _coalesceInterval(DEFAULT_COALESCE_INTERVAL), _undoMemoryBudget(),
+    _undoMemoryUsage(), _undoSpillEnabled(true), _unspilledActionIndex() {
 
     _rootAction = _currentUndoAction;
     _device = device;
@@ -268,7 +476,7 @@ void Document::setFixedSize(bool fixed_size) {
 
 bool Document::isReadOnly() const {
     ReadLocker locker(_lock);
-    return _readOnly;
+    return _readOnly || _saving;
 }
 
 void Document::setReadOnly(bool read_only) {
@@ -292,6 +500,16 @@ QByteArray Document::readAll() const {
     return _spanChain->read(0, _spanChain->getLength());
 }
 
+qulonglong Document::readInto(qulonglong position, char *buffer, qulonglong length, bool use_cache) const {
+    ReadLocker locker(_lock);
+    return _spanChain->readInto(position, buffer, length, use_cache);
+}
+
+DataView Document::view(qulonglong position, qulonglong length) const {
+    ReadLocker locker(_lock);
+    return _spanChain->view(position, length);
+}
+
 void Document::insertSpan(qulonglong position, const std::shared_ptr<AbstractSpan> &span, char fill_byte) {
     insertChain(position, SpanChain::fromSpans(SpanList() << span), fill_byte);
 }
@@ -317,7 +535,9 @@ void Document::appendChain(const std::shared_ptr<SpanChain> &chain) {
 
 void Document::_insertChain(qulonglong position, const std::shared_ptr<SpanChain> &chain,
                             char fill_byte, bool from_undo, int op_increment) {
+    _checkNotSaving();
     WriteLocker locker(_lock);
+    _checkNotSaving();
 
     // check if we can do this operation
     if (_readOnly) {
@@ -335,6 +555,12 @@ void Document::_insertChain(qulonglong position, const std::shared_ptr<SpanChain
     // this chain will be inserted into document chain (and stored in undo stack too).
     auto chain_to_insert = SpanChain::fromChain(*chain);
 
+    // data inserted next to data inserted by previous action can be merged into this action
+    bool can_coalesce = !from_undo && position <= _spanChain->getLength();
+    auto insert_action = can_coalesce ? std::dynamic_pointer_cast<InsertAction>(_coalescingAction) : nullptr;
+    bool coalesced = insert_action && !_coalesceTimer.hasExpired(_coalesceInterval) &&
+                     _canCoalesce(insert_action->getLength(), chain_to_insert) && insert_action->canCoalesce(position);
+
     // should we insert chain after current document end?
     if (position > _spanChain->getLength()) {
         // in this case, prepend span to be inserted with FillSpan and adjust insert position.
@@ -342,15 +568,25 @@ void Document::_insertChain(qulonglong position, const std::shared_ptr<SpanChain
         position = _spanChain->getLength();
     }
 
-    _incrementAtomicOperationIndex(op_increment);
+    _incrementAtomicOperationIndex(coalesced ? 0 : op_increment);
     if (!from_undo) {
         chain_to_insert->setCommonSavepoint(_currentAtomicOperationIndex);
     }
 
     _spanChain->insertChain(position, chain_to_insert);
 
-    if (!from_undo) {
-        addAction(std::make_shared<InsertAction>(shared_from_this(), position, chain_to_insert));
+    if (coalesced) {
+        _undoMemoryUsage -= insert_action->getPayloadSize();
+        insert_action->coalesce(position, chain_to_insert);
+        _undoMemoryUsage += insert_action->getPayloadSize();
+        _coalesceTimer.start();
+        _limitUndoHistory();
+    } else if (!from_undo) {
+        auto action = std::make_shared<InsertAction>(shared_from_this(), position, chain_to_insert);
+        addAction(action);
+        if (can_coalesce && _canCoalesce(0, chain_to_insert)) {
+            _startCoalescing(action);
+        }
     }
 
     emit resized(_spanChain->getLength());
@@ -372,7 +608,9 @@ void Document::writeChain(qulonglong position, const std::shared_ptr<SpanChain>
 
 void Document::_writeChain(qulonglong position, const std::shared_ptr<SpanChain> &chain,
                            char fill_byte, bool from_undo, int op_increment) {
+    _checkNotSaving();
     WriteLocker locker(_lock);
+    _checkNotSaving();
 
     if (_readOnly) {
         throw ReadOnlyError();
@@ -389,6 +627,19 @@ void Document::_writeChain(qulonglong position, const std::shared_ptr<SpanChain>
     auto chain_to_write = SpanChain::fromChain(*chain); // also will be stored in undo stack
     std::shared_ptr<SpanChain> overwritten;
 
+    // data written over or right after data written by previous action can be merged into this action
+    bool can_coalesce = !from_undo && position <= getLength();
+    auto write_action = can_coalesce ? std::dynamic_pointer_cast<WriteAction>(_coalescingAction) : nullptr;
+    bool coalesced = write_action && !_coalesceTimer.hasExpired(_coalesceInterval) &&
+                     _canCoalesce(write_action->getLength(), chain_to_write) && write_action->canCoalesce(position);
+
+    // data written over data inserted by previous action (as in insert mode, where placeholder is inserted before
+    // data is written) is merged into insertion
+    auto insert_action = can_coalesce ? std::dynamic_pointer_cast<InsertAction>(_coalescingAction) : nullptr;
+    bool folded = insert_action && !_coalesceTimer.hasExpired(_coalesceInterval) &&
+                  insert_action->canOverwrite(position, chain_to_write->getLength()) &&
+                  _canCoalesce(insert_action->getLength() - chain_to_write->getLength(), chain_to_write);
+
     // now we will remove data which should be overwritten
     if (position < getLength()) {
         // note that length of data we should overwrite can be less than length of data we want to write
@@ -400,7 +651,7 @@ void Document::_writeChain(qulonglong position, const std::shared_ptr<SpanChain>
         position = _spanChain->getLength();
     }
 
-    _incrementAtomicOperationIndex(op_increment);
+    _incrementAtomicOperationIndex(coalesced || folded ? 0 : op_increment);
 
     if (!from_undo) {
         chain_to_write->setCommonSavepoint(_currentAtomicOperationIndex);
@@ -412,8 +663,24 @@ void Document::_writeChain(qulonglong position, const std::shared_ptr<SpanChain>
         overwritten = SpanChain::fromSpans(SpanList());
     }
 
-    if (!from_undo) {
-        addAction(std::make_shared<WriteAction>(shared_from_this(), position, overwritten, chain_to_write));
+    if (coalesced) {
+        _undoMemoryUsage -= write_action->getPayloadSize();
+        write_action->coalesce(position, overwritten, chain_to_write);
+        _undoMemoryUsage += write_action->getPayloadSize();
+        _coalesceTimer.start();
+        _limitUndoHistory();
+    } else if (folded) {
+        _undoMemoryUsage -= insert_action->getPayloadSize();
+        insert_action->overwrite(position, chain_to_write);
+        _undoMemoryUsage += insert_action->getPayloadSize();
+        _coalesceTimer.start();
+        _limitUndoHistory();
+    } else if (!from_undo) {
+        auto action = std::make_shared<WriteAction>(shared_from_this(), position, overwritten, chain_to_write);
+        addAction(action);
+        if (can_coalesce && _canCoalesce(0, chain_to_write)) {
+            _startCoalescing(action);
+        }
     }
 
     if (overwritten->getLength() < chain_to_write->getLength()) {
@@ -455,6 +722,10 @@ bool Document::isRangeModified(qulonglong position, qulonglong length) const {
 }
 
 void Document::_remove(qulonglong position, qulonglong length, bool from_undo, int op_increment) {
+    _checkNotSaving();
+    WriteLocker locker(_lock);
+    _checkNotSaving();
+
     if (_readOnly) {
         throw ReadOnlyError();
     } else if (_fixedSize && length) {
@@ -498,10 +769,16 @@ void Document::_incrementAtomicOperationIndex(int inc) {
 }
 
 void Document::undo() {
+    _checkNotSaving();
     WriteLocker locker(_lock);
+    _checkNotSaving();
+    _coalescingAction.reset();
     if (canUndo()) {
         bool old_can_undo  = canUndo(), old_can_redo = canRedo();
+        auto action = _currentUndoAction->getUndoStepAction();
+        qulonglong old_payload = action->getPayloadSize();
         _currentUndoAction->undoStep();
+        _onUndoStateChanged(action, old_payload);
         if (old_can_undo != canUndo()) {
             emit canUndoChanged(canUndo());
         }
@@ -512,10 +789,17 @@ void Document::undo() {
 }
 
 void Document::redo(int branch_id) {
+    _checkNotSaving();
     WriteLocker locker(_lock);
+    _checkNotSaving();
+    _coalescingAction.reset();
     if (canRedo()) {
         bool old_can_undo  = canUndo(), old_can_redo = canRedo();
+        // action redone after switching to another branch is not known in advance
+        auto action = branch_id < 0 ? _currentUndoAction->getRedoStepAction() : nullptr;
+        qulonglong old_payload = action ? action->getPayloadSize() : 0;
         _currentUndoAction->redoStep(branch_id);
+        _onUndoStateChanged(action, old_payload);
         if (old_can_undo != canUndo()) {
             emit canUndoChanged(canUndo());
         }
@@ -527,15 +811,21 @@ void Document::redo(int branch_id) {
 
 void Document::addAction(const std::shared_ptr<AbstractUndoAction> &action) {
     WriteLocker locker(_lock);
+    _coalescingAction.reset();
     bool old_can_undo = canUndo();
+    // actions that could be redone are discarded by new action
+    _undoMemoryUsage -= _currentUndoAction->getRedoPayloadSize();
     _currentUndoAction->addAction(action);
+    _undoMemoryUsage += action->getPayloadSize();
     if (old_can_undo != canUndo()) {
         emit canUndoChanged(canUndo());
     }
+    _limitUndoHistory();
 }
 
 void Document::beginComplexAction(const QString &title) {
     WriteLocker locker(_lock);
+    _coalescingAction.reset();
     auto new_sub_action = std::make_shared<ComplexAction>(shared_from_this(), title);
     _currentUndoAction->addAction(new_sub_action);
     _currentUndoAction = new_sub_action;
@@ -546,6 +836,7 @@ void Document::endComplexAction() {
     if (!_currentUndoAction->getParentAction()) {
         throw DocumentError("trying to end complex action while there are no open actions");
     }
+    _coalescingAction.reset();
     _currentUndoAction = _currentUndoAction->getParentAction();
 }
 
@@ -564,8 +855,171 @@ QList<int> Document::getAlternativeBranchesIds()const {
     return _currentUndoAction->alternativeBranchesIds();
 }
 
-void Document::save(const std::shared_ptr<AbstractDevice> &write_device, bool switch_devices) {
+int Document::getCoalesceInterval()const {
+    ReadLocker locker(_lock);
+    return _coalesceInterval;
+}
+
+void Document::setCoalesceInterval(int interval) {
+    /** Sets maximal interval in milliseconds between adjacent writes or inserts of raw data that are merged into
+     *  single undo action. Zero disables merging.
+     **/
     WriteLocker locker(_lock);
+    _coalesceInterval = interval;
+    if (interval <= 0) {
+        _coalescingAction.reset();
+    }
+}
+
+bool Document::_canCoalesce(qulonglong action_length, const std::shared_ptr<SpanChain> &chain)const {
+    /** Checks if :chain: can be merged into action holding :action_length: bytes. Only raw data is merged.
+     **/
+    if (_coalesceInterval <= 0 || action_length + chain->getLength() > MAXIMAL_COALESCED_LENGTH) {
+        return false;
+    }
+
+    for (auto span : chain->getSpans()) {
+        if (!std::dynamic_pointer_cast<DataSpan>(span)) {
+            return false;
+        }
+    }
+    return true;
+}
+
+void Document::_startCoalescing(const std::shared_ptr<AbstractUndoAction> &action) {
+    _coalescingAction = action;
+    _coalesceTimer.start();
+}
+
+qulonglong Document::getUndoMemoryBudget()const {
+    ReadLocker locker(_lock);
+    return _undoMemoryBudget;
+}
+
+void Document::setUndoMemoryBudget(qulonglong budget) {
+    /** Sets maximal number of bytes of data undo history can keep in memory. When history grows over this limit,
+     *  data of oldest actions is moved to temporary journal file (and read back from it on undo), or oldest
+     *  actions are forgotten if spilling is disabled. Zero budget means no limit.
+     **/
+    WriteLocker locker(_lock);
+    _undoMemoryBudget = budget;
+    _limitUndoHistory();
+}
+
+bool Document::isUndoSpillEnabled()const {
+    ReadLocker locker(_lock);
+    return _undoSpillEnabled;
+}
+
+void Document::setUndoSpillEnabled(bool enabled) {
+    WriteLocker locker(_lock);
+    _undoSpillEnabled = enabled;
+    _limitUndoHistory();
+}
+
+qulonglong Document::getUndoMemoryUsage()const {
+    ReadLocker locker(_lock);
+    return _undoMemoryUsage;
+}
+
+void Document::_limitUndoHistory() {
+    if (!_undoMemoryBudget || _undoMemoryUsage <= _undoMemoryBudget) {
+        return;
+    }
+
+    if (_undoSpillEnabled && _spillUndoHistory()) {
+        return;
+    }
+
+    qulonglong dropped_payload;
+    int history_length = _rootAction->getHistoryLength();
+    while (_undoMemoryUsage > _undoMemoryBudget && _rootAction->dropOldest(&dropped_payload)) {
+        _undoMemoryUsage -= dropped_payload;
+        int new_history_length = _rootAction->getHistoryLength();
+        _unspilledActionIndex = std::max(0, _unspilledActionIndex - (history_length - new_history_length));
+        history_length = new_history_length;
+    }
+}
+
+void Document::_onUndoStateChanged(const std::shared_ptr<AbstractUndoAction> &action, qulonglong old_payload) {
+    /** Updates undo memory usage after :action: was undone or redone. Data inserted by undone action is held by
+     *  history only, and data of action that is already spilled can become payload again, so all history should
+     *  be checked on next spill.
+     **/
+    if (action) {
+        _undoMemoryUsage = _undoMemoryUsage - old_payload + action->getPayloadSize();
+    } else {
+        _undoMemoryUsage = _rootAction->getPayloadSize();
+    }
+    _unspilledActionIndex = 0;
+    _limitUndoHistory();
+}
+
+bool Document::_spillUndoHistory() {
+    /** Moves data of oldest undo actions to journal file until history fits into budget. Returns false if
+     *  journal cannot be written.
+     **/
+    try {
+        if (!_undoJournal) {
+            static std::atomic<int> journal_index(0);
+            QString journal_name = QDir::temp().filePath(QString("microhex-undo-%1-%2")
+                                                         .arg(QCoreApplication::applicationPid()).arg(++journal_index));
+            FileLoadOptions journal_options;
+            journal_options.forceNew = true;
+            journal_options.temporary = true;
+            _undoJournal = deviceFromFile(getTempFilename(journal_name, "mhu"), journal_options);
+        }
+
+        // same span can be referenced by several actions, but its data should be written only once
+        QHash<const AbstractSpan*, std::shared_ptr<AbstractSpan>> spilled_spans;
+        auto journal = _undoJournal;
+        SpanReplacer spill = [journal, &spilled_spans](const std::shared_ptr<AbstractSpan> &span)
+                                                                                -> std::shared_ptr<AbstractSpan> {
+            if (!std::dynamic_pointer_cast<DataSpan>(span)) {
+                return span;
+            } else if (!spilled_spans.contains(span.get())) {
+                qulonglong position = journal->getLength();
+                journal->resize(position + span->getLength());
+                if (journal->write(position, span->read(0, span->getLength())) != span->getLength()) {
+                    throw DeviceError("failed to write undo journal: not all data was written");
+                }
+                spilled_spans[span.get()] = journal->createSpan(position, span->getLength());
+            }
+            return spilled_spans[span.get()];
+        };
+
+        // actions before _unspilledActionIndex have no payload left, so they are not checked again
+        int history_length = _rootAction->getHistoryLength();
+        _unspilledActionIndex = std::max(0, std::min(_unspilledActionIndex, history_length - 1));
+        for (int index = _unspilledActionIndex; index < history_length && _undoMemoryUsage > _undoMemoryBudget;
+             ++index) {
+            auto action = _rootAction->getHistoryAction(index);
+            qulonglong payload = action->getPayloadSize();
+            if (payload) {
+                action->replacePayloadSpans(spill);
+                _undoMemoryUsage -= payload - action->getPayloadSize();
+            }
+            // last action can still grow, as edits can be merged into it
+            if (index + 1 < history_length) {
+                _unspilledActionIndex = index + 1;
+            }
+        }
+    } catch (const std::exception &err) {
+        qWarning() << "failed to spill undo history:" << err.what();
+        return false;
+    }
+    return true;
+}
+
+void Document::save(const std::shared_ptr<AbstractDevice> &write_device, bool switch_devices) {
+    /** Writes document data to :write_device: (or to current device if :write_device: is null). Document is
+     *  locked for writing only while save is being prepared and completed. While data is written, document is
+     *  locked for reading only, so it stays readable from another threads, and all modifications fail with
+     *  ReadOnlyError (Document::isReadOnly returns true while saving), so readers always see same data that is
+     *  being saved. Progress is reported with saveProgress signal emitted from saving thread. If saver allows it,
+     *  save can be cancelled with Document::cancelSave; in this case SaveCancelledError is thrown.
+     **/
+    ReadLocker read_locker(_lock);
 
     auto device_to_write = write_device ? write_device : _device;
     auto device_to_read = _device;
@@ -578,28 +1032,64 @@ void Document::save(const std::shared_ptr<AbstractDevice> &write_device, bool sw
         throw DocumentError();
     }
 
-    auto saver = device_to_write->createSaver(shared_from_this(), device_to_read);
-
+    std::shared_ptr<AbstractSaver> saver;
     QList<std::shared_ptr<PrimitiveDeviceSpan>> spans_to_dissolve;
-    if (device_to_read == device_to_write || switch_devices) {
-        spans_to_dissolve = _prepareToUpdateDevice(switch_devices ? device_to_write : device_to_read);
+    {
+        WriteLocker locker(_lock);
+        if (_saving) {
+            throw DocumentError("document is already being saved");
+        }
+
+        saver = device_to_write->createSaver(shared_from_this(), device_to_read);
+
+        if (device_to_read == device_to_write || switch_devices) {
+            spans_to_dissolve = _prepareToUpdateDevice(switch_devices ? device_to_write : device_to_read);
+        }
+
+        _saveLength = getLength();
+        _saveCancelRequested = false;
+        _saveCancellable = saver->isCancellable();
+        _saving = true;
+        if (!_readOnly) {
+            emit readOnlyChanged(true);
+        }
     }
 
-    saver->begin();
+    struct SavingGuard {
+        Document *document;
+        ~SavingGuard() { document->_endSaving(); }
+    } saving_guard = { this };
+
+    // saver that changes data referenced by document while writing (for example, moves data inside file) should
+    // not allow reading document until save is completed
+    std::unique_ptr<WriteLocker> exclusive_locker;
+    if (saver->needsExclusiveAccess()) {
+        exclusive_locker.reset(new WriteLocker(_lock));
+    }
+
+    bool recovered = false;
     try {
-        SpanList spans = _spanChain->getSpans();
-        for (auto span : spans) {
-            span->put(saver);
-        }
+        saver->begin();
+        putSpans(saver);
     } catch (...) {
         saver->fail();
-        for (auto span : _device->getSpans()) {
-            span->cancelDissolve();
+        if (!saver->isRecovered()) {
+            for (auto span : _device->getSpans()) {
+                span->cancelDissolve();
+            }
+            throw;
         }
-        throw;
+        // saver has completed save in spite of error (in-place save is replayed from journal when file was already
+        // changed), so spans should be updated just like after successful save
+        recovered = true;
     }
 
-    saver->complete();
+    WriteLocker locker(_lock);
+
+    _saveCancellable = false;
+    if (!recovered) {
+        saver->complete();
+    }
 
     if (switch_devices) {
         _device = device_to_write;
@@ -618,6 +1108,11 @@ void Document::save(const std::shared_ptr<AbstractDevice> &write_device, bool sw
 
     _setSavepoint();
 
+    // spans of old device referenced by undo actions were replaced with their data
+    _undoMemoryUsage = _rootAction->getPayloadSize();
+    _unspilledActionIndex = 0;
+    _limitUndoHistory();
+
     if (switch_devices) {
         emit urlChanged(this->getUrl());
     }
@@ -647,7 +1142,59 @@ const std::shared_ptr<SpanChain> Document::exportRange(qulonglong position, qulo
     return _spanChain->exportRange(position, length, ram_limit);
 }
 
+void Document::putSpans(const std::shared_ptr<AbstractSaver> &saver) const {
+    /** Passes all document spans to :saver: in order of their positions in document. DeviceSpans are passed as
+     *  primitive spans they consist of.
+     **/
+    ReadLocker locker(_lock);
+    for (auto span : _spanChain->getSpans()) {
+        span->put(saver);
+    }
+}
+
+bool Document::isSaving() const {
+    return _saving;
+}
+
+bool Document::canCancelSave() const {
+    return _saving && _saveCancellable;
+}
+
+void Document::cancelSave() {
+    /** Requests cancelling save that is in progress. Does nothing if document is not being saved or save cannot be
+     *  cancelled. Can be called from any thread, including one that executes Document::save (from slot connected
+     *  to saveProgress signal).
+     **/
+    if (canCancelSave()) {
+        _saveCancelRequested = true;
+    }
+}
+
+void Document::_checkNotSaving() const {
+    if (_saving) {
+        throw ReadOnlyError();
+    }
+}
+
+void Document::_endSaving() {
+    _saving = false;
+    _saveCancellable = false;
+    _saveCancelRequested = false;
+    if (!_readOnly) {
+        emit readOnlyChanged(false);
+    }
+}
+
+bool Document::_reportSaveProgress(qulonglong saved_length) {
+    /** Called by saver after each written block. Returns true if cancelling save was requested.
+     **/
+    emit saveProgress(saved_length, _saveLength);
+    return _saveCancelRequested;
+}
+
 void Document::_setSavepoint() {
+    // edits made after save should not be merged with edits made before it
+    _coalescingAction.reset();
     if (_savepoint != _currentAtomicOperationIndex) {
         _savepoint = _currentAtomicOperationIndex;
         _spanChain->setCommonSavepoint(_savepoint);
@@ -730,7 +1277,7 @@ QList<std::shared_ptr<PrimitiveDeviceSpan> > Document::_prepareToUpdateDevice(co
                 bool ok = false;
                 QByteArray data_to_store;
                 try {
-                    data_to_store = write_device->read(current_offset, data_to_store_length);
+                    data_to_store = detachedData(write_device->read(current_offset, data_to_store_length));
                     ok = true;
                 } catch (const std::bad_alloc &) {
                     // not enough memory
@@ -787,3 +1334,18 @@ void AbstractUndoAction::setParentAction(const std::shared_ptr<ComplexAction> &a
     _parentAction = action;
 }
 
+qulonglong AbstractUndoAction::getPayloadSize()const {
+    /** Returns number of bytes of data only undo history keeps in memory for this action: data that is not
+     *  referenced by document in current state of action.
+     **/
+    return 0;
+}
+
+void AbstractUndoAction::replacePayloadSpans(const SpanReplacer &) {
+
+}
+
+void AbstractUndoAction::_setTitle(const QString &title) {
+    _title = title;
+}
+
@@ -3,11 +3,14 @@
 
 #include <exception>
 #include <memory>
+#include <atomic>
 #include <QObject>
 #include <QUrl>
 #include <QByteArray>
+#include <QElapsedTimer>
 #include "readwritelock.h"
 #include "base.h"
+#include "spans.h"
 
 
 class SpanChain;
@@ -16,6 +19,8 @@ class AbstractSpan;
 class ComplexAction;
 class AbstractDevice;
 class PrimitiveDeviceSpan;
+class AbstractSaver;
+class FileDevice;
 
 
 class DocumentError : public BaseException {
@@ -24,11 +29,18 @@ public:
 };
 
 
+class SaveCancelledError : public DocumentError {
+public:
+    SaveCancelledError() : DocumentError("saving was cancelled") { }
+};
+
+
 class Document : public QObject, public std::enable_shared_from_this<Document> {
     Q_OBJECT
     friend class InsertAction;
     friend class RemoveAction;
     friend class WriteAction;
+    friend class StandardSaver;
 public:
     Document(const std::shared_ptr<AbstractDevice> &device=std::shared_ptr<AbstractDevice>());
     ~Document();
@@ -45,6 +57,8 @@ public:
 
     QByteArray read(qulonglong position, qulonglong length)const;
     QByteArray readAll()const;
+    qulonglong readInto(qulonglong position, char *buffer, qulonglong length, bool use_cache=true)const;
+    DataView view(qulonglong position, qulonglong length)const;
 
     void insertSpan(qulonglong position, const std::shared_ptr<AbstractSpan> &span, char fill_byte=0);
     void insertChain(qulonglong position, const std::shared_ptr<SpanChain> &chain, char fill_byte=0);
@@ -66,10 +80,21 @@ public:
     bool canUndo()const;
     bool canRedo()const;
     QList<int> getAlternativeBranchesIds()const;
+    int getCoalesceInterval()const;
+    void setCoalesceInterval(int interval);
+    qulonglong getUndoMemoryBudget()const;
+    void setUndoMemoryBudget(qulonglong budget);
+    bool isUndoSpillEnabled()const;
+    void setUndoSpillEnabled(bool enabled);
+    qulonglong getUndoMemoryUsage()const;
 
     void save(const std::shared_ptr<AbstractDevice> &write_device=std::shared_ptr<AbstractDevice>(),
               bool switch_devices=false);
     bool checkCanQuickSave()const;
+    void putSpans(const std::shared_ptr<AbstractSaver> &saver)const;
+    bool isSaving()const;
+    bool canCancelSave()const;
+    void cancelSave();
 
     const std::shared_ptr<SpanChain> exportRange(qulonglong position, qulonglong length, int ram_limit=-1)const;
 
@@ -84,6 +109,7 @@ signals:
     void urlChanged(const QUrl &);
     void readOnlyChanged(bool);
     void fixedSizeChanged(bool);
+    void saveProgress(qulonglong, qulonglong);
 
 protected:
     std::shared_ptr<AbstractDevice> _device;
@@ -96,6 +122,15 @@ protected:
     int _currentAtomicOperationIndex;
     int _savepoint;
     std::shared_ptr<ReadWriteLock> _lock;
+    std::atomic<bool> _saving, _saveCancellable, _saveCancelRequested;
+    qulonglong _saveLength;
+    std::shared_ptr<AbstractUndoAction> _coalescingAction;
+    QElapsedTimer _coalesceTimer;
+    int _coalesceInterval;
+    qulonglong _undoMemoryBudget, _undoMemoryUsage;
+    bool _undoSpillEnabled;
+    std::shared_ptr<FileDevice> _undoJournal;
+    int _unspilledActionIndex; // index of first action in history of root action that can have payload to spill
 
     void _insertChain(qulonglong position, const std::shared_ptr<SpanChain> &chain, char fill_byte, bool from_undo, int op_increment);
     void _remove(qulonglong position, qulonglong length, bool from_undo, int op_increment);
@@ -103,6 +138,14 @@ protected:
     void _incrementAtomicOperationIndex(int inc);
     QList<std::shared_ptr<PrimitiveDeviceSpan>> _prepareToUpdateDevice(const std::shared_ptr<AbstractDevice> &new_device);
     void _setSavepoint();
+    void _checkNotSaving()const;
+    void _endSaving();
+    bool _reportSaveProgress(qulonglong saved_length);
+    bool _canCoalesce(qulonglong action_length, const std::shared_ptr<SpanChain> &chain)const;
+    void _startCoalescing(const std::shared_ptr<AbstractUndoAction> &action);
+    void _limitUndoHistory();
+    bool _spillUndoHistory();
+    void _onUndoStateChanged(const std::shared_ptr<AbstractUndoAction> &action, qulonglong old_payload);
 
 private slots:
     void _onDeviceReadOnlyChanged(bool);
@@ -123,6 +166,11 @@ public:
 
     virtual void undo() = 0;
     virtual void redo() = 0;
+    virtual qulonglong getPayloadSize()const;
+    virtual void replacePayloadSpans(const SpanReplacer &replacer);
+
+protected:
+    void _setTitle(const QString &title);
 
 private:
     std::weak_ptr<Document> _document;
@@ -157,6 +205,15 @@ public:
     bool canUndo()const;
     bool canRedo()const;
     QList<int> alternativeBranchesIds()const;
+    qulonglong getPayloadSize()const;
+    qulonglong getRedoPayloadSize()const;
+    void replacePayloadSpans(const SpanReplacer &replacer);
+    std::shared_ptr<AbstractUndoAction> getUndoStepAction()const;
+    std::shared_ptr<AbstractUndoAction> getRedoStepAction()const;
+    QList<std::shared_ptr<AbstractUndoAction>> getHistory()const;
+    int getHistoryLength()const;
+    std::shared_ptr<AbstractUndoAction> getHistoryAction(int index)const;
+    bool dropOldest(qulonglong *dropped_payload);
 
 private:
     QList<std::shared_ptr<AbstractUndoAction>> _subActions;
@@ -1,6 +1,9 @@
 #include "matcher.h"
 #include "document.h"
 #include <QDebug>
+#include <QQueue>
+#include <algorithm>
+#include <cstring>
 
 int MATCHER_BUFFER_SIZE = 1024 * 1024;
 
@@ -17,6 +20,11 @@ BinaryFinder::BinaryFinder(const std::shared_ptr<Document> &doc, const QByteArra
     for (int j = findWhat.length() - 1; j >= 0; --j) {
         _reversedOffsetTable[(unsigned char)findWhat[j]] = j + 1;
     }
+
+    _shiftTable.fill(findWhat.length(), 256);
+    for (int j = 0; j < findWhat.length() - 1; ++j) {
+        _shiftTable[(unsigned char)findWhat[j]] = findWhat.length() - j - 1;
+    }
 }
 
 qulonglong BinaryFinder::findNext(qulonglong position, qulonglong limit, bool *found) {
@@ -123,3 +131,163 @@ qulonglong BinaryFinder::findPrevious(qulonglong position, qulonglong limit, boo
 
     return 0;
 }
+
+QList<FinderMatch> BinaryFinder::findAll(qulonglong from_position, qulonglong length) {
+    /** Returns all matches that start in range [from_position, from_position + length), sorted by position. Bytes
+     *  after the range are read only to complete matches starting inside it. Data is read past device caches, so
+     *  scanning large ranges does not evict pages other readers use.
+     **/
+
+    ReadLocker locker(_document->getLock());
+
+    QList<FinderMatch> result;
+    qulonglong document_length = _document->getLength();
+    if (_findWhat.isEmpty() || from_position >= document_length || !length) {
+        return result;
+    }
+
+    qulonglong pattern_length = _findWhat.length();
+    qulonglong range_end = document_length - from_position < length ? document_length : from_position + length;
+    qulonglong scan_end = std::min(document_length, range_end + pattern_length - 1);
+
+    qulonglong buffer_size = std::max(qulonglong(MATCHER_BUFFER_SIZE), pattern_length * 2);
+    QByteArray buffer(int(std::min(buffer_size, scan_end - from_position)), 0);
+    const unsigned char *buffer_data = reinterpret_cast<const unsigned char*>(buffer.constData());
+    const unsigned char *pattern_data = reinterpret_cast<const unsigned char*>(_findWhat.constData());
+    unsigned char last_pattern_byte = pattern_data[pattern_length - 1];
+
+    qulonglong buffer_start = from_position;
+    while (buffer_start < range_end) {
+        qulonglong bytes_read = _document->readInto(buffer_start, buffer.data(),
+                                                    std::min(qulonglong(buffer.length()), scan_end - buffer_start),
+                                                    false);
+        if (bytes_read < pattern_length) {
+            break;
+        }
+
+        qulonglong match_offset = 0;
+        while (match_offset + pattern_length <= bytes_read && buffer_start + match_offset < range_end) {
+            unsigned char last_byte = buffer_data[match_offset + pattern_length - 1];
+            if (last_byte == last_pattern_byte &&
+                    !std::memcmp(buffer_data + match_offset, pattern_data, pattern_length - 1)) {
+                result.append(FinderMatch(buffer_start + match_offset, int(pattern_length), 0));
+            }
+            match_offset += _shiftTable[last_byte];
+        }
+
+        // next buffer starts at first position that was not checked yet
+        buffer_start += match_offset;
+    }
+    return result;
+}
+
+MultiPatternFinder::MultiPatternFinder(const std::shared_ptr<Document> &doc, const QList<QByteArray> &patterns)
+    : _document(doc), _patterns(patterns), _maximalPatternLength(0) {
+    /** Builds Aho-Corasick automaton for given patterns. Transitions for all states are precalculated, so scanning
+     *  takes exactly one table lookup for each byte. Empty patterns are never matched.
+     **/
+
+    // build trie of patterns. State 0 is root.
+    _transitions.fill(-1, 256);
+    _outputs.resize(1);
+    for (int pattern_index = 0; pattern_index < patterns.length(); ++pattern_index) {
+        const QByteArray &pattern = patterns[pattern_index];
+        if (pattern.isEmpty()) {
+            continue;
+        }
+
+        int state = 0;
+        for (int j = 0; j < pattern.length(); ++j) {
+            int &next_state = _transitions[state * 256 + (unsigned char)pattern[j]];
+            if (next_state < 0) {
+                next_state = _outputs.size();
+                _outputs.resize(_outputs.size() + 1);
+                _transitions.resize(_transitions.size() + 256);
+                std::fill(_transitions.end() - 256, _transitions.end(), -1);
+            }
+            state = _transitions[state * 256 + (unsigned char)pattern[j]];
+        }
+        _outputs[state].append(pattern_index);
+        _maximalPatternLength = std::max(_maximalPatternLength, pattern.length());
+    }
+
+    // calculate failure links in breadth-first order and replace missing transitions with transitions of
+    // failure state, turning trie into automaton
+    QVector<int> failure(_outputs.size(), 0);
+    QQueue<int> states;
+    for (int byte = 0; byte < 256; ++byte) {
+        int &next_state = _transitions[byte];
+        if (next_state < 0) {
+            next_state = 0;
+        } else {
+            states.enqueue(next_state);
+        }
+    }
+
+    while (!states.isEmpty()) {
+        int state = states.dequeue();
+        _outputs[state] += _outputs[failure[state]];
+        for (int byte = 0; byte < 256; ++byte) {
+            int &next_state = _transitions[state * 256 + byte];
+            int failure_next_state = _transitions[failure[state] * 256 + byte];
+            if (next_state < 0) {
+                next_state = failure_next_state;
+            } else {
+                failure[next_state] = failure_next_state;
+                states.enqueue(next_state);
+            }
+        }
+    }
+}
+
+QList<FinderMatch> MultiPatternFinder::findAll(qulonglong from_position, qulonglong length) {
+    /** Returns all matches that start in range [from_position, from_position + length), sorted by position
+     *  and pattern index. Bytes after the range are read only to complete matches starting inside it.
+     **/
+
+    ReadLocker locker(_document->getLock());
+
+    QList<FinderMatch> result;
+    qulonglong document_length = _document->getLength();
+    if (!_maximalPatternLength || from_position >= document_length || !length) {
+        return result;
+    }
+
+    qulonglong range_end = document_length - from_position < length ? document_length : from_position + length;
+    qulonglong scan_end = std::min(document_length, range_end + _maximalPatternLength - 1);
+
+    QByteArray buffer(int(std::min(qulonglong(MATCHER_BUFFER_SIZE), scan_end - from_position)), 0);
+    const unsigned char *buffer_data = reinterpret_cast<const unsigned char*>(buffer.constData());
+    const int *transitions = _transitions.constData();
+
+    int state = 0;
+    qulonglong buffer_start = from_position;
+    while (buffer_start < scan_end) {
+        qulonglong bytes_read = _document->readInto(buffer_start, buffer.data(),
+                                                    std::min(qulonglong(buffer.length()), scan_end - buffer_start),
+                                                    false);
+        if (!bytes_read) {
+            break;
+        }
+
+        for (qulonglong j = 0; j < bytes_read; ++j) {
+            state = transitions[state * 256 + buffer_data[j]];
+            if (!_outputs[state].isEmpty()) {
+                for (int pattern_index : _outputs[state]) {
+                    qulonglong match_start = buffer_start + j + 1 - _patterns[pattern_index].length();
+                    if (match_start < range_end) {
+                        result.append(FinderMatch(match_start, _patterns[pattern_index].length(), pattern_index));
+                    }
+                }
+            }
+        }
+        buffer_start += bytes_read;
+    }
+
+    // automaton reports matches by positions of their last bytes
+    std::stable_sort(result.begin(), result.end(), [](const FinderMatch &first, const FinderMatch &second) {
+        return first.position < second.position ||
+                (first.position == second.position && first.patternIndex < second.patternIndex);
+    });
+    return result;
+}
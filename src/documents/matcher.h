@@ -2,24 +2,61 @@
 #define MATCHER_H
 
 #include <QByteArray>
+#include <QList>
+#include <QVector>
 #include <memory>
 #include "base.h"
 
 class Document;
 
 
+class FinderMatch {
+public:
+    FinderMatch() : position(), length(), patternIndex(-1) {
+
+    }
+
+    FinderMatch(qulonglong position, int length, int pattern_index)
+        : position(position), length(length), patternIndex(pattern_index) {
+
+    }
+
+    qulonglong position;
+    int length;
+    int patternIndex;
+};
+
+
 class BinaryFinder {
 public:
     BinaryFinder(const std::shared_ptr<Document> &doc, const QByteArray &findWhat);
 
     qulonglong findNext(qulonglong from_position, qulonglong limit=QULONGLONG_MAX, bool *found=nullptr);
     qulonglong findPrevious(qulonglong from_position, qulonglong limit=QULONGLONG_MAX, bool *found=nullptr);
+    QList<FinderMatch> findAll(qulonglong from_position, qulonglong length);
 
 private:
     std::shared_ptr<Document> _document;
     QByteArray _findWhat;
     QByteArray _offsetTable;
     QByteArray _reversedOffsetTable;
+    QVector<int> _shiftTable; // shift of pattern by last byte under it, for Boyer-Moore-Horspool search
+};
+
+
+class MultiPatternFinder {
+public:
+    MultiPatternFinder(const std::shared_ptr<Document> &doc, const QList<QByteArray> &patterns);
+
+    QList<FinderMatch> findAll(qulonglong from_position, qulonglong length);
+    int getMaximalPatternLength()const { return _maximalPatternLength; }
+
+private:
+    std::shared_ptr<Document> _document;
+    QList<QByteArray> _patterns;
+    int _maximalPatternLength;
+    QVector<int> _transitions; // 256 transitions for each automaton state
+    QVector<QVector<int>> _outputs; // indexes of patterns that end in each state
 };
 
 
@@ -114,8 +114,12 @@ bool ReadWriteLock::_acquireWrite(bool blocking, int timeout) {
         } else {
             QTime counter;
             counter.start();
-            while (!(ok = _canWriteNow()) || timeout < 0 || counter.elapsed() < timeout) {
-                _canWriteCondition.wait(_mutex.get(), std::max(0, timeout - counter.elapsed()));
+            while (!(ok = _canWriteNow())) {
+                if (timeout >= 0 && counter.elapsed() >= timeout) {
+                    break;
+                }
+                _canWriteCondition.wait(_mutex.get(), timeout >= 0 ? std::max(0, timeout - counter.elapsed())
+                                                             : -1);
             }
         }
 
@@ -16,6 +16,20 @@ public:
     }
 };
 
+class SharedDataView {
+public:
+    SharedDataView(const DataView &view) : _view(view) {
+
+    }
+
+    const char *getData()const { return _view.data.constData(); }
+    qulonglong getLength()const { return _view.data.length(); }
+
+private:
+    DataView _view;
+};
+
+
 class WrappedBase {
 public:
     virtual ~WrappedBase() { }
@@ -93,7 +107,9 @@ public:
     }
 
     qulonglong getLength()const { return _wrapped->getLength(); }
-    QByteArray read(qulonglong offset, qulonglong length)const { return _wrapped->read(offset, length); }
+    QByteArray read(qulonglong offset, qulonglong length)const {
+        return detachedData(_wrapped->read(offset, length));
+    }
 };
 
 
@@ -138,14 +154,29 @@ public:
     bool isReadOnly()const { return wrapped()->isReadOnly(); }
     qulonglong getLength()const { return wrapped()->getLength(); }
     const LoadOptions &getLoadOptions()const { return wrapped()->getLoadOptions(); }
+    bool isMapped()const { return wrapped()->isMapped(); }
 
-    QByteArray read(qulonglong position, qulonglong length)const { return wrapped()->read(position, length); }
-    QByteArray readAll()const { return wrapped()->readAll(); }
+    QByteArray read(qulonglong position, qulonglong length)const {
+        return detachedData(wrapped()->read(position, length));
+    }
+    QByteArray readAll()const { return detachedData(wrapped()->readAll()); }
+    qulonglong readInto(qulonglong position, char *buffer, qulonglong length)const {
+        return wrapped()->readInto(position, buffer, length);
+    }
+    SharedDataView view(qulonglong position, qulonglong length)const {
+        // data that cannot be viewed without copying is copied
+        DataView data_view = wrapped()->view(position, length);
+        return data_view.isNull() ? DataView(detachedData(wrapped()->read(position, length)), nullptr) : data_view;
+    }
     qulonglong write(qulonglong position, const QByteArray &data) { return wrapped()->write(position, data); }
     void resize(qulonglong new_size) { wrapped()->resize(new_size); }
 
     qulonglong getCacheSize()const { return wrapped()->getCacheSize(); }
     void setCacheSize(qulonglong new_cache_size) { wrapped()->setCacheSize(new_cache_size); }
+    qulonglong getPageSize()const { return wrapped()->getPageSize(); }
+    void setPageSize(qulonglong new_page_size) { wrapped()->setPageSize(new_page_size); }
+    CacheStats getCacheStats()const { return wrapped()->getCacheStats(); }
+    void resetCacheStats() { wrapped()->resetCacheStats(); }
 };
 
 
@@ -194,8 +225,18 @@ public:
     void setSpans(const SharedSpanList &spans) { wrapped()->setSpans(_toList(spans)); }
     void clear() { wrapped()->clear(); }
 
-    QByteArray read(qulonglong offset, qulonglong length)const { return wrapped()->read(offset, length); }
-    QByteArray readAll()const { return wrapped()->readAll(); }
+    QByteArray read(qulonglong offset, qulonglong length)const {
+        return detachedData(wrapped()->read(offset, length));
+    }
+    QByteArray readAll()const { return detachedData(wrapped()->readAll()); }
+    qulonglong readInto(qulonglong position, char *buffer, qulonglong length)const {
+        return wrapped()->readInto(position, buffer, length);
+    }
+    SharedDataView view(qulonglong position, qulonglong length)const {
+        // data that cannot be viewed without copying is copied
+        DataView data_view = wrapped()->view(position, length);
+        return data_view.isNull() ? DataView(detachedData(wrapped()->read(position, length)), nullptr) : data_view;
+    }
     SharedSpanList spansInRange(qulonglong offset, qulonglong length, qulonglong *left_offset=0,
                           qulonglong *right_offset=0)const {
         return _toSharedList(wrapped()->spansInRange(offset, length, left_offset, right_offset));
@@ -271,8 +312,18 @@ public:
     bool isReadOnly()const { return wrapped()->isReadOnly(); }
     void setReadOnly(bool r) { wrapped()->setReadOnly(r); }
 
-    QByteArray read(qulonglong position, qulonglong length)const { return wrapped()->read(position, length); }
-    QByteArray readAll()const { return wrapped()->readAll(); }
+    QByteArray read(qulonglong position, qulonglong length)const {
+        return detachedData(wrapped()->read(position, length));
+    }
+    QByteArray readAll()const { return detachedData(wrapped()->readAll()); }
+    qulonglong readInto(qulonglong position, char *buffer, qulonglong length)const {
+        return wrapped()->readInto(position, buffer, length);
+    }
+    SharedDataView view(qulonglong position, qulonglong length)const {
+        // data that cannot be viewed without copying is copied
+        DataView data_view = wrapped()->view(position, length);
+        return data_view.isNull() ? DataView(detachedData(wrapped()->read(position, length)), nullptr) : data_view;
+    }
 
     void insertSpan(qulonglong position, const SharedAbstractSpan &span, char fill_byte=0) {
         wrapped()->insertSpan(position, span.wrapped(), fill_byte);
@@ -301,10 +352,20 @@ public:
     bool canUndo()const { return wrapped()->canUndo(); }
     bool canRedo()const { return wrapped()->canRedo(); }
     QList<int> getAlternativeBranchesIds()const { return wrapped()->getAlternativeBranchesIds(); }
+    int getCoalesceInterval()const { return wrapped()->getCoalesceInterval(); }
+    void setCoalesceInterval(int interval) { wrapped()->setCoalesceInterval(interval); }
+    qulonglong getUndoMemoryBudget()const { return wrapped()->getUndoMemoryBudget(); }
+    void setUndoMemoryBudget(qulonglong budget) { wrapped()->setUndoMemoryBudget(budget); }
+    bool isUndoSpillEnabled()const { return wrapped()->isUndoSpillEnabled(); }
+    void setUndoSpillEnabled(bool enabled) { wrapped()->setUndoSpillEnabled(enabled); }
+    qulonglong getUndoMemoryUsage()const { return wrapped()->getUndoMemoryUsage(); }
 
     void save(const SharedAbstractDevice *write_device=nullptr, bool switch_devices=false) {
         wrapped()->save(write_device ? write_device->wrapped() : std::shared_ptr<AbstractDevice>(), switch_devices);
     }
+    bool isSaving()const { return wrapped()->isSaving(); }
+    bool canCancelSave()const { return wrapped()->canCancelSave(); }
+    void cancelSave() { wrapped()->cancelSave(); }
 
     SharedSpanChain exportRange(qulonglong position, qulonglong length, int ram_limit=-1)const {
         return wrapped()->exportRange(position, length, ram_limit);
@@ -321,6 +382,7 @@ signals:
     void urlChanged(const QUrl &);
     void readOnlyChanged(bool);
     void fixedSizeChanged(bool);
+    void saveProgress(qulonglong, qulonglong);
 
 private:
     void connectSignals() {
@@ -342,6 +404,11 @@ private:
         DO_CONNECT(readOnlyChanged(bool));
         DO_CONNECT(fixedSizeChanged(bool));
 
+        // progress is reported from thread that saves document, so slots connected with Qt::DirectConnection can
+        // cancel save from this thread
+        connect(w, SIGNAL(saveProgress(qulonglong, qulonglong)), this, SIGNAL(saveProgress(qulonglong, qulonglong)),
+                Qt::DirectConnection);
+
     #undef DO_CONNECT
     }
 };
@@ -365,6 +432,25 @@ public:
     qulonglong findPrevious(qulonglong from_position, qulonglong limit, bool *ok) {
         return wrapped()->findPrevious(from_position, limit, ok);
     }
+
+    QList<FinderMatch> findAll(qulonglong from_position, qulonglong length) {
+        return wrapped()->findAll(from_position, length);
+    }
+};
+
+
+class SharedMultiPatternFinder : public SharedWrapBase<MultiPatternFinder> {
+public:
+    SharedMultiPatternFinder(const SharedDocument &document, const QList<QByteArray> &patterns) :
+        SharedWrapBase(std::make_shared<MultiPatternFinder>(document.wrapped(), patterns)) {
+
+    }
+
+    QList<FinderMatch> findAll(qulonglong from_position, qulonglong length) {
+        return wrapped()->findAll(from_position, length);
+    }
+
+    int getMaximalPatternLength()const { return wrapped()->getMaximalPatternLength(); }
 };
 
 
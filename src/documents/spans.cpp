@@ -1,5 +1,6 @@
 #include "spans.h"
 #include <climits>
+#include <cstring>
 #include <exception>
 #include <memory>
 #include "chain.h"
@@ -17,6 +18,22 @@ void AbstractSpan::put(const std::shared_ptr<AbstractSaver> &saver) const {
     saver->putSpan(shared_from_this());
 }
 
+void AbstractSpan::readInto(qulonglong offset, char *buffer, qulonglong length, bool) const {
+    /** Copies :length: bytes starting from :offset: into :buffer:, which should be large enough to hold them.
+     *  If :use_cache: is false, data of devices is read past their caches. Default implementation copies data
+     *  returned by AbstractSpan::read.
+     **/
+    QByteArray data = read(offset, length);
+    std::memcpy(buffer, data.constData(), data.length());
+}
+
+DataView AbstractSpan::view(qulonglong, qulonglong) const {
+    /** Returns view of :length: bytes starting from :offset: without copying them, if span can do it.
+     *  Default implementation returns null view.
+     **/
+    return DataView();
+}
+
 bool AbstractSpan::_isRangeValid(qulonglong offset, qulonglong size)const {
     return offset < this->getLength() && offset + size <= this->getLength();
 }
@@ -34,6 +51,21 @@ QByteArray DataSpan::read(qulonglong offset, qulonglong length) const {
     return _data.mid(int(offset), int(length));
 }
 
+void DataSpan::readInto(qulonglong offset, char *buffer, qulonglong length, bool) const {
+    if (!_isRangeValid(offset, length)) {
+        throw OutOfBoundsError();
+    }
+    std::memcpy(buffer, _data.constData() + offset, length);
+}
+
+DataView DataSpan::view(qulonglong offset, qulonglong length) const {
+    if (!_isRangeValid(offset, length)) {
+        throw OutOfBoundsError();
+    }
+    // data of DataSpan is never changed, so it remains valid while span is alive
+    return DataView(QByteArray::fromRawData(_data.constData() + offset, int(length)), shared_from_this());
+}
+
 QPair<std::shared_ptr<AbstractSpan>, std::shared_ptr<AbstractSpan>> DataSpan::split(qulonglong offset) const {
     if (offset == 0 || offset >= getLength()) {
         throw OutOfBoundsError();
@@ -60,6 +92,13 @@ QByteArray FillSpan::read(qulonglong offset, qulonglong length) const {
     return QByteArray(length, _fillByte);
 }
 
+void FillSpan::readInto(qulonglong offset, char *buffer, qulonglong length, bool) const {
+    if (!_isRangeValid(offset, length)) {
+        throw OutOfBoundsError();
+    }
+    std::memset(buffer, _fillByte, length);
+}
+
 QPair<std::shared_ptr<AbstractSpan>, std::shared_ptr<AbstractSpan>> FillSpan::split(qulonglong offset) const {
     if (offset == 0 || offset >= getLength()) {
         throw OutOfBoundsError();
@@ -100,6 +139,24 @@ QByteArray PrimitiveDeviceSpan::read(qulonglong offset, qulonglong length) const
     }
 }
 
+void PrimitiveDeviceSpan::readInto(qulonglong offset, char *buffer, qulonglong length, bool use_cache) const {
+    if (!_isRangeValid(offset, length) || offset >= _device->getLength() || _device->getLength() - length < offset) {
+        throw OutOfBoundsError();
+    }
+
+    qulonglong read_bytes_count = _device->readInto(_deviceOffset + offset, buffer, length, use_cache);
+    if (read_bytes_count < length) {
+        std::memset(buffer + read_bytes_count, 0, length - read_bytes_count);
+    }
+}
+
+DataView PrimitiveDeviceSpan::view(qulonglong offset, qulonglong length) const {
+    if (!_isRangeValid(offset, length)) {
+        throw OutOfBoundsError();
+    }
+    return _device->view(_deviceOffset + offset, length);
+}
+
 QPair<std::shared_ptr<AbstractSpan>, std::shared_ptr<AbstractSpan> > PrimitiveDeviceSpan::split(qulonglong offset) const {
     if (!offset || offset >= getLength()) {
         throw OutOfBoundsError();
@@ -143,6 +200,20 @@ QByteArray DeviceSpan::read(qulonglong offset, qulonglong length) const {
     return _chain->read(offset, length);
 }
 
+void DeviceSpan::readInto(qulonglong offset, char *buffer, qulonglong length, bool use_cache) const {
+    if (!_isRangeValid(offset, length)) {
+        throw OutOfBoundsError();
+    }
+    _chain->readInto(offset, buffer, length, use_cache);
+}
+
+DataView DeviceSpan::view(qulonglong offset, qulonglong length) const {
+    if (!_isRangeValid(offset, length)) {
+        throw OutOfBoundsError();
+    }
+    return _chain->view(offset, length);
+}
+
 QPair<std::shared_ptr<AbstractSpan>, std::shared_ptr<AbstractSpan> > DeviceSpan::split(qulonglong offset) const {
     if (!offset || offset >= getLength()) {
         throw OutOfBoundsError();
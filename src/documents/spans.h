@@ -6,6 +6,8 @@
 #include <QObject>
 #include <QMetaType>
 #include <memory>
+#include <functional>
+#include "base.h"
 
 class SpanChain;
 class AbstractDevice;
@@ -13,6 +15,7 @@ class AbstractSaver;
 class AbstractSpan;
 
 typedef QList<std::shared_ptr<AbstractSpan>> SpanList;
+typedef std::function<std::shared_ptr<AbstractSpan>(const std::shared_ptr<AbstractSpan> &)> SpanReplacer;
 
 class AbstractSpan : public QObject, public std::enable_shared_from_this<AbstractSpan> {
     Q_OBJECT
@@ -22,6 +25,8 @@ public:
 
     virtual qulonglong getLength()const = 0;
     virtual QByteArray read(qulonglong offset, qulonglong length)const = 0;
+    virtual void readInto(qulonglong offset, char *buffer, qulonglong length, bool use_cache=true)const;
+    virtual DataView view(qulonglong offset, qulonglong length)const;
     virtual QPair<std::shared_ptr<AbstractSpan>, std::shared_ptr<AbstractSpan>> split(qulonglong offset)const = 0;
     virtual void put(const std::shared_ptr<AbstractSaver> &saver)const;
 
@@ -39,6 +44,8 @@ public:
 
     qulonglong getLength()const { return _data.length(); }
     QByteArray read(qulonglong offset, qulonglong length)const;
+    void readInto(qulonglong offset, char *buffer, qulonglong length, bool use_cache=true)const;
+    DataView view(qulonglong offset, qulonglong length)const;
     QPair<std::shared_ptr<AbstractSpan>, std::shared_ptr<AbstractSpan>> split(qulonglong offset)const;
 
 private:
@@ -52,7 +59,9 @@ public:
 
     qulonglong getLength()const;
     QByteArray read(qulonglong offset, qulonglong length)const;
+    void readInto(qulonglong offset, char *buffer, qulonglong length, bool use_cache=true)const;
     QPair<std::shared_ptr<AbstractSpan>, std::shared_ptr<AbstractSpan>> split(qulonglong offset)const;
+    char getFillByte()const { return _fillByte; }
 
 private:
     char _fillByte;
@@ -67,6 +76,8 @@ public:
 
     qulonglong getLength()const;
     QByteArray read(qulonglong offset, qulonglong length)const;
+    void readInto(qulonglong offset, char *buffer, qulonglong length, bool use_cache=true)const;
+    DataView view(qulonglong offset, qulonglong length)const;
     QPair<std::shared_ptr<AbstractSpan>, std::shared_ptr<AbstractSpan>> split(qulonglong offset)const;
 
     std::shared_ptr<const AbstractDevice> getDevice()const { return _device; }
@@ -93,6 +104,8 @@ public:
 
     qulonglong getLength()const;
     QByteArray read(qulonglong offset, qulonglong length)const;
+    void readInto(qulonglong offset, char *buffer, qulonglong length, bool use_cache=true)const;
+    DataView view(qulonglong offset, qulonglong length)const;
     QPair<std::shared_ptr<AbstractSpan>, std::shared_ptr<AbstractSpan>> split(qulonglong offset)const;
 
     QMap<std::shared_ptr<PrimitiveDeviceSpan>, qulonglong> getPrimitives()const;
@@ -7,6 +7,11 @@ _is_registered = False
 App_Translation = 'app.translation'
 App_DefaultErrorPolicy = 'app.default_error_policy'
 App_PoolOperationLimit = 'app.pool_operation_limit'
+App_PoolGroupOperationLimit = 'app.pool_group_operation_limit'
+App_PersistSearchIndex = 'app.persist_search_index'
+App_UndoCoalesceInterval = 'app.undo_coalesce_interval'
+App_UndoMemoryBudget = 'app.undo_memory_budget'
+App_UndoLimitPolicy = 'app.undo_limit_policy'
 IntegerEdit_Uppercase = 'integeredit.uppercase'
 IntegerEdit_DefaultStyle = 'integeredit.default_style'
 HexWidget_ShowHeader = 'hexwidget.show_header'
@@ -35,6 +40,11 @@ def doRegister():
             (App_Translation, '', str),
             (App_DefaultErrorPolicy, 'ask', str),
             (App_PoolOperationLimit, 10, int),
+            (App_PoolGroupOperationLimit, 2, int),
+            (App_PersistSearchIndex, False, bool),
+            (App_UndoCoalesceInterval, 1000, int),
+            (App_UndoMemoryBudget, 256 * 1024 * 1024, int),
+            (App_UndoLimitPolicy, 'spill', str),
             (HexWidget_DefaultTheme, dict(), dict),
             (HexWidget_AlternatingRows, True, bool),
             (HexWidget_Font, ('Ubuntu Mono,13,-1,5,50,0,0,0,0,0',
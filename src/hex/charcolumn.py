@@ -18,12 +18,23 @@ class CharColumnModel(models.RegularColumnModel):
     ReplacementCharacter = '·'
 
     def __init__(self, document, codec, render_font, bytes_on_row=16):
-        self.codec = codec
+        self._codec = codec
         self._bytesOnRow = bytes_on_row
         self._renderFont = QRawFont.fromFont(render_font)
+        self._translations = None
+        self._frameCharacters = None
         models.RegularColumnModel.__init__(self, document, delegate_type=CharColumnEditDelegate)
         self.reset()
 
+    @property
+    def codec(self):
+        return self._codec
+
+    @codec.setter
+    def codec(self, new_codec):
+        self._codec = new_codec
+        self._translations = None
+
     @property
     def regularDataSize(self):
         return self.codec.unitSize
@@ -40,6 +51,7 @@ class CharColumnModel(models.RegularColumnModel):
         # number of bytes on row should be multiplier of codec.unitSize
         if self._bytesOnRow % self.codec.unitSize:
             raise ValueError('number of bytes on row should be multiplier of encoding unit size')
+        self._translations = None
         models.ColumnModel.reset(self)
 
     @property
@@ -53,25 +65,84 @@ class CharColumnModel(models.RegularColumnModel):
         self._renderFont = new_font
         self.reset()
 
+    def decodeRow(self, document_data, role=Qt.DisplayRole):
+        """Converts :document_data: to string with exactly one character for each byte, as it should be displayed
+        in column (for Qt.DisplayRole) or edited (for Qt.EditRole). Works only for encodings which characters can be
+        decoded from single bytes, returns None for other encodings.
+        """
+        translations = self._lookupTranslations()
+        if translations is None:
+            return None
+        return bytes(document_data).decode('latin-1').translate(translations[0 if role == Qt.DisplayRole else 1])
+
+    def characterDataRange(self, start, length):
+        """Same as codec.decodeRange for model document, but uses characters decoded for current frame if possible.
+        """
+        if self._frameCharacters is not None:
+            frame_start, frame_characters = self._frameCharacters
+            unit_size = self.codec.unitSize
+            if frame_start <= start and start + length <= frame_start + len(frame_characters) * unit_size and \
+                            (start - frame_start) % unit_size == 0:
+                first = (start - frame_start) // unit_size
+                return frame_characters[first:first + (length + unit_size - 1) // unit_size]
+        return self.codec.decodeRange(self.document, start, length)
+
+    def rowsData(self, first_row, count):
+        if self.document is None or self._lookupTranslations() is not None:
+            return models.RegularColumnModel.rowsData(self, first_row, count)
+
+        # decode all characters in frame at once, texts and flags for indexes will be taken from this list
+        frame_start = first_row * self.bytesOnRow
+        with utils.readlock(self.document.lock):
+            frame_length = max(0, min(self.document.length, frame_start + count * self.bytesOnRow) - frame_start)
+            self._frameCharacters = (frame_start, self.codec.decodeRange(self.document, frame_start, frame_length))
+            try:
+                return models.RegularColumnModel.rowsData(self, first_row, count)
+            finally:
+                self._frameCharacters = None
+
+    def textsForDocumentData(self, document_data, indexes, role=Qt.DisplayRole):
+        if (role == Qt.DisplayRole or role == Qt.EditRole) and indexes:
+            decoded = self.decodeRow(document_data[:len(indexes)], role)
+            if decoded is not None and len(decoded) == len(indexes):
+                return list(decoded)
+
+            first_position = indexes[0].documentPosition
+            characters = self.characterDataRange(first_position, len(indexes) * self.codec.unitSize)
+            return [self._textForCharacterData(char_data, first_position + j * self.codec.unitSize, role)
+                    for j, char_data in enumerate(characters)]
+        return models.RegularColumnModel.textsForDocumentData(self, document_data, indexes, role)
+
     def textForDocumentData(self, document_data, index, role=Qt.DisplayRole):
         if role == Qt.DisplayRole or role == Qt.EditRole:
-            try:
-                position = index.documentPosition
-                char_data = self.codec.getCharacterData(self.document, position)
-                if char_data.startPosition != position:
-                    return ' '
-                else:
-                    return self._translateToVisualCharacter(char_data.unicode)
-            except encodings.EncodingError:
-                return '!' if role == Qt.DisplayRole else self.ReplacementCharacter
+            if document_data is not None and len(document_data) == 1:
+                decoded = self.decodeRow(document_data, role)
+                if decoded is not None:
+                    return decoded
+
+            position = index.documentPosition
+            return self._textForCharacterData(self.characterDataRange(position, self.codec.unitSize)[0], position,
+                                              role)
+
+    def _textForCharacterData(self, char_data, position, role):
+        if char_data.error is not None:
+            return '!' if role == Qt.DisplayRole else self.ReplacementCharacter
+        elif char_data.startPosition != position:
+            return ' '
+        else:
+            return self._translateToVisualCharacter(char_data.unicode)
 
     def indexFlags(self, index):
-        flags = models.RegularColumnModel.indexFlags(self, index)
-        try:
-            self.codec.getCharacterData(self.document, index.documentPosition)
-        except encodings.EncodingError:
-            flags |= self.FlagBroken
-        return flags
+        return models.RegularColumnModel.indexFlags(self, index) | self.flagsForDocumentData(None, index)
+
+    def flagsForDocumentData(self, document_data, index):
+        if document_data:
+            translations = self._lookupTranslations()
+            if translations is not None:
+                return self.FlagBroken if translations[2][document_data[0]] else 0
+
+        char_data = self.characterDataRange(index.documentPosition, self.codec.unitSize)[0]
+        return self.FlagBroken if char_data.error is not None else 0
 
     def _dataForNewIndex(self, input_text, before_index):
         # check if input is correct
@@ -95,6 +166,24 @@ class CharColumnModel(models.RegularColumnModel):
         if raw_data != current_data:
             self.document.writeSpan(position, documents.DataSpan(raw_data))
 
+    def _lookupTranslations(self):
+        """Returns tuple of (display translation, edit translation, broken flags) for single-byte encodings. Tables
+        depend on codec and render font and are built again after any of them changes."""
+        if self._translations is None:
+            decode_table = self.codec.decodeTable
+            if decode_table is None:
+                return None
+            display_translation, edit_translation, broken = {}, {}, []
+            for byte, char in enumerate(decode_table):
+                if char is None:
+                    display_translation[byte] = '!'
+                    edit_translation[byte] = self.ReplacementCharacter
+                else:
+                    display_translation[byte] = edit_translation[byte] = self._translateToVisualCharacter(char)
+                broken.append(char is None)
+            self._translations = (display_translation, edit_translation, broken)
+        return self._translations
+
     def _translateToVisualCharacter(self, text):
         result = ''
         for char in text:
@@ -121,20 +210,17 @@ class CharColumnModel(models.RegularColumnModel):
 
 
 class CharColumnEditDelegate(models.StandardEditDelegate):
+    # maximal number of bytes character in any supported encoding can occupy
+    _MaximalCharacterSize = 6
+
     @property
     def nextEditIndex(self):
         if not self.index:
             return models.ModelIndex()
 
-        codec = self.index.model.codec
-        document = self.index.model.document
         position = self.index.documentPosition
-        try:
-            char_data = codec.getCharacterData(document, position)
-        except encodings.EncodingError:
-            return self.index.next
-
-        if char_data.startPosition != position:
+        char_data = self.index.model.characterDataRange(position, self.index.model.codec.unitSize)[0]
+        if char_data.error is not None or char_data.startPosition != position:
             return self.index.next
         else:
             return self.index.model.indexFromPosition(position + char_data.bytesCount)
@@ -144,23 +230,28 @@ class CharColumnEditDelegate(models.StandardEditDelegate):
         if not self.index:
             return models.ModelIndex()
 
-        codec = self.index.model.codec
-        document = self.index.model.document
-        try:
-            position = codec.findCharacterStart(document, self.index.documentPosition)
-            if position <= 0:
-                return models.ModelIndex()
-            elif position != self.index.documentPosition:
-                return self.index.previous
-        except encodings.EncodingError:
+        # decode both current and previous characters at once: window should contain start of current character
+        # and start of character before it
+        unit_size = self.index.model.codec.unitSize
+        position = self.index.documentPosition
+        window_start = max(0, position - (self._MaximalCharacterSize * 2 // unit_size) * unit_size)
+        characters = self.index.model.characterDataRange(window_start, position + unit_size - window_start)
+
+        char_data = characters[-1]
+        if char_data.error is not None:
             return self.index.previous
-        prev_char_byte = position - 1
+        character_start = char_data.startPosition
+        if character_start <= 0:
+            return models.ModelIndex()
+        elif character_start != position:
+            return self.index.previous
+        prev_char_byte = character_start - 1
 
-        try:
-            character_start = codec.findCharacterStart(document, prev_char_byte)
-            return self.index.model.indexFromPosition(character_start)
-        except encodings.EncodingError:
+        # characters list has item only for each unit, so take unit that contains previous byte
+        prev_char_data = characters[(prev_char_byte - window_start) // unit_size]
+        if prev_char_data.error is not None:
             return self.index.model.indexFromPosition(prev_char_byte)
+        return self.index.model.indexFromPosition(prev_char_data.startPosition)
 
 
 class CharColumnValidator(QValidator):
@@ -18,6 +18,33 @@ class CharacterData(object):
         self.startPosition = -1
         self.bytesCount = -1
         self.documentData = b''
+        self.error = None
+
+    @staticmethod
+    def fromError(document, position, error):
+        d = CharacterData()
+        d.document = document
+        d.startPosition = position
+        d.error = error
+        return d
+
+
+class _DocumentWindow(object):
+    """Reads data from document once and serves reads from this data. Reads outside of window are passed
+    to document.
+    """
+
+    def __init__(self, document, start, length):
+        self.document = document
+        self.start = start
+        self.data = bytes(document.view(start, length))
+        self.atEnd = len(self.data) < length
+
+    def read(self, position, length):
+        offset = position - self.start
+        if offset >= 0 and (offset + length <= len(self.data) or self.atEnd):
+            return self.data[offset:offset + length]
+        return self.document.read(position, length)
 
 
 class AbstractCodec(object):
@@ -74,6 +101,41 @@ class AbstractCodec(object):
         """
         raise NotImplementedError()
 
+    @property
+    def contextSize(self):
+        """Returns tuple (before, after) with maximal number of bytes before and after position that
+        getCharacterData can read to decode character at this position.
+        """
+        return 0, self.unitSize
+
+    def decodeRange(self, document, start, length):
+        """Returns list of CharacterData objects for each unit in range of :length: bytes starting at :start:
+        (item for position p has index (p - start) // unitSize). Data is read from document only once.
+        Instead of raising EncodingError for units that cannot be decoded, CharacterData
+        with .error attribute set to raised exception is returned for it.
+        """
+        before, after = self.contextSize
+        window_start = max(0, start - before)
+        window = _DocumentWindow(document, window_start, start + length + after - window_start)
+
+        result = []
+        for position in range(start, start + length, self.unitSize):
+            try:
+                char_data = self.getCharacterData(window, position)
+                char_data.document = document
+            except EncodingError as err:
+                char_data = CharacterData.fromError(document, position, err)
+            result.append(char_data)
+        return result
+
+    @property
+    def decodeTable(self):
+        """Returns list of 256 strings where each item is character that single byte with corresponding value is
+        decoded to, or None if this byte cannot be decoded. Returns None for encodings where characters
+        cannot be decoded from single bytes.
+        """
+        return None
+
     def getCharacterData(self, document, position):
         """Returns CharacterData object that describes properties of character that
         includes byte at :position: in :document:
@@ -101,6 +163,7 @@ class QtProxyCodec(AbstractCodec):
 class SingleByteEncodingCodec(QtProxyCodec):
     def __init__(self, codec, name):
         QtProxyCodec.__init__(self, codec, name)
+        self._decodeTable = None
 
     @property
     def fixedSize(self):
@@ -117,6 +180,16 @@ class SingleByteEncodingCodec(QtProxyCodec):
     def encodeString(self, text):
         return self._qcodec.fromUnicode(text)
 
+    @property
+    def decodeTable(self):
+        if self._decodeTable is None:
+            table = []
+            for byte in range(256):
+                decoded = self._qcodec.toUnicode(bytes((byte,)))
+                table.append(decoded if len(decoded) == 1 else None)
+            self._decodeTable = table
+        return self._decodeTable
+
     def getCharacterData(self, document, position):
         d = CharacterData()
         data = document.read(position, 1)
@@ -154,6 +227,10 @@ class Utf16Codec(QtProxyCodec):
     def unitSize(self):
         return 2
 
+    @property
+    def contextSize(self):
+        return 2, 4
+
     def encodeString(self, text):
         # looks like QTextCodec adds BOM before converted string. It is not what we want.
         converted = self._qcodec.fromUnicode(text)
@@ -315,6 +392,74 @@ class Utf8Codec(QtProxyCodec):
 
         return d
 
+    @property
+    def contextSize(self):
+        return 5, 6
+
+    def decodeRange(self, document, start, length):
+        window_start = max(0, start - 5)
+        data = bytes(document.view(window_start, start + length + 5 - window_start))
+
+        result = []
+        decoded = dict()  # maps offset of first octet in data to CharacterData or exception
+        last_first_octet = -1
+        for offset in range(min(len(data), start + length - window_start)):
+            byte = data[offset]
+            if not (byte & 0x80):
+                first_byte_index = offset
+            elif (byte & 0xc0) == 0xc0:
+                first_byte_index = last_first_octet = offset
+            elif last_first_octet >= 0 and offset - last_first_octet <= 5:
+                first_byte_index = last_first_octet
+            else:
+                first_byte_index = -1
+
+            position = window_start + offset
+            if position < start:
+                continue
+
+            if first_byte_index < 0:
+                char_data = EncodingError('invalid utf-8 sequence: failed to find first octet')
+            else:
+                char_data = decoded.get(first_byte_index)
+                if char_data is None:
+                    char_data = self._decodeSequence(document, data, window_start, first_byte_index)
+                    decoded[first_byte_index] = char_data
+
+            if isinstance(char_data, EncodingError):
+                char_data = CharacterData.fromError(document, position, char_data)
+            result.append(char_data)
+
+        while len(result) < length:
+            result.append(CharacterData.fromError(document, start + len(result), PartialCharacterError()))
+
+        return result
+
+    def _decodeSequence(self, document, data, data_start, first_byte_index):
+        d = CharacterData()
+        d.document = document
+        d.startPosition = data_start + first_byte_index
+
+        first_byte = data[first_byte_index]
+        if (first_byte & 0xfc) == 0xfc:
+            d.bytesCount = 6
+        elif (first_byte & 0xf8) == 0xf8:
+            d.bytesCount = 5
+        elif (first_byte & 0xf0) == 0xf0:
+            d.bytesCount = 4
+        elif (first_byte & 0xe0) == 0xe0:
+            d.bytesCount = 3
+        elif (first_byte & 0xc0) == 0xc0:
+            d.bytesCount = 2
+        else:
+            d.bytesCount = 1
+
+        d.documentData = data[first_byte_index:first_byte_index + d.bytesCount]
+        d.unicode = self._qcodec.toUnicode(d.documentData)
+        if len(d.unicode) != 1:
+            return EncodingError('failed to decode utf-8 sequence')
+        return d
+
     def encodeString(self, text):
         encoded = self._qcodec.fromUnicode(text)
         if len(encoded) > 3 and encoded.startswith('\xef\xbb\xbf'):
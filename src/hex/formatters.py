@@ -32,10 +32,18 @@ class IntegerFormatter(object):
         elif self.style == self.StyleAsm:
             return 'asm'
 
+    # bases that can be formatted by builtin format function
+    _formatSpecs = {2: 'b', 8: 'o', 10: 'd', 16: 'x'}
+
     def format(self, value):
         result = ''
 
-        if value != 0:
+        format_spec = self._formatSpecs.get(self.base)
+        if format_spec is not None:
+            if self.uppercase and format_spec == 'x':
+                format_spec = 'X'
+            result = format(abs(value), format_spec)
+        elif value != 0:
             current = abs(value)
             while current != 0:
                 remainder = current % self.base
@@ -42,14 +42,14 @@ class HexColumnModel(models.RegularValueColumnModel):
     def createValidator(self):
         return HexColumnValidator(self.formatter, self.valuecodec)
 
-    def indexData(self, index, role=Qt.DisplayRole):
-        data = models.RegularValueColumnModel.indexData(self, index, role)
-        if data is not None:
-            if role == Qt.DisplayRole:
-                return ' ' * (self._cellTextSize - len(data)) + data
-            elif role == Qt.EditRole:
-                if self.valuecodec.signed and not data.startswith('-') and not data.startswith('+'):
-                    return '+' + data
+    def textForValue(self, value, role=Qt.DisplayRole):
+        # alignment is applied here and not in indexData, so texts returned by rowsData are aligned too
+        data = models.RegularValueColumnModel.textForValue(self, value, role)
+        if role == Qt.DisplayRole:
+            return ' ' * (self._cellTextSize - len(data)) + data
+        elif role == Qt.EditRole:
+            if self.valuecodec.signed and not data.startswith('-') and not data.startswith('+'):
+                return '+' + data
         return data
 
     def _dataForNewIndex(self, input_text, before_index):
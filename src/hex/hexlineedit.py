@@ -8,6 +8,18 @@ class HexLineEdit(QLineEdit):
         self._validator = HexInputValidator()
         self.setValidator(self._validator)
 
+    @property
+    def allowWildcards(self):
+        """Whether '?' can be entered in place of hex digit to mean any digit.
+        """
+        return self._validator.allowWildcards
+
+    @allowWildcards.setter
+    def allowWildcards(self, allow):
+        self._validator.allowWildcards = allow
+        if not allow:
+            self.setText(self.text().replace('?', ''))
+
     @property
     def data(self):
         formatter = formatters.IntegerFormatter(base=16)
@@ -15,6 +27,10 @@ class HexLineEdit(QLineEdit):
 
 
 class HexInputValidator(QValidator):
+    def __init__(self, allow_wildcards=False):
+        QValidator.__init__(self)
+        self.allowWildcards = allow_wildcards
+
     def validate(self, text, pos):
         # remove all spaces from text
         text = ''.join(text.split()).lower()
@@ -23,8 +39,9 @@ class HexInputValidator(QValidator):
             return self.Intermediate, '', 0
 
         # check if text contains only hex digits
+        allowed_chars = '1234567890abcdef?' if self.allowWildcards else '1234567890abcdef'
         for char in text:
-            if char not in '1234567890abcedef':
+            if char not in allowed_chars:
                 return self.Invalid, self._format(text), pos + pos // 2
 
         return self.Acceptable, self._format(text), pos + pos // 2
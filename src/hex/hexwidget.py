@@ -5,7 +5,7 @@ from PyQt4.QtGui import QColor, QFont, QFontMetricsF, QPolygonF, QWidget, QScrol
                         QTextEdit, QTextOption, QSizePolicy, QStyle, QStyleOptionFrameV2, QTextCursor, QTextDocument, \
                         QTextBlockFormat, QPlainTextDocumentLayout, QAbstractTextDocumentLayout, QTextCharFormat, \
                         QTextTableFormat, QRawFont, QKeyEvent, QFontDatabase, QMenu, QToolTip, QPixmap, QIcon, \
-                        QMessageBox
+                        QMessageBox, QStaticText, QFontInfo
 import math
 import os
 from hex.valuecodecs import IntegerCodec
@@ -18,6 +18,7 @@ import hex.settings as settings
 import hex.appsettings as appsettings
 import hex.resources.qrc_main
 import hex.formatters as formatters
+import hex.operations as operations
 from hex.models import ModelIndex, ColumnModel, FrameModel, StandardEditDelegate, index_range
 
 
@@ -137,8 +138,9 @@ class RowData(object):
 
 
 class IndexData(object):
-    def __init__(self, index):
-        self._text = None
+    def __init__(self, index, text=None, flags=None):
+        self._text = text
+        self._flags = flags
         self.index = index
         self.firstCharIndex = 0
         self.firstHtmlCharIndex = 0
@@ -165,16 +167,20 @@ class IndexData(object):
     def flags(self):
         if self.delegate is not None:
             return self.delegate.flags
-        else:
-            return self.index.flags
+        if self._flags is None:
+            self._flags = self.index.flags
+        return self._flags
 
 
 class ColumnDocumentBackend(QObject):
-    """Document backend controls generation of QTextDocument html structure and interacts with underlying QTextDocument.
+    """Document backend controls how column rows are stored, painted and laid out.
     """
 
     documentUpdated = pyqtSignal()
 
+    # if False, column does not generate html for cached rows
+    usesHtml = True
+
     def __init__(self, column):
         QObject.__init__(self)
         self._document = None
@@ -199,12 +205,15 @@ class ColumnDocumentBackend(QObject):
     def removeRows(self, row_index, number_of_rows):
         raise NotImplementedError()
 
-    def insertRow(self, row_index, number_of_rows):
+    def insertRows(self, row_index, number_of_rows):
         raise NotImplementedError()
 
     def rectForIndex(self, index):
         raise NotImplementedError()
 
+    def rectForRow(self, row_index):
+        raise NotImplementedError()
+
     def cursorPositionInIndex(self, index, cursor_offset):
         raise NotImplementedError()
 
@@ -214,11 +223,21 @@ class ColumnDocumentBackend(QObject):
     def cursorPositionFromPoint(self, point):
         raise NotImplementedError()
 
+    def paint(self, painter, text_color):
+        """Paints document with origin at (0, 0) using :text_color: for unmodified data"""
+        raise NotImplementedError()
+
+    def idealWidth(self):
+        raise NotImplementedError()
+
     def invalidate(self):
         self._document = None
 
 
 class TextDocumentBackend(ColumnDocumentBackend):
+    """Backend that renders rows as html into QTextDocument. Can display any column, but is slow.
+    """
+
     def __init__(self, column):
         ColumnDocumentBackend.__init__(self, column)
 
@@ -227,6 +246,8 @@ class TextDocumentBackend(ColumnDocumentBackend):
         if self._document is None:
             self._document = self._column.createDocumentTemplate()
 
+            self._column._fillCache()
+
             cursor = QTextCursor(self._document)
             cursor.beginEditBlock()
             try:
@@ -367,6 +388,163 @@ class TextDocumentBackend(ColumnDocumentBackend):
     def cursorPositionFromPoint(self, point):
         return self._positionForPoint(point)[1]
 
+    def paint(self, painter, text_color):
+        # little trick to quickly change default text color for document without re-generating it
+        paint_context = QAbstractTextDocumentLayout.PaintContext()
+        paint_context.palette.setColor(QPalette.Text, text_color)
+        paint_context.palette.setColor(QPalette.Window, QColor(0, 0, 0, 0))
+        # standard QTextDocument.draw also sets clip rect here, but we already have one
+        self.document.documentLayout().draw(painter, paint_context)
+
+    def idealWidth(self):
+        return self._document.idealWidth() if self._document is not None else 0
+
+
+class StaticTextBackend(ColumnDocumentBackend):
+    """Backend that paints each row with few QStaticText objects (one for each text color) and calculates geometry
+    of indexes from font metrics. It gives correct results only for fixed-pitch fonts, but is much faster than
+    TextDocumentBackend. Document is list of tuples (row_length, [(text_class, static_text)]) for each visible row.
+    """
+
+    usesHtml = False
+
+    TextNormal, TextModified, TextBroken = range(3)
+
+    def __init__(self, column):
+        ColumnDocumentBackend.__init__(self, column)
+
+    @property
+    def _charWidth(self):
+        return self._column._fontMetrics.width(' ')
+
+    @property
+    def _lineHeight(self):
+        return self._column._fontMetrics.height()
+
+    def generateDocument(self):
+        if self._document is None:
+            self._column._fillCache()
+            self._document = [self._createRowTexts(self._column.getRowCachedData(row_index))
+                              for row_index in range(self._column.visibleRows)]
+            self.documentUpdated.emit()
+        else:
+            self._column._renderDocumentData()
+
+    def _createRowTexts(self, row_data):
+        if row_data is None:
+            return 0, []
+
+        # cells with same color are joined into single line, cells of other colors are replaced with spaces
+        lines = dict()
+        for index_data in row_data.items:
+            index_text = index_data.text
+            if index_text:
+                flags = index_data.flags
+                if flags & ColumnModel.FlagBroken:
+                    text_class = self.TextBroken
+                elif flags & ColumnModel.FlagModified:
+                    text_class = self.TextModified
+                else:
+                    text_class = self.TextNormal
+                line = lines.get(text_class, '')
+                lines[text_class] = line + ' ' * (index_data.firstCharIndex - len(line)) + index_text
+
+        row_texts = []
+        for text_class, line in lines.items():
+            static_text = QStaticText(line)
+            static_text.setTextFormat(Qt.PlainText)
+            static_text.setPerformanceHint(QStaticText.AggressiveCaching)
+            row_texts.append((text_class, static_text))
+        return len(row_data.text), row_texts
+
+    def updateRow(self, row_index, row_data):
+        if self._document is not None and 0 <= row_index < len(self._document):
+            self._document[row_index] = self._createRowTexts(row_data)
+            self.documentUpdated.emit()
+
+    def removeRows(self, row_index, number_of_rows):
+        if self._document is not None:
+            del self._document[row_index:row_index + number_of_rows]
+            self.documentUpdated.emit()
+
+    def insertRows(self, row_index, number_of_rows):
+        if self._document is not None:
+            if row_index < 0:
+                row_index = len(self._document)
+            self._document[row_index:row_index] = [(0, [])] * number_of_rows
+            self.documentUpdated.emit()
+
+    def rectForIndex(self, index):
+        index = self._column.frameModel.toFrameIndex(index)
+        if not index:
+            return QRectF()
+
+        index_data = self._column.getIndexCachedData(index)
+        if index_data is not None:
+            char_width = self._charWidth
+            return QRectF(index_data.firstCharIndex * char_width, index.row * self._lineHeight,
+                          len(index_data.text or '') * char_width, self._lineHeight)
+        return QRectF()
+
+    def rectForRow(self, row_index):
+        if isinstance(row_index, ModelIndex):
+            return self.rectForRow(self._column.frameModel.toFrameIndex(row_index).row)
+
+        self.generateDocument()
+
+        if 0 <= row_index < len(self._document):
+            return QRectF(0, row_index * self._lineHeight, self.idealWidth(), self._lineHeight)
+        return QRectF()
+
+    def cursorPositionInIndex(self, index, cursor_offset):
+        index = self._column.frameModel.toFrameIndex(index)
+        if not index:
+            return QPointF()
+
+        index_data = self._column.getIndexCachedData(index)
+        if index_data is None or cursor_offset < 0 or cursor_offset > len(index_data.text):
+            return QPointF()
+
+        return QPointF((index_data.firstCharIndex + cursor_offset) * self._charWidth, index.row * self._lineHeight)
+
+    def _positionForPoint(self, point):
+        if point.x() >= 0 and point.y() >= 0:
+            row_data = self._column.getRowCachedData(int(point.y() // self._lineHeight))
+            if row_data is not None:
+                char_position = point.x() / self._charWidth
+                for index_data in row_data.items:
+                    text_length = len(index_data.text or '')
+                    if int(char_position) < index_data.firstCharIndex + text_length:
+                        cursor_offset = int(round(char_position)) - index_data.firstCharIndex
+                        return index_data.index, max(0, min(cursor_offset, text_length))
+        return ModelIndex(), 0
+
+    def indexFromPoint(self, point):
+        return self._positionForPoint(point)[0]
+
+    def cursorPositionFromPoint(self, point):
+        return self._positionForPoint(point)[1]
+
+    def paint(self, painter, text_color):
+        theme = self._column._theme
+        colors = {
+            self.TextNormal: text_color,
+            self.TextModified: theme.modifiedTextColor,
+            self.TextBroken: theme.brokenTextColor
+        }
+
+        painter.setFont(self._column.font)
+        line_height = self._lineHeight
+        for row_index, row in enumerate(self.document):
+            for text_class, static_text in row[1]:
+                painter.setPen(colors[text_class])
+                painter.drawStaticText(QPointF(0, row_index * line_height), static_text)
+
+    def idealWidth(self):
+        if self._document is None:
+            return 0
+        return max([row[0] for row in self._document] or [0]) * self._charWidth
+
 
 class Column(QObject):
     updateRequested = pyqtSignal()
@@ -398,8 +576,9 @@ class Column(QObject):
         self._spaced = self.dataModel.preferSpaced
         self._cache = []
         self._documentDirty = False
-        self._documentBackend = TextDocumentBackend(self)
-        self._documentBackend.documentUpdated.connect(self._onDocumentUpdated)
+        self._documentBackendType = None
+        self._documentBackend = None
+        self._updateDocumentBackend()
 
         self._updateHeaderData()
         self.dataModel.headerDataChanged.connect(self._updateHeaderData)
@@ -498,10 +677,39 @@ class Column(QObject):
         self._fontMetrics = QFontMetricsF(new_font)
         if hasattr(self.dataModel, 'renderFont'):  # well, this is hack until i invent better solution...
             self.dataModel.renderFont = new_font
+        self._updateDocumentBackend()
         self._documentBackend.invalidate()
         self.headerResized.emit()  # this can adjust geometry again...
         self._updateGeometry()
 
+    @property
+    def documentBackendType(self):
+        """Class of document backend this column uses. If set to None, StaticTextBackend is used for regular
+        models displayed with fixed-pitch font, and TextDocumentBackend for other ones."""
+        return type(self._documentBackend)
+
+    @documentBackendType.setter
+    def documentBackendType(self, backend_type):
+        self._documentBackendType = backend_type
+        self._updateDocumentBackend()
+
+    def _updateDocumentBackend(self):
+        backend_type = self._documentBackendType
+        if backend_type is None:
+            if self.regular and QFontInfo(self._font).fixedPitch():
+                backend_type = StaticTextBackend
+            else:
+                backend_type = TextDocumentBackend
+
+        if type(self._documentBackend) is not backend_type:
+            if self._documentBackend is not None:
+                self._documentBackend.documentUpdated.disconnect(self._onDocumentUpdated)
+            self._documentBackend = backend_type(self)
+            self._documentBackend.documentUpdated.connect(self._onDocumentUpdated)
+            # cached rows can lack data new backend needs
+            self._invalidateCache()
+            self.updateRequested.emit()
+
     @property
     def document(self):
         return self.dataModel.document
@@ -523,7 +731,7 @@ class Column(QObject):
     def getRowCachedData(self, visible_row_index):
         if 0 <= visible_row_index < self._visibleRows:
             if self._cache[visible_row_index] is None:
-                self._updateCachedRow(visible_row_index)
+                self._updateCachedRows(visible_row_index, 1)
             return self._cache[visible_row_index]
 
     def getIndexCachedData(self, index):
@@ -628,14 +836,9 @@ class Column(QObject):
 
         painter.translate(self.documentOrigin)
 
-        # little trick to quickly change default text color for document without re-generating it
-        paint_context = QAbstractTextDocumentLayout.PaintContext()
-        paint_context.palette.setColor(QPalette.Text, self._theme.textColor if paint_data.leadingColumn is self
-                                                      else self._theme.inactiveTextColor)
-        paint_context.palette.setColor(QPalette.Window, QColor(0, 0, 0, 0))
-        # standard QTextDocument.draw also sets clip rect here, but we already have one
         self._renderDocumentData()
-        self._documentBackend.document.documentLayout().draw(painter, paint_context)
+        self._documentBackend.paint(painter, self._theme.textColor if paint_data.leadingColumn is self
+                                             else self._theme.inactiveTextColor)
 
         painter.restore()
 
@@ -727,62 +930,91 @@ class Column(QObject):
     def _renderDocumentData(self):
         """Document will contain actual data after calling this method"""
         if self._documentDirty:
+            dirty_rows = set(row_index for row_index in range(len(self._cache)) if self._cache[row_index] is None)
+            self._fillCache()
+
             # we cannot simply iterate over all cached rows, because call to DocumentBackend.updateRow can
             # cause number of rows on screen to be changed
             row_index = 0
             while row_index < len(self._cache):
-                if self._cache[row_index] is None:
-                    self._updateCachedRow(row_index)
+                if row_index in dirty_rows or self._cache[row_index] is None:
+                    if self._cache[row_index] is None:
+                        self._updateCachedRows(row_index, 1)
                     self._documentBackend.updateRow(row_index, self._cache[row_index])
                 row_index += 1
             self._documentDirty = False
 
     def _onDocumentUpdated(self):
-        ideal_width = self._documentBackend._document.idealWidth() + VisualSpace * 2
+        ideal_width = self._documentBackend.idealWidth() + VisualSpace * 2
         if ideal_width != self._geom.width():
             self.resizeRequested.emit(QSizeF(ideal_width, self._geom.height()))
 
-    def _updateCachedRow(self, row_index):
+    def _fillCache(self):
+        """Fetches data for all rows that are not cached yet. Each run of adjacent missing rows is requested from
+        model at once."""
+        row_index = 0
+        while row_index < len(self._cache):
+            if self._cache[row_index] is None:
+                run_end = row_index + 1
+                while run_end < len(self._cache) and self._cache[run_end] is None:
+                    run_end += 1
+                self._updateCachedRows(row_index, run_end - row_index)
+                row_index = run_end
+            else:
+                row_index += 1
+
+    def _updateCachedRows(self, first_row_index, row_count):
+        for row_offset, model_row_data in enumerate(self.frameModel.rowsData(first_row_index, row_count)):
+            self._updateCachedRow(first_row_index + row_offset, model_row_data)
+
+    def _updateCachedRow(self, row_index, model_row_data):
         row_data = RowData()
-        row_data.html = '<div class="row">'
-        column_count = self.frameModel.columnCount(row_index)
+        uses_html = self._documentBackend.usesHtml
+        if uses_html:
+            row_data.html = '<div class="row">'
+        column_count = len(model_row_data)
+        active_delegate = self.frameModel.activeDelegate
         for column_index in range(column_count):
-            index = self.frameModel.toSourceIndex(self.frameModel.index(row_index, column_index))
-            index_data = IndexData(index)
-            if self.frameModel.activeDelegate is not None and self.frameModel.activeDelegate.index == index:
-                index_data.delegate = self.frameModel.activeDelegate
+            index = model_row_data.indexes[column_index]
+            index_data = IndexData(index, model_row_data.texts[column_index], model_row_data.flags[column_index])
+            if active_delegate is not None and active_delegate.index == index:
+                index_data.delegate = active_delegate
             index_data.firstCharIndex = len(row_data.text)
             index_data.firstHtmlCharIndex = len(row_data.html)
             index_text = index_data.text
 
             if index_text is not None:
-                cell_classes = []
+                row_data.text += index_text
 
-                flags = index_data.flags
-                if flags & ColumnModel.FlagModified:
-                    cell_classes.append('cell-mod')
-                if flags & ColumnModel.FlagBroken:
-                    cell_classes.append('cell-broken')
+                if uses_html:
+                    cell_classes = []
 
-                prepared_text = utils.htmlEscape(index_text)
-                if cell_classes:
-                    # unfortunately, HTML subset supported by Qt does not include multiclasses
-                    for css_class in cell_classes:
-                        index_html = '<span class="{0}">{1}</span>'.format(css_class, prepared_text)
-                else:
-                    index_html = prepared_text
+                    flags = index_data.flags
+                    if flags & ColumnModel.FlagModified:
+                        cell_classes.append('cell-mod')
+                    if flags & ColumnModel.FlagBroken:
+                        cell_classes.append('cell-broken')
 
-                row_data.html += index_html
-                row_data.text += index_text
-                index_data.html = index_html
+                    prepared_text = utils.htmlEscape(index_text)
+                    if cell_classes:
+                        # unfortunately, HTML subset supported by Qt does not include multiclasses
+                        for css_class in cell_classes:
+                            index_html = '<span class="{0}">{1}</span>'.format(css_class, prepared_text)
+                    else:
+                        index_html = prepared_text
+
+                    row_data.html += index_html
+                    index_data.html = index_html
 
             if self.spaced and column_index + 1 < column_count:
                 row_data.text += ' '
-                row_data.html += '&nbsp;'
+                if uses_html:
+                    row_data.html += '&nbsp;'
 
             row_data.items.append(index_data)
 
-        row_data.html += '</div>'
+        if uses_html:
+            row_data.html += '</div>'
         self._cache[row_index] = row_data
 
     def _onFrameScrolled(self, new_first_row, old_first_row):
@@ -904,6 +1136,53 @@ def _translate(x, dx, dy=0):
         raise TypeError('{0} is not translatable'.format(type(x)))
 
 
+class SaveOperation(operations.Operation):
+    """Saves document in another thread, reporting number of bytes written. While saving, document stays readable,
+    but cannot be modified (it reports itself as read-only). Save can be cancelled if document saver writes data
+    to temporary file first; target file is not changed in this case.
+    """
+
+    def __init__(self, document, device=None, switch_to_device=False):
+        url = device.url if device is not None else document.url
+        operations.Operation.__init__(self, utils.tr('saving {0}').format(url.toString()))
+        self._document = document
+        self._device = device
+        self._switchToDevice = switch_to_device
+        self._cancelRequested = False
+        # user waits for save to be completed, it should not be queued after background operations
+        self.priority = self.PriorityInteractive
+
+    @property
+    def document(self):
+        return self._document
+
+    def doWork(self):
+        self.setProgressText(utils.tr('saving...'))
+        self._document.saveProgress.connect(self._onSaveProgress, Qt.DirectConnection)
+        try:
+            self._document.save(self._device, self._switchToDevice)
+        except Exception:
+            if self._cancelRequested:
+                self.setProgressText(utils.tr('saving cancelled'))
+                self._cancel()
+                return
+            raise
+        finally:
+            self._document.saveProgress.disconnect(self._onSaveProgress)
+        self.setProgressText(utils.tr('saved'))
+
+    def _onSaveProgress(self, saved_length, total_length):
+        # called from thread executing Document.save
+        self.setCanCancel(self._document.canCancelSave())
+        if total_length:
+            self.setProgress(saved_length * 100 / total_length)
+        self.setProgressText(utils.tr('saving... {0} of {1} written').format(utils.formatSize(saved_length),
+                                                                             utils.formatSize(total_length)))
+        if self.takeCommand() == self.CancelCommand and self._document.canCancelSave():
+            self._cancelRequested = True
+            self._document.cancelSave()
+
+
 class HexWidget(QWidget):
     """HexWidget displays data in set of columns. One of columns is leading (just like widget can be focused).
     """
@@ -949,6 +1228,7 @@ class HexWidget(QWidget):
 
         self._theme = Theme()
         self._document = document
+        self._saveOperation = None
         self._columns = []
         self._leadingColumn = None
         self._caretPosition = 0
@@ -2215,6 +2495,28 @@ class HexWidget(QWidget):
             self.document.save(device, switch_to_device)
             self.reset()
 
+    def saveOperation(self, device=None, switch_to_device=False):
+        """Returns SaveOperation that saves document in background. Operation is not started. Widget is reset
+        when operation is finished.
+        """
+        if self.document is None:
+            return None
+        operation = SaveOperation(self.document, device, switch_to_device)
+        operation.finished.connect(self._onSaveFinished)
+        self._saveOperation = operation
+        return operation
+
+    @property
+    def saveOperationInProgress(self):
+        """SaveOperation created by saveOperation that is not finished yet, or None.
+        """
+        return self._saveOperation
+
+    def _onSaveFinished(self, status):
+        if self.sender() is self._saveOperation:
+            self._saveOperation = None
+        self.reset()
+
     def reset(self):
         for column in self._columns:
             column.dataModel.reset()
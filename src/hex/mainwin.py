@@ -362,27 +362,58 @@ class MainWindow(QMainWindow):
 
     def closeTab(self, tab_index):
         subWidget = self.tabsWidget.widget(tab_index)
-        if subWidget.hexWidget.isModified:
+        hex_widget = subWidget.hexWidget
+        # document being saved in background is still modified, and cannot be saved again until save is finished
+        if not self._waitForSave(hex_widget):
+            return False
+
+        if hex_widget.isModified:
             msgbox = QMessageBox(self)
             msgbox.setWindowTitle(utils.tr('Close editor'))
             msgbox.setIcon(QMessageBox.Question)
             msgbox.setText(utils.tr('Document {0} has unsaved changed. Do you want to save it?')
                            .format(subWidget.title))
-            msgbox.addButton(utils.tr('Save'), QMessageBox.YesRole)
-            msgbox.addButton(utils.tr('Do not save'), QMessageBox.NoRole)
+            save_button = msgbox.addButton(utils.tr('Save'), QMessageBox.YesRole)
+            discard_button = msgbox.addButton(utils.tr('Do not save'), QMessageBox.NoRole)
             msgbox.addButton(QMessageBox.Cancel)
             msgbox.setDefaultButton(QMessageBox.Cancel)
-            ans = msgbox.exec_()
-            if ans == QMessageBox.Cancel:
-                return
-            elif ans == QMessageBox.Yes:
-                subWidget.hexWidget.save()
+            msgbox.exec_()
+            if msgbox.clickedButton() is save_button:
+                if hex_widget.document.device is None:
+                    self.tabsWidget.setCurrentIndex(tab_index)
+                    self.saveAs()
+                else:
+                    self._saveInBackground(hex_widget)
+                # tab is not closed if save was cancelled or failed
+                if not self._waitForSave(hex_widget) or hex_widget.isModified:
+                    return False
+            elif msgbox.clickedButton() is not discard_button:
+                return False
 
         self.tabsWidget.removeTab(tab_index)
         self.subWidgets = [w for w in self.subWidgets if w is not subWidget]
         subWidget.setParent(None)
         return True
 
+    def _waitForSave(self, hex_widget):
+        """Shows dialog for operation saving document of :hex_widget: in background until operation is finished,
+        so user can watch or cancel it. Returns False if document is still being saved when dialog is closed.
+        """
+        save_operation = hex_widget.saveOperationInProgress
+        if save_operation is None:
+            if hex_widget.document is not None and hex_widget.document.saving:
+                QMessageBox.information(self, utils.tr('Close editor'),
+                                        utils.tr('Document is being saved. Wait for save to be finished.'))
+                return False
+            return True
+
+        dialog = operations.OperationDialog(self, save_operation)
+        save_operation.finished.connect(dialog.accept)
+        if not save_operation.snapshot.isFinished:
+            dialog.exec_()
+        save_operation.finished.disconnect(dialog.accept)
+        return save_operation.snapshot.isFinished
+
     def openFileDialog(self):
         filename = QFileDialog.getOpenFileName(self, utils.tr('Open file'), utils.lastFileDialogPath())
         if filename:
@@ -426,7 +457,24 @@ class MainWindow(QMainWindow):
             options = documents.FileLoadOptions()
             options.forceNew = True
             save_device = documents.deviceFromUrl(QUrl.fromLocalFile(filename), options)
-            hex_widget.save(save_device, switch_to_device=True)
+            self._saveInBackground(hex_widget, save_device, switch_to_device=True)
+
+    def _saveInBackground(self, hex_widget, device=None, switch_to_device=False):
+        save_operation = hex_widget.saveOperation(device, switch_to_device)
+        save_operation.finished.connect(self._onSaveFinished)
+        save_operation.run()
+
+    def _onSaveFinished(self, status):
+        save_operation = self.sender()
+        if status == operations.OperationState.Failed:
+            messages = save_operation.messagesPage(0, save_operation.snapshot.messageCount)
+            msgbox = QMessageBox(self)
+            msgbox.setWindowTitle(utils.tr('Error saving file'))
+            msgbox.setIcon(QMessageBox.Critical)
+            msgbox.setText(utils.tr('Failed to save document due to following error:\n{0}')
+                           .format('\n'.join(text for text, level in messages)))
+            msgbox.addButton(QMessageBox.Ok)
+            msgbox.exec_()
 
     def newDocument(self):
         e = documents.Document()
@@ -572,7 +620,7 @@ class MainWindow(QMainWindow):
         if not self.activeSubWidget.hexWidget.document.device:
             self.saveAs()
         else:
-            self.activeSubWidget.hexWidget.save()
+            self._saveInBackground(self.activeSubWidget.hexWidget)
 
     @forActiveWidget
     def zoomIn(self):
@@ -750,6 +798,10 @@ class HexSubWindow(QWidget):
         else:
             self.icon = QIcon()
         self.name = name
+        document.coalesceInterval = globalSettings[appsettings.App_UndoCoalesceInterval]
+        document.undoMemoryBudget = globalSettings[appsettings.App_UndoMemoryBudget]
+        # history that does not fit into budget is moved to disk, or forgotten with 'drop' policy
+        document.undoSpillEnabled = globalSettings[appsettings.App_UndoLimitPolicy] != 'drop'
         self.hexWidget = HexWidget(self, document)
         self.hexWidget.isModifiedChanged.connect(self._onModifiedChanged)
         self.hexWidget.urlChanged.connect(self._onUrlChanged)
@@ -1,6 +1,22 @@
+import array
+import bisect
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+import re
+import threading
+import os
+import hashlib
+import struct
+import sys
+import weakref
+from PyQt4.QtCore import Qt
 import hex.operations as operations
 import hex.utils as utils
 import hex.documents as documents
+import hex.settings as settings
+import hex.appsettings as appsettings
 
 
 class Match(object):
@@ -29,21 +45,171 @@ class Match(object):
         return not (self._document is None or self._position < 0 or self._length < 0)
 
 
+class MatchStore(object):
+    """Compact thread-safe storage for matches found by matcher: each match takes 16 bytes (position and length
+    stored in arrays of unsigned 64-bit integers) instead of Match object for each of them.
+    Stored matches follow document modifications in the same way as DataRange bound to data does: inserting or removing
+    data before match shifts it, and removing data inside match collapses its length (match is never removed from store,
+    so indexes of matches remain valid). Matchers report matches in order of their positions, and store uses binary
+    search to find matches affected by modification while they are ordered.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._positions = array.array('Q')
+        self._lengths = array.array('Q')
+        self._maxLength = 0
+        self._ordered = True
+        self._revision = 0
+        self._positionSet = None  # (length, set of positions of matches with this length), dropped on shift
+
+    def __len__(self):
+        with self._lock:
+            return len(self._positions)
+
+    def __getitem__(self, index):
+        """Returns tuple of (position, length) for match with given index.
+        """
+        with self._lock:
+            return self._positions[index], self._lengths[index]
+
+    @property
+    def revision(self):
+        """Incremented each time positions or lengths of stored matches are changed by document modification.
+        """
+        with self._lock:
+            return self._revision
+
+    def append(self, position, length):
+        self.extend(((position, length),))
+
+    def extendPositions(self, positions, length, skip_stored=False):
+        """Adds batch of matches with same :length: starting at ordered :positions: (any sequence of integers).
+        If :skip_stored: is True, positions of matches with same length that are already in store are not added.
+        """
+        with self._lock:
+            if skip_stored and self._positions:
+                stored = self._storedPositions(length)
+                positions = array.array('Q', (position for position in positions if position not in stored))
+            if positions:
+                if self._positions and positions[0] < self._positions[-1]:
+                    self._ordered = False
+                self._positions.extend(positions)
+                self._lengths.extend(array.array('Q', (length,)) * len(positions))
+                self._maxLength = max(self._maxLength, length)
+                if self._positionSet is not None and self._positionSet[0] == length:
+                    self._positionSet[1].update(positions)
+
+    def extend(self, matches):
+        """Adds batch of matches, each one given as (position, length) tuple or Match object.
+        """
+        with self._lock:
+            for match in matches:
+                position, length = (match.position, match.length) if isinstance(match, Match) else match
+                if self._positions and position < self._positions[-1]:
+                    self._ordered = False
+                self._positions.append(position)
+                self._lengths.append(length)
+                self._maxLength = max(self._maxLength, length)
+                if self._positionSet is not None and self._positionSet[0] == length:
+                    self._positionSet[1].add(position)
+
+    def _storedPositions(self, length):
+        """Returns set of positions of stored matches with given :length:. Set is built once and kept up to date while
+        matches are added, until they are shifted by document modification.
+        """
+        if self._positionSet is None or self._positionSet[0] != length:
+            self._positionSet = (length, {position for position, stored_length in zip(self._positions, self._lengths)
+                                          if stored_length == length})
+        return self._positionSet[1]
+
+    def onBytesInserted(self, start, length):
+        with self._lock:
+            if not self._positions or length <= 0:
+                return
+
+            if self._ordered:
+                # matches starting at or after :start: form tail of store and are shifted all at once
+                first_shifted = bisect.bisect_left(self._positions, start)
+                self._positions[first_shifted:] = array.array('Q', map(length.__add__,
+                                                                       self._positions[first_shifted:]))
+                candidates = range(bisect.bisect_left(self._positions, start - self._maxLength + 1, 0, first_shifted),
+                                   first_shifted)
+            else:
+                self._positions = array.array('Q', (position + length if position >= start else position
+                                                    for position in self._positions))
+                candidates = range(len(self._positions))
+
+            # matches data was inserted inside of are expanded
+            for index in candidates:
+                if self._positions[index] < start < self._positions[index] + self._lengths[index]:
+                    self._lengths[index] += length
+                    self._maxLength = max(self._maxLength, self._lengths[index])
+            self._positionSet = None
+            self._revision += 1
+
+    def onBytesRemoved(self, start, length):
+        with self._lock:
+            if not self._positions or length <= 0:
+                return
+
+            end = start + length
+            if self._ordered:
+                # matches starting after removed range are shifted all at once, matches intersecting with removed
+                # range are adjusted one by one
+                first_shifted = bisect.bisect_left(self._positions, end)
+                self._positions[first_shifted:] = array.array('Q', map(length.__rsub__,
+                                                                       self._positions[first_shifted:]))
+                candidates = range(bisect.bisect_left(self._positions, start - self._maxLength + 1, 0, first_shifted),
+                                   first_shifted)
+            else:
+                candidates = range(len(self._positions))
+
+            for index in candidates:
+                match_start, match_end = self._positions[index], self._positions[index] + self._lengths[index]
+                if not self._ordered and match_start >= end:
+                    self._positions[index] -= length
+                elif match_end > start:
+                    new_start = match_start if match_start < start else max(start, match_start - length)
+                    new_end = match_end if match_end <= start else max(start, match_end - length)
+                    self._positions[index], self._lengths[index] = new_start, new_end - new_start
+            self._positionSet = None
+            self._revision += 1
+
+
 class AbstractMatcher(operations.Operation):
+    """Base class for operations looking for matches in document. Matches found are kept in MatchStore (see
+    AbstractMatcher.matches) and are not added to operation results.
+    """
+
     def __init__(self, document, title=None):
         if title is None:
             title = utils.tr('looking for matches')
         operations.Operation.__init__(self, title)
         self._document = document
         self._resultCount = 0
+        self._matches = MatchStore()
 
         self.setCanPause(True)
         self.setCanCancel(True)
+        self.priority = self.PriorityBackground
+
+        # we should not change matches while document is being modified, so adjust them after it
+        self._document.bytesInserted.connect(self._onBytesInserted, Qt.QueuedConnection)
+        self._document.bytesRemoved.connect(self._onBytesRemoved, Qt.QueuedConnection)
 
     @property
     def document(self):
         return self._document
 
+    @property
+    def concurrencyGroup(self):
+        return self._document
+
+    @property
+    def matches(self):
+        return self._matches
+
     def _updateState(self, position):
         while True:
             command = self.takeCommand()
@@ -69,34 +235,196 @@ class AbstractMatcher(operations.Operation):
 
     @property
     def allMatches(self):
-        return self.state.results.values()
+        return [self.matchAt(index) for index in range(len(self._matches))]
+
+    def matchAt(self, index):
+        """Creates Match object for match stored in MatchStore under given index.
+        """
+        position, length = self._matches[index]
+        return Match(self._document, position, length)
+
+    def addMatches(self, matches):
+        """Adds batch of found matches to store.
+        """
+        with self.lock:
+            if self._state.isFinished:
+                raise operations.OperationError('operation already finished')
+            self._matches.extend(matches)
+            self._resultCount = len(self._matches)
 
-    def addResult(self, name, value):
-        self._resultCount += 1
-        operations.Operation.addResult(self, name, value)
+    def _onBytesInserted(self, start, length):
+        self._matches.onBytesInserted(start, length)
+
+    def _onBytesRemoved(self, start, length):
+        self._matches.onBytesRemoved(start, length)
 
 
 class BinaryMatcher(AbstractMatcher):
-    def __init__(self, document, find_what, title=None):
+    """Looks for exact byte sequence. If :worker_count: is greater than one, large documents are split into chunks
+    searched concurrently by several threads (native finder does not hold GIL while searching). By default one worker
+    for each processor core is used.
+    If :search_index: is given, matches found are remembered in it, and only ranges of document that were modified
+    since last search (or not searched yet because of cancelling) are searched again.
+    """
+
+    # number of bytes searched by one worker task in parallel mode
+    ChunkSize = 1024 * 1024 * 16
+
+    def __init__(self, document, find_what, title=None, worker_count=None, search_index=None):
         AbstractMatcher.__init__(self, document, title)
         self._findWhat = find_what
         self._finder = documents.BinaryFinder(document, find_what)
+        self._workerCount = max(1, worker_count if worker_count is not None else multiprocessing.cpu_count())
+        self._searchIndex = search_index
+
+        if search_index is not None:
+            # matches are shifted by index entry together with its own positions instead (see
+            # _SearchIndexEntry.attachStore), so search restarted after modification sees both updated at once
+            self._document.bytesInserted.disconnect(self._onBytesInserted)
+            self._document.bytesRemoved.disconnect(self._onBytesRemoved)
+
+    @property
+    def workerCount(self):
+        return self._workerCount
+
+    @property
+    def searchIndex(self):
+        return self._searchIndex
 
     def doWork(self):
         self.setProgressText(utils.tr('searching...'))
-        current_position = 0
+        if self._searchIndex is not None:
+            completed = self._searchIndexed()
+        else:
+            def on_chunk(chunk_start, chunk_end, positions):
+                self.addMatches((match_position, len(self._findWhat)) for match_position in positions)
+                return True
+
+            completed = self._searchRange(0, self.document.length, on_chunk)
+
+        if completed:
+            self.setProgressText(utils.tr('search completed: {0} matches found').format(len(self._matches)))
+
+    def _searchIndexed(self):
+        entry = self._searchIndex.entry(self._findWhat)
+        entry.attachStore(self._matches)
+        skip_stored = False
+        while True:
+            # search all ranges index does not know matches for. Matches are added to store in order of positions as
+            # soon as they are known: ones in clean ranges are taken from index, and ones in dirty ranges are added
+            # when chunk is committed, so cancelled search keeps matches found so far
+            dirty_ranges, revision = entry.dirtyRanges(self.document.length)
+            total_length = sum(range_end - range_start for range_start, range_end in dirty_ranges) or 1
+            searched_length = 0
+            known_start = 0
+            interrupted = False
+            for range_start, range_end in dirty_ranges:
+                if not self._addKnownPositions(entry, known_start, range_start, revision, skip_stored):
+                    interrupted = True
+                    break
+
+                def on_chunk(chunk_start, chunk_end, positions):
+                    with entry.lock:
+                        if not entry.commit(chunk_start, chunk_end, positions, revision):
+                            return False
+                        self._addPositions(positions, skip_stored)
+                    return True
+
+                def progress_position(position, searched_length=searched_length, range_start=range_start):
+                    return self.document.length * (searched_length + position - range_start) / total_length
+
+                result = self._searchRange(range_start, range_end, on_chunk, progress_position)
+                if result is None:
+                    interrupted = True
+                    break
+                elif not result:
+                    return False
+                searched_length += range_end - range_start
+                known_start = range_end
+
+            if not interrupted and self._addKnownPositions(entry, known_start, None, revision, skip_stored):
+                break
+            # document was modified while searching, start again with new ranges. Matches that are already in store
+            # should not be added again
+            skip_stored = True
+
+        self._searchIndex.saveIfEnabled()
+        return True
+
+    def _addKnownPositions(self, entry, start, end, revision, skip_stored):
+        # positions are added under entry lock, so document modification cannot shift store between them
+        with entry.lock:
+            positions = entry.positionsInRange(start, end, revision)
+            if positions is None:
+                return False
+            self._addPositions(positions, skip_stored)
+        return True
+
+    def _addPositions(self, positions, skip_stored):
+        with self.lock:
+            self._matches.extendPositions(positions, len(self._findWhat), skip_stored)
+            self._resultCount = len(self._matches)
+
+    def _searchRange(self, start, end, on_chunk, progress_position=None):
+        """Searches for matches starting in range [start, end). For each searched chunk :on_chunk: is called with chunk
+        boundaries and positions of matches found inside it, in order of chunk positions. Returns True if search was
+        completed, False if it was cancelled, and None if it was interrupted because :on_chunk: returned False.
+        """
+        if progress_position is None:
+            progress_position = lambda position: position
+
+        if self._workerCount > 1 and end - start > self.ChunkSize:
+            return self._searchParallel(start, end, on_chunk, progress_position)
+        else:
+            return self._searchSequential(start, end, on_chunk, progress_position)
+
+    def _searchSequential(self, start, end, on_chunk, progress_position):
+        current_position = start
         step = 1024 * 1024
-        while current_position < self.document.length:
-            match_position, found = self._finder.findNext(current_position, self.document.length - current_position)
-            if found:
-                self.addResult(str(self._resultCount), Match(self.document, match_position, len(self._findWhat)))
-                current_position = match_position + 1
-            else:
-                current_position += step
+        while current_position < end:
+            chunk_length = min(step, end - current_position)
+            if not on_chunk(current_position, current_position + chunk_length,
+                            self._findInChunk(current_position, chunk_length)):
+                return None
+            current_position += chunk_length
+
+            if self._updateState(progress_position(current_position)):
+                return False
+        return True
+
+    def _searchParallel(self, start, end, on_chunk, progress_position):
+        chunks = ((chunk_start, min(self.ChunkSize, end - chunk_start))
+                  for chunk_start in range(start, end, self.ChunkSize))
 
-            self._updateState(current_position)
+        with concurrent.futures.ThreadPoolExecutor(self._workerCount) as executor:
+            # keep limited number of chunks queued, so results of chunks that are searched but not reported yet
+            # do not take too much memory
+            pending = collections.deque((chunk, executor.submit(self._findInChunk, *chunk))
+                                        for chunk in itertools.islice(chunks, self._workerCount * 2))
+            while pending:
+                (chunk_start, chunk_length), future = pending.popleft()
+                # chunks are reported in order of their positions, so results are ordered too
+                if not on_chunk(chunk_start, chunk_start + chunk_length, future.result()):
+                    result = None
+                else:
+                    next_chunk = next(chunks, None)
+                    if next_chunk is not None:
+                        pending.append((next_chunk, executor.submit(self._findInChunk, *next_chunk)))
 
-        self.setProgressText(utils.tr('search completed: {0} matches found').format(len(self.allMatches)))
+                    result = False if self._updateState(progress_position(chunk_start + chunk_length)) else True
+
+                if result is not True:
+                    for chunk, future in pending:
+                        future.cancel()
+                    return result
+        return True
+
+    def _findInChunk(self, chunk_start, chunk_length):
+        """Returns positions of all matches starting inside given chunk. Data after chunk end is searched too, so
+        matches crossing chunk boundary are found by exactly one chunk. Chunk data is read past device caches, so
+        workers do not serialize on device cache and do not evict pages GUI uses.
+        """
+        return [finder_match.position for finder_match in self._finder.findAll(chunk_start, chunk_length)]
 
     def _doFind(self, from_position, limit, is_reversed):
         if limit is None:
@@ -119,7 +447,665 @@ class BinaryMatcher(AbstractMatcher):
             return Match()
 
     def findNext(self, from_position, limit=None):
+        if self._searchIndex is not None:
+            match_position = self._searchIndex.entry(self._findWhat).findNext(from_position, limit,
+                                                                                 self.document.length)
+            if match_position is not None:
+                return Match(self.document, match_position, len(self._findWhat)) if match_position >= 0 else Match()
         return self._doFind(from_position, limit, False)
 
     def findPrevious(self, from_position, limit=None):
         return self._doFind(from_position, limit, True)
+
+
+class MultiPatternMatch(Match):
+    def __init__(self, document=None, position=-1, length=-1, pattern_index=-1):
+        Match.__init__(self, document, position, length)
+        self._patternIndex = pattern_index
+
+    @property
+    def patternIndex(self):
+        """Index of matched pattern in list of patterns given to matcher.
+        """
+        return self._patternIndex
+
+
+class MultiPatternMatcher(AbstractMatcher):
+    """Looks for any of given byte patterns in one pass over document. Matches of all patterns are reported in order
+    of their positions, and MultiPatternMatch.patternIndex tells which pattern was matched.
+    """
+
+    def __init__(self, document, patterns, title=None):
+        AbstractMatcher.__init__(self, document, title)
+        self._patterns = [bytes(pattern) for pattern in patterns]
+        if not any(self._patterns):
+            raise ValueError('at least one non-empty pattern is required')
+        self._finder = documents.MultiPatternFinder(document, self._patterns)
+        self._patternIndexes = array.array('L')  # index of pattern for each match in store
+
+    @property
+    def patterns(self):
+        return self._patterns
+
+    def matchAt(self, index):
+        position, length = self._matches[index]
+        return MultiPatternMatch(self._document, position, length, self._patternIndexes[index])
+
+    def addMatches(self, finder_matches):
+        with self.lock:
+            finder_matches = list(finder_matches)
+            AbstractMatcher.addMatches(self, ((finder_match.position, finder_match.length)
+                                              for finder_match in finder_matches))
+            self._patternIndexes.extend(finder_match.patternIndex for finder_match in finder_matches)
+
+    def doWork(self):
+        self.setProgressText(utils.tr('searching...'))
+        current_position = 0
+        step = 1024 * 1024
+        while current_position < self.document.length:
+            self.addMatches(self._finder.findAll(current_position, step))
+            current_position += step
+
+            if self._updateState(min(current_position, self.document.length)):
+                return
+
+        self.setProgressText(utils.tr('search completed: {0} matches found').format(len(self._matches)))
+
+    def _matchFromFinderMatch(self, finder_match):
+        return MultiPatternMatch(self._document, finder_match.position, finder_match.length, finder_match.patternIndex)
+
+    def findNext(self, from_position, limit=None):
+        """Returns first match that starts at or after :from_position:, but before :from_position: + :limit:.
+        """
+        limit = max(0, self._document.length - from_position) if limit is None else limit
+        step = 1024 * 1024
+        current_position = from_position
+        while current_position < from_position + limit:
+            matches = self._finder.findAll(current_position, min(step, from_position + limit - current_position))
+            if matches:
+                return self._matchFromFinderMatch(matches[0])
+            current_position += step
+        return MultiPatternMatch()
+
+    def findPrevious(self, from_position, limit=None):
+        """Returns last match that ends at or before :from_position:, but starts not before :from_position: - :limit:.
+        Among matches starting at same position, match of pattern with smallest index is preferred.
+        """
+        limit = from_position if limit is None else min(limit, from_position)
+        step = 1024 * 1024
+        window_end = from_position
+        while window_end > from_position - limit:
+            window_start = max(from_position - limit, window_end - step)
+            # matches that end before :from_position: can start only before this point
+            best_match = None
+            for finder_match in self._finder.findAll(window_start, window_end - window_start):
+                if finder_match.position + finder_match.length <= from_position and \
+                        (best_match is None or finder_match.position > best_match.position):
+                    best_match = finder_match
+            if best_match is not None:
+                return self._matchFromFinderMatch(best_match)
+            window_end = window_start
+        return MultiPatternMatch()
+
+
+class MaskedPattern(object):
+    """Byte pattern in which any bits can be ignored when matching. Text form of pattern consists of pairs of hex
+    digits with '?' in place of digits that can have any value, for example '4D 5A ?? ?? 50 45' or 'F? ?0'.
+    """
+
+    def __init__(self, values, masks):
+        if len(values) != len(masks):
+            raise ValueError('values and masks should have same length')
+        elif not values:
+            raise ValueError('pattern should not be empty')
+
+        self._masks = bytes(masks)
+        self._values = bytes(value & mask for value, mask in zip(values, self._masks))
+
+        # longest run of bytes without ignored bits is looked for first, other bytes are checked for found
+        # candidates only
+        self._anchor, self._anchorOffset = b'', 0
+        run_start = 0
+        for byte_index in range(len(self._masks) + 1):
+            if byte_index == len(self._masks) or self._masks[byte_index] != 0xff:
+                if byte_index - run_start > len(self._anchor):
+                    self._anchor, self._anchorOffset = self._values[run_start:byte_index], run_start
+                run_start = byte_index + 1
+
+        self._regex = re.compile(b''.join(self._byteExpression(value, mask) for value, mask in
+                                          zip(self._values, self._masks)), re.DOTALL)
+
+    @classmethod
+    def fromString(cls, text):
+        # like HexLineEdit.data, single digit separated by spaces is treated as byte with high digit being zero
+        digits = ''
+        for token in text.split():
+            if len(token) == 1:
+                token = '0' + token
+            elif len(token) % 2:
+                raise ValueError(utils.tr('pattern should contain even number of digits'))
+            digits += token
+
+        values, masks = [], []
+        for byte_index in range(0, len(digits), 2):
+            value = mask = 0
+            for digit in digits[byte_index:byte_index + 2]:
+                value, mask = value << 4, mask << 4
+                if digit != '?':
+                    try:
+                        value |= int(digit, 16)
+                    except ValueError:
+                        raise ValueError(utils.tr('invalid character in pattern: {0}').format(digit))
+                    mask |= 0xf
+            values.append(value)
+            masks.append(mask)
+        return cls(values, masks)
+
+    @property
+    def values(self):
+        return self._values
+
+    @property
+    def masks(self):
+        return self._masks
+
+    def __len__(self):
+        return len(self._values)
+
+    def __str__(self):
+        return ' '.join(''.join('{0:X}'.format((value >> shift) & 0xf) if (mask >> shift) & 0xf else '?'
+                                for shift in (4, 0)) for value, mask in zip(self._values, self._masks))
+
+    def findAll(self, data, start=0, end=None):
+        """Yields offsets of all matches (including overlapping ones) in :data: that start in range [start, end).
+        """
+        last_start = len(data) - len(self)
+        end = last_start + 1 if end is None else min(end, last_start + 1)
+        position = start
+        while position < end:
+            if self._anchor:
+                anchor_position = data.find(self._anchor, position + self._anchorOffset,
+                                            end + self._anchorOffset + len(self._anchor) - 1)
+                if anchor_position < 0:
+                    return
+                position = anchor_position - self._anchorOffset
+                if self._regex.match(data, position):
+                    yield position
+            else:
+                match = self._regex.search(data, position, end + len(self) - 1)
+                if match is None:
+                    return
+                position = match.start()
+                yield position
+            position += 1
+
+    @staticmethod
+    def _byteExpression(value, mask):
+        if mask == 0xff:
+            return re.escape(bytes((value,)))
+        elif mask == 0:
+            return b'.'
+        return b'[' + b''.join(re.escape(bytes((byte,))) for byte in range(256) if byte & mask == value) + b']'
+
+
+class MaskedMatcher(AbstractMatcher):
+    """Looks for MaskedPattern (or pattern given in its text form) in document.
+    """
+
+    def __init__(self, document, pattern, title=None):
+        AbstractMatcher.__init__(self, document, title)
+        self._pattern = MaskedPattern.fromString(pattern) if isinstance(pattern, str) else pattern
+
+    @property
+    def pattern(self):
+        return self._pattern
+
+    def doWork(self):
+        self.setProgressText(utils.tr('searching...'))
+        current_position = 0
+        step = 1024 * 1024
+        while current_position < self.document.length:
+            self.addMatches((match_position, len(self._pattern))
+                            for match_position in self._findAll(current_position, step))
+            current_position += step
+
+            if self._updateState(min(current_position, self.document.length)):
+                return
+
+        self.setProgressText(utils.tr('search completed: {0} matches found').format(len(self._matches)))
+
+    def _findAll(self, start, length):
+        """Yields positions of matches that start in range [start, start + length)
+        """
+        data = bytes(self._document.view(start, length + len(self._pattern) - 1))
+        return (start + offset for offset in self._pattern.findAll(data, 0, length))
+
+    def findNext(self, from_position, limit=None):
+        limit = max(0, self._document.length - from_position) if limit is None else limit
+        step = 1024 * 1024
+        current_position = from_position
+        while current_position < from_position + limit:
+            match_position = next(self._findAll(current_position, min(step, from_position + limit - current_position)),
+                                  None)
+            if match_position is not None:
+                return Match(self._document, match_position, len(self._pattern))
+            current_position += step
+        return Match()
+
+    def findPrevious(self, from_position, limit=None):
+        """Returns last match that ends at or before :from_position:, but starts not before :from_position: - :limit:.
+        """
+        limit = from_position if limit is None else min(limit, from_position)
+        step = 1024 * 1024
+        window_end = from_position - len(self._pattern) + 1  # matches can start only before this position
+        while window_end > from_position - limit:
+            window_start = max(from_position - limit, window_end - step)
+            match_positions = list(self._findAll(window_start, window_end - window_start))
+            if match_positions:
+                return Match(self._document, match_positions[-1], len(self._pattern))
+            window_end = window_start
+        return Match()
+
+
+class RegexMatcher(AbstractMatcher):
+    """Looks for matches of regular expression (bytes pattern for Python re module). Document is never read as whole:
+    expression is applied to windows of ChunkSize bytes, and each window is extended by :max_match_length: bytes so
+    matches crossing window boundary are found too. Matches longer than :max_match_length: are truncated or missed,
+    and empty matches are ignored. Like re.finditer, doWork reports non-overlapping matches only.
+    """
+
+    ChunkSize = 1024 * 1024
+    DefaultMaxMatchLength = 1024 * 64
+
+    def __init__(self, document, pattern, title=None, flags=0, max_match_length=None):
+        AbstractMatcher.__init__(self, document, title)
+        self._regex = pattern if hasattr(pattern, 'finditer') else re.compile(pattern, flags)
+        self._maxMatchLength = self.DefaultMaxMatchLength if max_match_length is None else max_match_length
+        if self._maxMatchLength <= 0:
+            raise ValueError('maximal match length should be positive')
+
+    @property
+    def regex(self):
+        return self._regex
+
+    @property
+    def maxMatchLength(self):
+        return self._maxMatchLength
+
+    def doWork(self):
+        self.setProgressText(utils.tr('searching...'))
+        current_position = 0
+        while current_position < self.document.length:
+            chunk_end = min(self.document.length, current_position + self.ChunkSize)
+            matches, current_position = self._searchChunk(current_position, chunk_end)
+            self.addMatches(matches)
+
+            if self._updateState(min(current_position, self.document.length)):
+                return
+
+        self.setProgressText(utils.tr('search completed: {0} matches found').format(len(self._matches)))
+
+    def _searchChunk(self, chunk_start, chunk_end, data_end=None):
+        """Returns tuple of (matches starting in range [chunk_start, chunk_end), position next chunk should start at).
+        Next chunk starts after end of last match found, so matches are never overlapping. If :data_end: is given,
+        matches never extend beyond it.
+        """
+        window_end = chunk_end + self._maxMatchLength
+        if data_end is not None:
+            window_end = min(window_end, data_end)
+        data = bytes(self._document.view(chunk_start, max(0, window_end - chunk_start)))
+
+        matches = []
+        next_position = chunk_end
+        for regex_match in self._regex.finditer(data):
+            if regex_match.start() >= chunk_end - chunk_start:
+                break
+            elif regex_match.end() > regex_match.start():
+                matches.append(Match(self._document, chunk_start + regex_match.start(),
+                                     regex_match.end() - regex_match.start()))
+                next_position = max(next_position, chunk_start + regex_match.end())
+        return matches, next_position
+
+    def findNext(self, from_position, limit=None):
+        """Returns first match that starts at or after :from_position:, but before :from_position: + :limit:.
+        """
+        limit = max(0, self._document.length - from_position) if limit is None else limit
+        current_position = from_position
+        while current_position < from_position + limit:
+            matches, next_position = self._searchChunk(current_position,
+                                                       min(current_position + self.ChunkSize, from_position + limit))
+            if matches:
+                return matches[0]
+            current_position = next_position
+        return Match()
+
+    def findPrevious(self, from_position, limit=None):
+        """Returns last match that ends at or before :from_position:, but starts not before :from_position: - :limit:.
+        """
+        limit = from_position if limit is None else min(limit, from_position)
+        window_end = from_position
+        while window_end > from_position - limit:
+            window_start = max(from_position - limit, window_end - self.ChunkSize)
+            matches = self._searchChunk(window_start, window_end, from_position)[0]
+            if matches:
+                return matches[-1]
+            window_end = window_start
+        return Match()
+
+
+class _SearchIndexEntry(object):
+    """Ordered positions of all matches of single pattern in document, except of matches starting in dirty ranges.
+    Dirty ranges are ranges of positions that were not searched yet or were modified after search. Revision of entry
+    is incremented after each document modification, so search results can be committed only if document was not
+    modified after search was started.
+    """
+
+    def __init__(self, pattern, document_length):
+        self.lock = threading.RLock()
+        self.pattern = pattern
+        self.positions = array.array('Q')
+        self.revision = 0
+        self._dirty = [(0, document_length)] if document_length else []
+        self._stores = weakref.WeakSet()
+
+    @property
+    def isComplete(self):
+        with self.lock:
+            return not self._dirty
+
+    def attachStore(self, store):
+        """Makes entry shift matches in MatchStore :store: on document modification under its lock, together with its
+        own positions. Positions taken from entry and added to store under entry lock stay consistent with matches
+        already in store.
+        """
+        with self.lock:
+            self._stores.add(store)
+
+    def dirtyRanges(self, document_length):
+        """Returns tuple of (list of dirty ranges inside document, current revision).
+        """
+        with self.lock:
+            self._dirty = [(start, min(end, document_length)) for start, end in self._dirty if start < document_length]
+            return list(self._dirty), self.revision
+
+    def commit(self, start, end, positions, revision):
+        """Adds positions of matches found in range [start, end) and marks range as clean. Returns False if
+        document was modified since :revision:.
+        """
+        with self.lock:
+            if revision != self.revision:
+                return False
+            insert_index = bisect.bisect_left(self.positions, start)
+            self.positions[insert_index:insert_index] = array.array('Q', positions)
+            self._subtractDirty(start, end)
+            return True
+
+    def positionsInRange(self, start, end, revision):
+        """Returns positions of known matches in range [start, end) (up to end of document if :end: is None), or None
+        if document was modified since :revision:.
+        """
+        with self.lock:
+            if revision != self.revision:
+                return None
+            first_index = bisect.bisect_left(self.positions, start)
+            last_index = len(self.positions) if end is None else bisect.bisect_left(self.positions, end)
+            return self.positions[first_index:last_index]
+
+    def findNext(self, from_position, limit, document_length):
+        """Returns position of first match lying inside [from_position, from_position + limit) or -1 if there are no
+        such matches. Returns None if index does not know all matches in this range.
+        """
+        with self.lock:
+            end = (document_length if limit is None else from_position + limit) - len(self.pattern) + 1
+            if any(range_start < end and from_position < range_end for range_start, range_end in self._dirty):
+                return None
+            index = bisect.bisect_left(self.positions, from_position)
+            if index < len(self.positions) and self.positions[index] < end:
+                return self.positions[index]
+            return -1
+
+    def onInserted(self, start, length):
+        with self.lock:
+            # matches crossing insertion point are broken, matches after it are shifted
+            self._removePositions(start - len(self.pattern) + 1, start)
+            first_shifted = bisect.bisect_left(self.positions, start)
+            self.positions[first_shifted:] = array.array('Q', map(length.__add__, self.positions[first_shifted:]))
+
+            self._dirty = [(range_start + length if range_start >= start else range_start,
+                            range_end + length if range_end > start else range_end)
+                           for range_start, range_end in self._dirty]
+            self._addDirty(start - len(self.pattern) + 1, start + length)
+            for store in self._stores:
+                store.onBytesInserted(start, length)
+            self.revision += 1
+
+    def onRemoved(self, start, length):
+        with self.lock:
+            end = start + length
+            self._removePositions(start - len(self.pattern) + 1, end)
+            first_shifted = bisect.bisect_left(self.positions, end)
+            self.positions[first_shifted:] = array.array('Q', map(length.__rsub__, self.positions[first_shifted:]))
+
+            def adjust(position):
+                return position if position <= start else max(start, position - length)
+            self._dirty = [(adjust(range_start), adjust(range_end)) for range_start, range_end in self._dirty
+                           if adjust(range_start) < adjust(range_end)]
+            self._addDirty(start - len(self.pattern) + 1, start)
+            for store in self._stores:
+                store.onBytesRemoved(start, length)
+            self.revision += 1
+
+    def onChanged(self, start, length):
+        with self.lock:
+            self._removePositions(start - len(self.pattern) + 1, start + length)
+            self._addDirty(start - len(self.pattern) + 1, start + length)
+            self.revision += 1
+
+    def _removePositions(self, start, end):
+        del self.positions[bisect.bisect_left(self.positions, max(0, start)):bisect.bisect_left(self.positions, end)]
+
+    def _addDirty(self, start, end):
+        start = max(0, start)
+        if start >= end:
+            return
+        merged = []
+        for range_start, range_end in sorted(self._dirty + [(start, end)]):
+            if merged and range_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+            else:
+                merged.append((range_start, range_end))
+        self._dirty = merged
+
+    def _subtractDirty(self, start, end):
+        result = []
+        for range_start, range_end in self._dirty:
+            if range_start < start:
+                result.append((range_start, min(range_end, start)))
+            if range_end > end:
+                result.append((max(range_start, end), range_end))
+        self._dirty = result
+
+
+class SearchIndex(object):
+    """Remembers matches found by BinaryMatcher in single document, separately for each pattern, and keeps them
+    up to date when document is modified: matches are shifted or dropped, and only modified ranges (with margins of
+    pattern length) should be searched again.
+    If App_PersistSearchIndex setting is enabled, complete results for document that is not modified are saved to
+    files in settings directory and loaded on next search in same unmodified file.
+    """
+
+    MaxPersistedPatternCount = 20
+
+    def __init__(self, document):
+        self._document = weakref.ref(document)
+        self._lock = threading.RLock()
+        self._entries = collections.OrderedDict()
+        self._skipDataChangedAt = None
+
+        # index should be updated synchronously with document modification, before any search can read new data
+        document.bytesInserted.connect(self._onBytesInserted, Qt.DirectConnection)
+        document.bytesRemoved.connect(self._onBytesRemoved, Qt.DirectConnection)
+        document.dataChanged.connect(self._onDataChanged, Qt.DirectConnection)
+
+    @property
+    def patterns(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def entry(self, pattern):
+        pattern = bytes(pattern)
+        with self._lock:
+            if pattern not in self._entries:
+                entry = _SearchIndexEntry(pattern, self._document().length)
+                self._loadEntry(entry)
+                self._entries[pattern] = entry
+            return self._entries[pattern]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _onBytesInserted(self, start, length):
+        with self._lock:
+            # insertion is followed by dataChanged signal for all data after insertion point, it should be ignored
+            self._skipDataChangedAt = start
+            for entry in self._entries.values():
+                entry.onInserted(start, length)
+
+    def _onBytesRemoved(self, start, length):
+        with self._lock:
+            self._skipDataChangedAt = start
+            for entry in self._entries.values():
+                entry.onRemoved(start, length)
+
+    def _onDataChanged(self, start, length):
+        with self._lock:
+            if self._skipDataChangedAt == start:
+                self._skipDataChangedAt = None
+                return
+            self._skipDataChangedAt = None
+            for entry in self._entries.values():
+                entry.onChanged(start, length)
+
+    def _persistentFileInfo(self):
+        """Returns tuple of (index file path, file identity) for document that can have persisted index, or None.
+        """
+        document = self._document()
+        if document is None or document.modified or not settings.globalSettings()[appsettings.App_PersistSearchIndex]:
+            return None
+        device = document.device
+        if device is None or not device.url.isLocalFile():
+            return None
+        filename = device.url.toLocalFile()
+        try:
+            file_stat = os.stat(filename)
+        except OSError:
+            return None
+        load_options = device.loadOptions
+        identity = (os.path.abspath(filename), file_stat.st_size, file_stat.st_mtime_ns,
+                    load_options.rangeStart if load_options.rangeLoad else 0, document.length)
+        index_filename = hashlib.sha1(repr(identity[0]).encode('utf-8')).hexdigest() + '.idx'
+        return os.path.join(settings.defaultSettingsDirectory, 'search-index', index_filename), identity
+
+    def _loadEntry(self, entry):
+        file_info = self._persistentFileInfo()
+        if file_info is None:
+            return
+        try:
+            with open(file_info[0], 'rb') as index_file:
+                positions = self._readIndexFile(index_file, file_info[1], entry.pattern)
+        except (OSError, ValueError, struct.error):
+            # damaged index file is not different from missing one
+            return
+        if positions is not None:
+            entry.positions.extend(positions)
+            entry.commit(0, file_info[1][-1], (), entry.revision)
+
+    def saveIfEnabled(self):
+        """Saves complete results for patterns to file if App_PersistSearchIndex setting is enabled and document is
+        not modified.
+        """
+        file_info = self._persistentFileInfo()
+        if file_info is None:
+            return
+
+        with self._lock:
+            patterns = {}
+            for pattern, entry in reversed(list(self._entries.items())):
+                with entry.lock:
+                    if entry.isComplete and len(patterns) < self.MaxPersistedPatternCount:
+                        patterns[pattern] = array.array('Q', entry.positions)
+
+        try:
+            os.makedirs(os.path.dirname(file_info[0]), exist_ok=True)
+            with open(file_info[0], 'wb') as index_file:
+                self._writeIndexFile(index_file, file_info[1], patterns)
+        except OSError:
+            pass
+
+    # Index file starts with magic and identity of file (utf-8 path prefixed with its length and four integers),
+    # followed by number of patterns and, for each pattern, its length, number of matches, pattern itself and
+    # positions of matches as raw array of 64-bit integers. All integers are little-endian.
+    IndexFileMagic = b'MHSINDEX\x01'
+
+    @classmethod
+    def _writeIndexFile(cls, index_file, identity, patterns):
+        path = identity[0].encode('utf-8')
+        index_file.write(cls.IndexFileMagic + struct.pack('<I', len(path)) + path + struct.pack('<4q', *identity[1:]))
+        index_file.write(struct.pack('<I', len(patterns)))
+        for pattern, positions in patterns.items():
+            if sys.byteorder != 'little':
+                positions.byteswap()
+            index_file.write(struct.pack('<IQ', len(pattern), len(positions)) + pattern)
+            positions.tofile(index_file)
+
+    @classmethod
+    def _readIndexFile(cls, index_file, identity, pattern):
+        """Returns positions of matches of :pattern: stored in index file, or None if file was written for another
+        identity or has no such pattern. Raises ValueError if file is damaged.
+        """
+        def read(size):
+            data = index_file.read(size)
+            if len(data) != size:
+                raise ValueError('search index file is truncated')
+            return data
+
+        if read(len(cls.IndexFileMagic)) != cls.IndexFileMagic:
+            raise ValueError('not a search index file')
+        path_length, = struct.unpack('<I', read(4))
+        stored_identity = (read(path_length).decode('utf-8'),) + struct.unpack('<4q', read(32))
+        if stored_identity != identity:
+            return None
+
+        document_length = identity[-1]
+        pattern_count, = struct.unpack('<I', read(4))
+        for pattern_index in range(pattern_count):
+            pattern_length, position_count = struct.unpack('<IQ', read(12))
+            if position_count > document_length:
+                raise ValueError('search index file is damaged')
+            if read(pattern_length) != pattern:
+                index_file.seek(position_count * 8, os.SEEK_CUR)
+                continue
+
+            positions = array.array('Q')
+            positions.frombytes(read(position_count * 8))
+            if sys.byteorder != 'little':
+                positions.byteswap()
+            if any(positions[index] >= positions[index + 1] for index in range(len(positions) - 1)) or \
+                    (positions and positions[-1] >= document_length):
+                raise ValueError('search index file is damaged')
+            return positions
+        return None
+
+
+_searchIndexes = weakref.WeakKeyDictionary()
+_searchIndexesLock = threading.Lock()
+
+
+def documentSearchIndex(document):
+    """Returns SearchIndex for given document, creating it on first call.
+    """
+    with _searchIndexesLock:
+        if document not in _searchIndexes:
+            _searchIndexes[document] = SearchIndex(document)
+        return _searchIndexes[document]
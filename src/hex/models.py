@@ -144,6 +144,28 @@ class ModelIndex(object):
         return self.data(ColumnModel.DataSizeRole)
 
 
+class ModelRowData(object):
+    """Describes all indexes on single model row: indexes themselves, their display texts, flags and document
+    positions. Lists have same length and are ordered by column.
+    """
+
+    def __init__(self, row=-1):
+        self.row = row
+        self.indexes = []
+        self.texts = []
+        self.flags = []
+        self.positions = []
+
+    def append(self, index, text, flags, position):
+        self.indexes.append(index)
+        self.texts.append(text)
+        self.flags.append(flags)
+        self.positions.append(position)
+
+    def __len__(self):
+        return len(self.indexes)
+
+
 class AbstractModel(QObject):
     def __init__(self):
         QObject.__init__(self)
@@ -546,6 +568,27 @@ class ColumnModel(AbstractModel):
         """Return index matching given document position. Can return virtual index"""
         raise NotImplementedError()
 
+    def rowData(self, row) -> ModelRowData:
+        """Return data for all indexes on given row, or None if there is no such row in model."""
+        rows = self.rowsData(row, 1)
+        return rows[0] if rows else None
+
+    def rowsData(self, first_row, count) -> list:
+        """Return list of ModelRowData objects for :count: rows starting from :first_row:. Rows that are not in
+        model are not included. Default implementation queries each index separately, models that can get data
+        for many indexes at once should reimplement it.
+        """
+        result = []
+        for row in range(max(first_row, 0), first_row + count):
+            if not self.hasRow(row):
+                break
+            row_data = ModelRowData(row)
+            for column in range(self.columnCount(row)):
+                index = self.index(row, column)
+                row_data.append(index, index.data(), index.flags, index.data(self.DocumentPositionRole))
+            result.append(row_data)
+        return result
+
     @property
     def regular(self):
         """Return True if this model is regular. Regular models have same number of columns on each row
@@ -616,6 +659,21 @@ class RegularColumnModel(ColumnModel):
         """
         raise NotImplementedError()
 
+    def textsForDocumentData(self, document_data, indexes, role=Qt.DisplayRole) -> list:
+        """Return list of texts for adjacent real :indexes: which data is :document_data:. Default implementation
+        calls textForDocumentData for each index, reimplement it if texts for many indexes can be produced
+        faster at once.
+        """
+        data_size = self.regularDataSize
+        return [self.textForDocumentData(document_data[j * data_size:(j + 1) * data_size], indexes[j], role)
+                for j in range(len(indexes))]
+
+    def flagsForDocumentData(self, document_data, index) -> int:
+        """Reimplement this method to add flags that depend on index data (for example, FlagBroken). Called by
+        rowsData for each index, :document_data: is empty for virtual indexes.
+        """
+        return 0
+
     def reset(self):
         ColumnModel.reset(self)
 
@@ -688,6 +746,70 @@ class RegularColumnModel(ColumnModel):
             flags |= self.FlagModified
         return flags
 
+    def rowsData(self, first_row, count):
+        """Reads data for all requested rows with single Document.read call. Modification flags are checked
+        for whole range first, so rows without modifications do not require any additional calls to document.
+        """
+        if self.document is None:
+            return ColumnModel.rowsData(self, first_row, count)
+
+        first_row = max(first_row, 0)
+        count = min(count, self.rowCount() - first_row)
+        if count <= 0:
+            return []
+
+        bytes_on_row = self.bytesOnRow
+        data_size = self.regularDataSize
+        frame_start = first_row * bytes_on_row
+
+        result = []
+        with utils.readlock(self.document.lock):
+            document_length = self.document.length
+            frame_length = max(0, min(count * bytes_on_row, document_length - frame_start))
+            if frame_length:
+                frame_data = bytes(self.document.view(frame_start, frame_length))
+                frame_modified = self.document.isRangeModified(frame_start, frame_length)
+            else:
+                frame_data = b''
+                frame_modified = False
+            last_real_offset = self.lastRealIndex.offset
+
+            # indexes that have data in document are adjacent and start from first frame index, so texts for
+            # all of them can be produced at once
+            real_indexes = []
+            for row in range(first_row, first_row + count):
+                for column in range(min(self.columnCount(row), self.regularColumnCount)):
+                    if row * bytes_on_row + column * data_size >= document_length:
+                        break
+                    real_indexes.append(ModelIndex(row, column, self))
+            real_texts = self.textsForDocumentData(frame_data, real_indexes)
+
+            for row in range(first_row, first_row + count):
+                row_data = ModelRowData(row)
+                row_start = row * bytes_on_row
+                row_modified = frame_modified and self.document.isRangeModified(row_start, bytes_on_row)
+                for column in range(self.columnCount(row)):
+                    index = ModelIndex(row, column, self)
+                    position = row_start + column * data_size
+                    if position >= document_length:
+                        document_data = b''
+                        text = self.virtualIndexData(index)
+                    else:
+                        data_offset = position - frame_start
+                        document_data = frame_data[data_offset:data_offset + data_size]
+                        text = real_texts[data_offset // data_size]
+
+                    flags = self.FlagEditable
+                    if row * self.regularColumnCount + column > last_real_offset:
+                        flags |= self.FlagVirtual
+                    elif row_modified and self.document.isRangeModified(position, data_size):
+                        flags |= self.FlagModified
+                    flags |= self.flagsForDocumentData(document_data, index)
+
+                    row_data.append(index, text, flags, position)
+                result.append(row_data)
+        return result
+
     def headerData(self, section, role=Qt.DisplayRole):
         if role == Qt.DisplayRole and 0 <= section < self.regularColumnCount:
             return formatters.IntegerFormatter(base=16).format(section * self.regularDataSize)
@@ -766,6 +888,7 @@ class RegularValueColumnModel(RegularColumnModel):
         self.valuecodec = valuecodec
         self.formatter = formatter
         self.columnsOnRow = columns_on_row
+        self._textTables = {}
         RegularColumnModel.__init__(self, document, delegate_type=delegate_type)
 
     @property
@@ -776,12 +899,51 @@ class RegularValueColumnModel(RegularColumnModel):
     def regularColumnCount(self):
         return self.columnsOnRow
 
+    def reset(self):
+        self._textTables = {}
+        RegularColumnModel.reset(self)
+
     def textForDocumentData(self, document_data, index, role=Qt.DisplayRole):
         try:
             decoded = self.valuecodec.decode(document_data)
         except struct.error:
             return '!' * self.regularTextLength if self.regularTextLength > 0 else '!'
-        return self.formatter.format(decoded)
+        return self.textForValue(decoded, role)
+
+    def textForValue(self, value, role=Qt.DisplayRole):
+        """Return text for index which data is decoded to :value:. Reimplement this method instead of
+        textForDocumentData to change text both for single indexes and whole rows.
+        """
+        return self.formatter.format(value)
+
+    def textsForDocumentData(self, document_data, indexes, role=Qt.DisplayRole):
+        data_size = self.regularDataSize
+        full_count = min(len(indexes), len(document_data) // data_size)
+
+        if data_size == 1:
+            # each possible byte value has its own precomputed text
+            texts = list(map(self._textTable(role).__getitem__, document_data[:full_count]))
+        else:
+            try:
+                values = self.valuecodec.decodeMany(document_data[:full_count * data_size])
+            except struct.error:
+                return RegularColumnModel.textsForDocumentData(self, document_data, indexes, role)
+            text_for_value = self.textForValue
+            texts = [text_for_value(value, role) for value in values]
+
+        if full_count < len(indexes):
+            texts += RegularColumnModel.textsForDocumentData(self, document_data[full_count * data_size:],
+                                                             indexes[full_count:], role)
+        return texts
+
+    def _textTable(self, role):
+        """Table of texts for all 256 possible values of single-byte index. Tables are dropped when model
+        is reset."""
+        table = self._textTables.get(role)
+        if table is None:
+            table = [self.textForValue(self.valuecodec.decode(bytes((byte,))), role) for byte in range(256)]
+            self._textTables[role] = table
+        return table
 
     def _saveData(self, delegate):
         if delegate.index and delegate.index.model is self:
@@ -899,6 +1061,27 @@ class FrameModel(AbstractModel):
         else:
             return self.sourceModel.indexFlags(self.toSourceIndex(index))
 
+    def rowsData(self, first_row, count):
+        """Unlike source model implementation, always returns :count: items - one for each frame row, even
+        if there is no corresponding source row (such rows are empty). Indexes in returned data belong to source
+        model. Data for index being edited is taken from active delegate.
+        """
+        first_row = max(first_row, 0)
+        count = max(min(count, self._rowCount - first_row), 0)
+        source_rows = {row_data.row: row_data for row_data in
+                       self.sourceModel.rowsData(first_row + self._firstRow, count)}
+
+        result = []
+        for source_row in range(first_row + self._firstRow, first_row + self._firstRow + count):
+            row_data = source_rows.get(source_row) or ModelRowData(source_row)
+            if self._activeDelegate is not None and self._activeDelegate.index.row == source_row:
+                for column, index in enumerate(row_data.indexes):
+                    if index == self._activeDelegate.index:
+                        row_data.texts[column] = self._activeDelegate.data(Qt.DisplayRole)
+                        row_data.flags[column] = self._activeDelegate.flags
+            result.append(row_data)
+        return result
+
     def toSourceIndex(self, index):
         if not index or index.model is self.sourceModel:
             return index
@@ -4,20 +4,34 @@ import copy
 import logging
 import time
 import itertools
-from PyQt4.QtCore import QObject, pyqtSignal, Qt, QEvent, QSize, QAbstractListModel, QAbstractTableModel, QModelIndex
+import collections
+import bisect
+import multiprocessing
+import concurrent.futures
+import asyncio
+import selectors
+import math
+from PyQt4.QtCore import QObject, pyqtSignal, Qt, QEvent, QSize, QAbstractListModel, QAbstractTableModel, QModelIndex, \
+                         QUrl, QTimer, QSocketNotifier, QEventLoop
 from PyQt4.QtGui import QWidget, QPushButton, QToolButton, QProgressBar, QHBoxLayout, QLabel, QMessageBox, qApp, \
                         QListView, QDialogButtonBox, QVBoxLayout, QTreeView, QItemDelegate, QStyleOptionProgressBarV2, \
                         QStyle
 import hex.utils as utils
 import hex.settings as settings
 import hex.appsettings as appsettings
+import hex.documents as documents
 
 
 class OperationError(Exception):
     pass
 
 
-class OperationState:
+class _OperationStatusInfo(object):
+    """Status constants and properties derived from status, shared by OperationState and OperationStateSnapshot.
+    """
+
+    __slots__ = ()
+
     # values for OperationState.status
     NotStarted, WaitingForStart, Running, Paused, Cancelled, Completed, Failed = range(7)
 
@@ -31,19 +45,6 @@ class OperationState:
         Failed: utils.tr('Failed')
     }
 
-    def __init__(self):
-        self.title = ''
-        self.status = self.NotStarted
-        self.progress = 0.0
-        self.progressText = ''
-        self.canPause = False
-        self.canCancel = False
-        self.messages = []  # each item is tuple - (text, level). Level is one of logging module
-                            # level constants.
-        self.results = {}
-        self.errorCount = 0
-        self.warningCount = 0
-
     @property
     def statusText(self):
         """Text representation of OperationState.status
@@ -63,12 +64,27 @@ class OperationState:
         """Indicates that operation is finished. Returns true if status is OperationState.Completed, OperationState.Failed or
         OperationState.Cancelled
         """
-        return self.status in (OperationState.Cancelled, OperationState.Completed, OperationState.Failed)
+        return self.status in (self.Cancelled, self.Completed, self.Failed)
 
     @property
     def isStarted(self):
         return self.status not in (self.NotStarted, self.WaitingForStart)
 
+
+class OperationState(_OperationStatusInfo):
+    def __init__(self):
+        self.title = ''
+        self.status = self.NotStarted
+        self.progress = 0.0
+        self.progressText = ''
+        self.canPause = False
+        self.canCancel = False
+        self.messages = []  # each item is tuple - (text, level). Level is one of logging module
+                            # level constants.
+        self.results = {}
+        self.errorCount = 0
+        self.warningCount = 0
+
     def __deepcopy__(self, memo):
         c = OperationState()
         c.title, c.status, c.progress, c.progressText, c.canPause, c.canCancel, c.errorCount, c.warningCount = (
@@ -80,6 +96,18 @@ class OperationState:
         return c
 
 
+class OperationStateSnapshot(_OperationStatusInfo, collections.namedtuple('OperationStateSnapshot', (
+        'version', 'title', 'status', 'progress', 'progressText', 'canPause', 'canCancel', 'errorCount',
+        'warningCount', 'resultCount', 'messageCount'))):
+    """Immutable copy of scalar fields of OperationState. Unlike OperationState, snapshot has only number of results
+    and messages, so taking it does not depend on how many results operation has. Use Operation.resultsPage and
+    Operation.messagesPage to access results and messages themselves.
+    Operation increments version each time its state is changed, so two snapshots with same version are equal.
+    """
+
+    __slots__ = ()
+
+
 class _CallbackRequestEvent(QEvent):
     _eventType = QEvent.registerEventType()
 
@@ -157,6 +185,17 @@ class Operation(QObject):
           exception raised)
 
         - use WrapperOperation to execute any callable in operation context.
+
+        - reimplement Operation.processTask to return ProcessTask describing work and run operation with
+          RunModeProcess. Task is executed in separate process (see ProcessTask), and Operation just relays
+          progress, messages and results reported by it.
+
+    Results added with Operation.addResult are not delivered one by one: they are buffered and thread operation object
+    belongs to (usually GUI thread) takes at most ResultsBatchSize of them each ResultsInterval milliseconds, emitting
+    single newResults signal for each batch. If there are MaxPendingResults results waiting for delivery, operation
+    code adding new result is blocked until GUI takes some of them (but not longer than ResultsBackpressureTimeout
+    seconds, so operation is never blocked forever if GUI thread is busy waiting for operation). After timeout expires,
+    results are added without waiting until GUI takes enough of them to bring pending results below the limit.
     """
 
     statusChanged = pyqtSignal(int)
@@ -170,51 +209,90 @@ class Operation(QObject):
     newResults = pyqtSignal(list)
     finished = pyqtSignal(int)
     started = pyqtSignal()
+    _resultsDeliveryRequested = pyqtSignal()
 
     # predefined commands for use with sendCommand
     PauseCommand = 'pause'
     ResumeCommand = 'resume'
     CancelCommand = 'cancel'
 
-    RunModeNotStarted, RunModeThisThread, RunModeNewThread = range(3)
+    RunModeNotStarted, RunModeThisThread, RunModeNewThread, RunModeProcess = range(4)
+
+    # priority classes used by OperationPool to order waiting operations. Interactive operations are started
+    # immediately regardless of pool limits.
+    PriorityInteractive, PriorityNormal, PriorityBackground = range(3)
 
     DefaultErrorPolicy = 'default'
     IgnoreErrorPolicy = 'ignore'
     FailErrorPolicy = 'fail'
     AskErrorPolicy = 'ask'
 
+    # parameters of results delivery, can be changed for single operation before it is started
+    ResultsInterval = 16  # milliseconds between batches, enough to keep GUI at 60 fps
+    ResultsBatchSize = 2000
+    MaxPendingResults = 100000
+    ResultsBackpressureTimeout = 1.0  # seconds
+
     def __init__(self, title='', parent=None):
         QObject.__init__(self)
         self.lock = threading.RLock()
 
         self._state = OperationState()
+        self._stateVersion = 0
         self._commandsQueue = queue.Queue()
         self._waitFinish = threading.Condition(self.lock)
         self._waitResults = threading.Condition(self.lock)
+        self._resultsDrained = threading.Condition(self.lock)
+        self._resultWaiterCount = 0
         self._manualScope = False  # if True, operation will not be automatically finished. Ignored if runMode ==
                                    # RunModeThisThread. This value should be set only by _InlineOperation class.
         self._daemon = None
         self._thread = None
 
         self._runMode = self.RunModeNotStarted
+        self._priority = self.PriorityNormal
         self._requestDoWork = True
         self._state.title = title
         self._waitUserCallback = threading.Condition(self.lock)
         self._callbackAccepted = False
         self._callbackResult = None
         self._subOperationStack = []
-        self._newResults = []
+        self._newResults = collections.deque()
+        self._resultNames = []  # names of results in order they were added, for paging results without walking dict
         self._resultsTimer = None
+        self._backpressureSuspended = False  # set when GUI did not take results in time, cleared when it catches up
 
         self._errorPolicy = self.DefaultErrorPolicy
 
         self._parentOperation = parent
 
+        # timer can be started only from thread operation object belongs to, so request is queued if operation
+        # is started from another thread
+        self._resultsDeliveryRequested.connect(self._startResultsDelivery)
+
     def timerEvent(self, event):
         with self.lock:
-            if event.timerId() == self._resultsTimer and self._newResults:
-                self.newResults.emit(self._newResults)
-                self._newResults = []
+            if event.timerId() == self._resultsTimer:
+                self._deliverResults(self.ResultsBatchSize)
+                if self._state.isFinished and not self._newResults:
+                    self.killTimer(self._resultsTimer)
+                    self._resultsTimer = None
+
+    def _startResultsDelivery(self):
+        with self.lock:
+            if self._resultsTimer is None and not (self._state.isFinished and not self._newResults):
+                self._resultsTimer = self.startTimer(self.ResultsInterval)
+
+    def _deliverResults(self, max_count):
+        """Emits newResults with at most :max_count: results waiting for delivery.
+        """
+        with self.lock:
+            if self._newResults:
+                batch = [self._newResults.popleft() for j in range(min(max_count, len(self._newResults)))]
+                if len(self._newResults) < self.MaxPendingResults:
+                    self._backpressureSuspended = False
+                self._resultsDrained.notify_all()
+                self.newResults.emit(batch)
 
     @property
     def title(self):
@@ -223,15 +301,68 @@ class Operation(QObject):
 
     @property
     def state(self):
+        """Returns full copy of operation state, including all results and messages. This can be expensive for
+        operations with large number of results; use Operation.snapshot when only scalar fields are needed.
+        """
         with self.lock:
-            # return self._state
             return copy.deepcopy(self._state)
 
+    @property
+    def snapshot(self):
+        """Returns OperationStateSnapshot describing current state. Cost of taking snapshot does not depend on number
+        of results and messages.
+        """
+        with self.lock:
+            state = self._state
+            return OperationStateSnapshot(self._stateVersion, state.title, state.status, state.progress,
+                                          state.progressText, state.canPause, state.canCancel, state.errorCount,
+                                          state.warningCount, len(state.results), len(state.messages))
+
+    @property
+    def stateVersion(self):
+        """Number that is incremented each time any part of operation state is changed.
+        """
+        with self.lock:
+            return self._stateVersion
+
+    def resultsPage(self, first, count):
+        """Returns list of at most :count: (name, value) tuples for results starting from :first: one, in order
+        results were added.
+        """
+        with self.lock:
+            return [(name, self._state.results[name]) for name in self._resultNames[first:first + count]]
+
+    def messagesPage(self, first, count):
+        """Returns list of at most :count: (text, level) tuples for messages starting from :first: one.
+        """
+        with self.lock:
+            return self._state.messages[first:first + count]
+
     @property
     def runMode(self):
         with self.lock:
             return self._runMode
 
+    @property
+    def priority(self):
+        with self.lock:
+            return self._priority
+
+    @priority.setter
+    def priority(self, new_priority):
+        with self.lock:
+            if self._state.status != OperationState.NotStarted:
+                raise OperationError('priority cannot be changed after operation is started')
+            self._priority = new_priority
+
+    @property
+    def concurrencyGroup(self):
+        """Operations with same concurrency group (for example, operations that read same document) are limited by
+        OperationPool to run at most App_PoolGroupOperationLimit at once. None means that operation does not belong
+        to any group.
+        """
+        return None
+
     @property
     def requestDoWork(self):
         with self.lock:
@@ -275,16 +406,28 @@ class Operation(QObject):
         with self.lock:
             if not command:
                 raise OperationError('invalid command')
-            if not self.onCommandReceived(command):
+            cancel_waiting = command == self.CancelCommand and self._state.status == OperationState.WaitingForStart \
+                                and self._runMode in (self.RunModeNewThread, self.RunModeProcess)
+            if not cancel_waiting and not self.onCommandReceived(command):
                 self._commandsQueue.put(command)
 
+        # operation that is not started yet can be cancelled without waiting for pool to start it
+        if cancel_waiting:
+            if globalOperationPool().removeWaitingOperation(self):
+                self._cancel()
+            else:
+                # pool has already started operation, it will take command from queue
+                with self.lock:
+                    if not self.onCommandReceived(command):
+                        self._commandsQueue.put(command)
+
     def run(self, runMode=RunModeNewThread, daemon=False):
         """Start operation. Fails if operation already started.
         """
         with self.lock:
             if self._state.status != OperationState.NotStarted:
                 raise OperationError('operation already started or waiting for start')
-            if runMode not in (self.RunModeThisThread, self.RunModeNewThread):
+            if runMode not in (self.RunModeThisThread, self.RunModeNewThread, self.RunModeProcess):
                 raise OperationError('invalid run mode')
             self._runMode = runMode
             self._daemon = daemon
@@ -293,6 +436,47 @@ class Operation(QObject):
         globalOperationContext()._enterOperation(self)
         globalOperationPool().addOperation(self)
 
+    async def runAsync(self, run_mode=RunModeNewThread, daemon=False):
+        """Coroutine that starts operation (if it is not started yet) and returns its final status after it finishes.
+        No thread is blocked while waiting. Cancelling coroutine sends cancel command to operation.
+        """
+        finished = self._finishedFuture()
+        if self.snapshot.status == OperationState.NotStarted:
+            self.run(run_mode, daemon)
+        try:
+            return await finished
+        except asyncio.CancelledError:
+            self.sendCancel()
+            raise
+
+    def resultBatches(self):
+        """Returns asynchronous iterator over lists of (name, value) results, as they are delivered by newResults
+        signal. First batch contains results delivered before iterator was created. Iteration stops when operation
+        finishes.
+        """
+        return _ResultBatchIterator(self)
+
+    def _finishedFuture(self):
+        """Returns asyncio future for current event loop that is resolved with operation final status.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def resolve(status):
+            if not future.done():
+                future.set_result(status)
+            self.finished.disconnect(on_finished)
+
+        def on_finished(status):
+            loop.call_soon_threadsafe(resolve, status)
+
+        with self.lock:
+            if self._state.isFinished:
+                future.set_result(self._state.status)
+            else:
+                self.finished.connect(on_finished, Qt.DirectConnection)
+        return future
+
     def sendPause(self):
         """Send pause command to operation. Note that this method does not check if pause
         command has any meaning at the moment.
@@ -339,7 +523,11 @@ class Operation(QObject):
             if threading.current_thread() is self.opThread:
                 raise OperationError('deadlock detected: waiting for operation results from same thread')
             if not self._state.isFinished:
-                self._waitResults.wait()
+                self._resultWaiterCount += 1
+                try:
+                    self._waitResults.wait()
+                finally:
+                    self._resultWaiterCount -= 1
 
     def takeCommand(self, block=False, timeout=None):
         """Get oldest command from queue, removing it. Arguments :block: and :timeout: has
@@ -354,14 +542,16 @@ class Operation(QObject):
         with self.lock:
             self.setStatus(OperationState.Running)
             self.started.emit()
-            self._resultsTimer = self.startTimer(300)
+            if self._parentOperation is None:
+                # results of sub-operation are delivered synchronously when it finishes, so parent operation that
+                # holds its lock while sub-operation runs never blocks thread delivering results
+                self._resultsDeliveryRequested.emit()
 
     def _finalize(self):
         with self.lock:
-            if self._newResults:
-                self.newResults.emit(self._newResults)
-            self.killTimer(self._resultsTimer)
-            self._resultsTimer = None
+            # deliver all results left, timer will stop itself after it
+            while self._newResults:
+                self._deliverResults(self.ResultsBatchSize)
 
     def _finish(self):
         """Finish operation. If operation has error messages (state.errorCount > 0) final
@@ -386,6 +576,48 @@ class Operation(QObject):
         """
         raise NotImplementedError()
 
+    def processTask(self):
+        """Should be reimplemented to return ProcessTask for operations that can be run with RunModeProcess.
+        """
+        raise NotImplementedError()
+
+    def _doWorkInProcess(self):
+        """Executes task returned by Operation.processTask in process pool and relays events reported by it until
+        task is finished. Cancel command sent to operation is passed to task.
+        """
+        channel, cancel_event = _processManager().Queue(), _processManager().Event()
+        future = globalProcessPool().submit(_executeProcessTask, self.processTask(), channel, cancel_event)
+        self.setCanCancel(True)
+
+        while True:
+            if self.takeCommand() == self.CancelCommand:
+                cancel_event.set()
+
+            try:
+                event = channel.get(timeout=0.05)
+            except queue.Empty:
+                if future.done() and channel.empty():
+                    # process has failed before reporting anything, result will raise its exception
+                    future.result()
+                    return
+                continue
+
+            kind, args = event[0], event[1:]
+            if kind == 'progress':
+                self.setProgress(*args)
+            elif kind == 'progressText':
+                self.setProgressText(*args)
+            elif kind == 'message':
+                self.addMessage(*args)
+            elif kind == 'results':
+                for result_name, result_value in args[0]:
+                    self.addResult(result_name, result_value)
+            elif kind == 'done':
+                future.result()  # raises exception task has failed with
+                if args[0]:
+                    self._cancel()
+                return
+
     def onCommandReceived(self, command):
         """Method called before received command will be placed into queue.
         If method returns true, command will be considered as processed and will not be placed into queue.
@@ -412,7 +644,10 @@ class Operation(QObject):
                     self._requestDoWork = False
                     self.lock.release()
                     try:
-                        self.doWork()
+                        if self._runMode == self.RunModeProcess:
+                            self._doWorkInProcess()
+                        else:
+                            self.doWork()
                     except Exception as exc:
                         self.addMessage(str(exc), logging.ERROR)
                         print('error inside operation: {0}'.format(exc))
@@ -423,7 +658,7 @@ class Operation(QObject):
 
                     if threading.current_thread() is utils.guiThread:
                         qApp.processEvents()
-                elif not self._manualScope or self.runMode == Operation.RunModeNewThread:
+                elif not self._manualScope or self.runMode in (Operation.RunModeNewThread, Operation.RunModeProcess):
                     self._finish()
                 else:
                     break
@@ -432,6 +667,7 @@ class Operation(QObject):
         with self.lock:
             if getattr(self._state, attrib_name) != value:
                 setattr(self._state, attrib_name, value)
+                self._stateVersion += 1
                 attrib_signal = attrib_name + 'Changed'
                 getattr(self, attrib_signal).emit(value)
 
@@ -476,9 +712,24 @@ class Operation(QObject):
             if self._state.isFinished:
                 raise OperationError('operation already finished')
 
+            if len(self._newResults) >= self.MaxPendingResults and self._resultsTimer is not None and \
+                            not self._backpressureSuspended and threading.current_thread() is not utils.guiThread:
+                # too many results are waiting for delivery, give GUI a chance to take them. If it does not take
+                # anything in time, it is probably waiting for us and we should not block again until it catches up.
+                while len(self._newResults) >= self.MaxPendingResults:
+                    if not self._resultsDrained.wait(self.ResultsBackpressureTimeout):
+                        self._backpressureSuspended = True
+                        break
+                if self._state.isFinished:
+                    raise OperationError('operation already finished')
+
+            if new_result_name not in self._state.results:
+                self._resultNames.append(new_result_name)
             self._state.results[new_result_name] = new_result_value
+            self._stateVersion += 1
             self._newResults.append((new_result_name, new_result_value))
-            self._waitResults.notify_all()
+            if self._resultWaiterCount:
+                self._waitResults.notify_all()
 
     def addMessage(self, message, level=logging.INFO):
         """Add message to operation message list. :level: should be from logging module level enumeration.
@@ -486,6 +737,7 @@ class Operation(QObject):
         """
         with self.lock:
             self._state.messages.append((message, level))
+            self._stateVersion += 1
             if level >= logging.ERROR:
                 self._state.errorCount += 1
             elif level == logging.WARNING:
@@ -525,7 +777,7 @@ class Operation(QObject):
                     raise OperationError('cannot execute sub-operation in context of finished operation')
                 if self._state.status != OperationState.Running:
                     raise OperationError('operation state should be Running to execute sub-operation')
-                if subop.state.isStarted:
+                if subop.snapshot.isStarted:
                     raise OperationError('invalid sub-operation: should be alive and not started')
                 subop._parentOperation = self
 
@@ -537,11 +789,12 @@ class Operation(QObject):
 
                 self._subOperationStack.append((subop, copy.copy(self._state), progress_weight, process_results,
                                                 result_name_converter, finish_on_fail))
-                saved_state = self.state
+                saved_state = self.snapshot
+                subop_state = subop.snapshot
 
-                self.setCanPause(subop.state.canPause)
-                self.setCanCancel(self._state.canCancel and subop.canCancel)
-                self.setProgressText(subop.state.progressText or self._state.progressText)
+                self.setCanPause(subop_state.canPause)
+                self.setCanCancel(self._state.canCancel and subop_state.canCancel)
+                self.setProgressText(subop_state.progressText or self._state.progressText)
 
                 # if current progress value + progress_weight is greater 100, decrease
                 # current progress
@@ -598,7 +851,7 @@ class Operation(QObject):
             self.setProgress(saved_state.progress + subop_progress_weight)
             self.setProgressText(saved_state.progressText)
 
-            if finish_on_fail and subop.state.status == OperationState.Failed:
+            if finish_on_fail and subop.snapshot.status == OperationState.Failed:
                 self._finish()  # final state will be set to OperationState.Failed as error messages
                                  # are directly written to operation
 
@@ -760,9 +1013,13 @@ class OperationContext(QObject):
 
     def _leaveOperation(self, operation):
         with self.lock:
-            thread_ident = operation.opThread.ident
+            # operation can be finished without being started (when cancelled while waiting in pool)
+            thread_ident = operation.opThread.ident if operation.opThread is not None else None
             if thread_ident in self._operations:
-                self._operations[thread_ident].pop()
+                if thread_ident is None:
+                    self._operations[None] = [op for op in self._operations[None] if op is not operation]
+                else:
+                    self._operations[thread_ident].pop()
                 if not self._operations[thread_ident]:
                     del self._operations[thread_ident]
                 self.operationRemoved.emit(operation)
@@ -891,44 +1148,162 @@ class SequentialOperationGroup(Operation):
                     self.requestDoWork = True
 
 
+class _PoolWorker(object):
+    """Thread owned by OperationPool that runs operations one after another. Daemon flag of worker thread is same as
+    Operation.daemon of operations it runs.
+    """
+
+    def __init__(self, pool, operation, daemon):
+        self.pool = pool
+        self.operation = operation
+        self.daemon = daemon
+        self.wakeUp = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=daemon)
+        self.thread.start()
+
+    def _run(self):
+        while self.operation is not None:
+            try:
+                self.operation._work()
+            finally:
+                self.operation = self.pool._onWorkerDone(self)
+
+
 class OperationPool(QObject):
-    """Operation pool allows to limit number of parallel threads for operations."""
+    """Operation pool runs operations started with RunModeNewThread (and relays of RunModeProcess operations) on
+    reusable worker threads. Waiting operations are started in order of their priorities (and in order of adding for
+    same priority). Number of running operations is limited by App_PoolOperationLimit, and number of running
+    operations with same Operation.concurrencyGroup is limited by App_PoolGroupOperationLimit; interactive
+    operations ignore both limits and never wait.
+    Daemon and non-daemon operations are run by separate sets of daemon and non-daemon workers, so non-daemon
+    operations keep interpreter alive until they are finished.
+    Worker threads that have nothing to do for IdleWorkerTimeout seconds are stopped. Idle non-daemon workers
+    are stopped as soon as main thread finishes too, so they do not keep interpreter alive themselves.
+    """
+
+    IdleWorkerTimeout = 30
+    # how often idle non-daemon worker checks if main thread is finished
+    MainThreadCheckInterval = 0.5
 
     def __init__(self):
         QObject.__init__(self)
         self.moveToThread(qApp.thread())
         self.lock = threading.RLock()
-        self._waiting = []
+        self._waiting = []  # sorted list of (priority, sequence number, operation)
+        self._sequence = itertools.count()
         self._limit = settings.globalSettings()[appsettings.App_PoolOperationLimit]
-        self._threadCount = 0  # number of threads in which operations are run
+        self._groupLimit = settings.globalSettings()[appsettings.App_PoolGroupOperationLimit]
+        self._runningCount = 0  # number of running operations that are not interactive
+        self._groupRunningCounts = collections.Counter()
+        self._runningWorkerCount = 0
+        self._idleWorkers = {True: [], False: []}  # idle daemon and non-daemon workers
+
+    @property
+    def workerCount(self):
+        """Number of worker threads that are running operations or waiting for them.
+        """
+        with self.lock:
+            return self._runningWorkerCount + sum(len(workers) for workers in self._idleWorkers.values())
 
     def addOperation(self, new_operation):
+        assert new_operation.snapshot.status == OperationState.WaitingForStart
+
+        if new_operation.runMode == Operation.RunModeThisThread:
+            new_operation._work()
+        elif new_operation.runMode in (Operation.RunModeNewThread, Operation.RunModeProcess):
+            with self.lock:
+                bisect.insort(self._waiting, (new_operation.priority, next(self._sequence), new_operation))
+                self._startWaiting()
+
+    def removeWaitingOperation(self, operation):
+        """Removes operation that was not started yet from queue. Returns False if operation is already started.
+        """
         with self.lock:
-            with new_operation.lock:
-                assert new_operation.state.status == OperationState.WaitingForStart
+            for index, waiting in enumerate(self._waiting):
+                if waiting[2] is operation:
+                    del self._waiting[index]
+                    return True
+            return False
 
-                new_operation.finished.connect(self._onOperationFinished)
+    def _canStart(self, operation):
+        if operation.priority == Operation.PriorityInteractive:
+            return True
+        group = operation.concurrencyGroup
+        return self._runningCount < self._limit and (group is None or self._groupRunningCounts[group] < self._groupLimit)
 
-                if new_operation.runMode == Operation.RunModeNewThread and self._threadCount >= self._limit:
-                    self._waiting.append(new_operation)
-                else:
-                    self._runOperation(new_operation)
+    def _startWaiting(self):
+        """Starts all waiting operations that are allowed to run by pool limits. Should be called with lock held.
+        """
+        index = 0
+        while index < len(self._waiting):
+            operation = self._waiting[index][2]
+            if self._canStart(operation):
+                del self._waiting[index]
+                self._startOperation(operation)
+            else:
+                index += 1
+
+    def _startOperation(self, operation):
+        if operation.priority != Operation.PriorityInteractive:
+            self._runningCount += 1
+        if operation.concurrencyGroup is not None:
+            self._groupRunningCounts[operation.concurrencyGroup] += 1
+
+        self._runningWorkerCount += 1
+        idle_workers = self._idleWorkers[bool(operation.daemon)]
+        if idle_workers:
+            worker = idle_workers.pop()
+            worker.operation = operation
+            worker.wakeUp.set()
+        else:
+            _PoolWorker(self, operation, bool(operation.daemon))
 
-    def _onOperationFinished(self):
-        operation = self.sender()
+    def _onWorkerDone(self, worker):
+        """Called by worker after operation was finished. Returns next operation worker should run, or None if worker
+        should be stopped.
+        """
         with self.lock:
-            if operation.runMode == Operation.RunModeNewThread:
-                self._threadCount -= 1
-                if self._threadCount < self._limit and self._waiting:
-                    self._runOperation(self._waiting.pop(0))
+            operation = worker.operation
+            if operation.priority != Operation.PriorityInteractive:
+                self._runningCount -= 1
+            group = operation.concurrencyGroup
+            if group is not None:
+                self._groupRunningCounts[group] -= 1
+                if not self._groupRunningCounts[group]:
+                    del self._groupRunningCounts[group]
+
+            self._runningWorkerCount -= 1
+            worker.operation = None
+            worker.wakeUp.clear()
+            self._idleWorkers[worker.daemon].append(worker)
+            # slot of finished operation can be taken by waiting one, possibly by this worker
+            self._startWaiting()
+
+        if self._waitForOperation(worker):
+            return worker.operation
 
-    def _runOperation(self, operation):
         with self.lock:
-            if operation.runMode == Operation.RunModeThisThread:
-                operation._work()
-            elif operation.runMode == Operation.RunModeNewThread:
-                threading.Thread(target=operation._work, daemon=operation.daemon).start()
-                self._threadCount += 1
+            if worker in self._idleWorkers[worker.daemon]:
+                self._idleWorkers[worker.daemon].remove(worker)
+                return None
+        # operation was assigned to worker right after timeout expired
+        worker.wakeUp.wait()
+        return worker.operation
+
+    def _waitForOperation(self, worker):
+        """Waits until idle worker is given operation to run. Returns False if worker should be stopped instead.
+        """
+        if worker.daemon:
+            return worker.wakeUp.wait(self.IdleWorkerTimeout)
+
+        deadline = time.monotonic() + self.IdleWorkerTimeout
+        while threading.main_thread().is_alive():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if worker.wakeUp.wait(min(remaining, self.MainThreadCheckInterval)):
+                return True
+        return worker.wakeUp.is_set()
 
 
 _globalOperationPool = None
@@ -941,7 +1316,334 @@ def globalOperationPool():
     return _globalOperationPool
 
 
+class _ResultBatchIterator(object):
+    def __init__(self, operation):
+        self._operation = operation
+        self._loop = asyncio.get_event_loop()
+        self._batches = asyncio.Queue()
+        self._finished = False
+        self._connected = False
+
+        with operation.lock:
+            # results that are not delivered yet will be received with newResults
+            delivered_count = len(operation._state.results) - len(operation._newResults)
+            if delivered_count:
+                self._batches.put_nowait(operation.resultsPage(0, delivered_count))
+            if operation._state.isFinished:
+                self._batches.put_nowait(None)
+            else:
+                operation.newResults.connect(self._onNewResults, Qt.DirectConnection)
+                operation.finished.connect(self._onFinished, Qt.DirectConnection)
+                self._connected = True
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._finished:
+            raise StopAsyncIteration()
+        batch = await self._batches.get()
+        if batch is None:
+            self._finished = True
+            if self._connected:
+                self._operation.newResults.disconnect(self._onNewResults)
+                self._operation.finished.disconnect(self._onFinished)
+            raise StopAsyncIteration()
+        return batch
+
+    def _onNewResults(self, results):
+        self._loop.call_soon_threadsafe(self._batches.put_nowait, list(results))
+
+    def _onFinished(self, status):
+        self._loop.call_soon_threadsafe(self._batches.put_nowait, None)
+
+
+class _QtYield(Exception):
+    pass
+
+
+class _QtSelector(selectors.BaseSelector):
+    """Selector for asyncio event loop driven by Qt event loop. It never blocks: when asyncio loop is going to wait
+    for events, selector interrupts loop iteration and remembers how long loop wanted to wait, so Qt event loop can
+    wait instead of it.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self.timeout = None
+        self._polled = False
+        self._iterationsLeft = 0
+
+    def beginStep(self, max_iterations):
+        self._polled = False
+        self._iterationsLeft = max_iterations
+
+    def register(self, fileobj, events, data=None):
+        return self._selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._selector.modify(fileobj, events, data)
+
+    def select(self, timeout=None):
+        if not self._polled:
+            # first iteration of step should process file events that woke us up
+            self._polled = True
+            return self._selector.select(0)
+        elif timeout is not None and timeout <= 0 and self._iterationsLeft > 0:
+            self._iterationsLeft -= 1
+            return self._selector.select(0)
+        self.timeout = 0 if timeout is not None and timeout <= 0 else timeout
+        raise _QtYield()
+
+    def close(self):
+        self._selector.close()
+
+    def get_key(self, fileobj):
+        return self._selector.get_key(fileobj)
+
+    def get_map(self):
+        return self._selector.get_map()
+
+    def fileno(self):
+        return self._selector.fileno() if hasattr(self._selector, 'fileno') else None
+
+
+class _QtEventLoop(asyncio.SelectorEventLoop):
+    """Asyncio event loop which has no loop of its own: its iterations are executed by Qt event loop of GUI thread
+    when callbacks are scheduled, timers expire or watched file descriptors become ready (including self-pipe written
+    by call_soon_threadsafe).
+    """
+
+    MaxIterationsPerStep = 100
+    FilePollInterval = 10  # used only if selector cannot be watched by QSocketNotifier
+
+    def __init__(self):
+        self._qtSelector = _QtSelector()
+        asyncio.SelectorEventLoop.__init__(self, self._qtSelector)
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._step)
+        self._notifier = None
+        fileno = self._qtSelector.fileno()
+        if fileno is not None:
+            self._notifier = QSocketNotifier(fileno, QSocketNotifier.Read)
+            self._notifier.activated.connect(self._step)
+
+    def call_soon(self, *args, **kwargs):
+        handle = asyncio.SelectorEventLoop.call_soon(self, *args, **kwargs)
+        self._wakeUp()
+        return handle
+
+    def call_at(self, *args, **kwargs):
+        handle = asyncio.SelectorEventLoop.call_at(self, *args, **kwargs)
+        self._wakeUp()
+        return handle
+
+    def close(self):
+        self._timer.stop()
+        if self._notifier is not None:
+            self._notifier.setEnabled(False)
+        asyncio.SelectorEventLoop.close(self)
+
+    def _wakeUp(self):
+        # callbacks scheduled while loop is running are processed in current step
+        if not self.is_running() and not self.is_closed():
+            self._timer.start(0)
+
+    def _step(self):
+        if self.is_running() or self.is_closed():
+            return
+        self._qtSelector.beginStep(self.MaxIterationsPerStep)
+        try:
+            self.run_forever()
+        except _QtYield:
+            pass
+        timeout = self._qtSelector.timeout
+        if timeout is None and self._notifier is None and self._qtSelector.get_map():
+            timeout = self.FilePollInterval / 1000
+        if timeout is None:
+            self._timer.stop()
+        else:
+            self._timer.start(int(math.ceil(timeout * 1000)))
+
+
+_qtEventLoop = None
+
+
+def qtEventLoop():
+    """Returns asyncio event loop driven by Qt event loop. Loop is created on first call and installed as event loop
+    of GUI thread. Should be called only from GUI thread.
+    """
+    global _qtEventLoop
+    if _qtEventLoop is None:
+        _qtEventLoop = _QtEventLoop()
+        asyncio.set_event_loop(_qtEventLoop)
+    return _qtEventLoop
+
+
+def startCoroutine(coroutine):
+    """Schedules coroutine to be run by asyncio event loop driven by Qt event loop and returns asyncio.Task for it.
+    Returns immediately, so it is safe to call from slots. Should be called only from GUI thread.
+    """
+    return asyncio.ensure_future(coroutine, loop=qtEventLoop())
+
+
+def runCoroutine(coroutine):
+    """Runs coroutine and returns its result. In GUI thread coroutine is run by event loop returned by qtEventLoop,
+    and nested QEventLoop is executed until coroutine is finished. As any nested event loop, it can re-enter slots
+    that are waiting for this call to return, so do not call it from slots: use startCoroutine there. It also cannot
+    be called from coroutine (await it instead). In other threads coroutine is run in new asyncio event loop.
+    """
+    if threading.current_thread() is utils.guiThread:
+        loop = qtEventLoop()
+        if loop.is_running():
+            raise RuntimeError('runCoroutine cannot be called from coroutine running in GUI thread')
+        task = startCoroutine(coroutine)
+        if not task.done():
+            qt_loop = QEventLoop()
+            task.add_done_callback(lambda task: qt_loop.quit())
+            qt_loop.exec_()
+        return task.result()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class ProcessTask(object):
+    """Picklable description of work executed in separate process by operation started with RunModeProcess.
+    Reimplement ProcessTask.execute with code to be executed: it gets ProcessTaskContext which should be used to report
+    progress, messages and results and to check if task was cancelled. Task object is copied to process, so it should
+    contain only simple data (paths, ranges and parameters), not documents or devices.
+    """
+
+    def execute(self, context):
+        raise NotImplementedError()
+
+
+class DeviceRangeTask(ProcessTask):
+    """Task that works with range of file document is loaded from. Process opens its own read-only device for this
+    file, so document should not have unsaved modifications in this range.
+    """
+
+    def __init__(self, url, range_start=0, range_length=None):
+        self.url = url
+        self.rangeStart = range_start
+        self.rangeLength = range_length
+
+    @classmethod
+    def fromDocument(cls, document, start=0, length=None, **kwargs):
+        if length is None:
+            length = document.length - start
+        device = document.device
+        if device is None or not device.url.isLocalFile():
+            raise OperationError('document should be loaded from file')
+        elif document.isRangeModified(start, length):
+            raise OperationError('document range has unsaved modifications')
+
+        load_options = device.loadOptions
+        device_start = load_options.rangeStart if load_options.rangeLoad else 0
+        return cls(device.url.toString(), device_start + start, length, **kwargs)
+
+    def openDevice(self):
+        options = documents.FileLoadOptions()
+        options.readOnly = True
+        if self.rangeStart or self.rangeLength is not None:
+            options.rangeLoad = True
+            options.rangeStart = self.rangeStart
+            options.rangeLength = self.rangeLength if self.rangeLength is not None else 0
+        return documents.deviceFromUrl(QUrl(self.url), options)
+
+
+class ProcessTaskContext(object):
+    """Interface ProcessTask uses to communicate with Operation it is executed for. Results are sent to operation
+    in batches.
+    """
+
+    ResultsBatchSize = 1000
+    ResultsInterval = 0.1  # seconds
+
+    def __init__(self, channel, cancel_event):
+        self._channel = channel
+        self._cancelEvent = cancel_event
+        self._progress = 0.0
+        self._results = []
+        self._lastResultsTime = time.monotonic()
+
+    @property
+    def isCancelled(self):
+        return self._cancelEvent.is_set()
+
+    def setProgress(self, progress):
+        if abs(progress - self._progress) >= 0.01:
+            self._progress = progress
+            self._channel.put(('progress', progress))
+
+    def setProgressText(self, text):
+        self._channel.put(('progressText', text))
+
+    def addMessage(self, message, level=logging.INFO):
+        self._channel.put(('message', message, level))
+
+    def addResult(self, name, value):
+        self._results.append((name, value))
+        if len(self._results) >= self.ResultsBatchSize or \
+                        time.monotonic() - self._lastResultsTime >= self.ResultsInterval:
+            self.flushResults()
+
+    def flushResults(self):
+        if self._results:
+            self._channel.put(('results', self._results))
+            self._results = []
+        self._lastResultsTime = time.monotonic()
+
+
+def _executeProcessTask(task, channel, cancel_event):
+    # this function is executed in pool process
+    context = ProcessTaskContext(channel, cancel_event)
+    try:
+        task.execute(context)
+    finally:
+        context.flushResults()
+        channel.put(('done', context.isCancelled))
+
+
+_globalProcessPool = None
+_globalProcessManager = None
+_processPoolLock = threading.Lock()
+
+
+def globalProcessPool():
+    """Process pool RunModeProcess operations are executed in. Pool has process for each processor core.
+    """
+    global _globalProcessPool
+    with _processPoolLock:
+        if _globalProcessPool is None:
+            _globalProcessPool = concurrent.futures.ProcessPoolExecutor(multiprocessing.cpu_count())
+        return _globalProcessPool
+
+
+def _processManager():
+    # queues and events passed to pool processes should be created by manager
+    global _globalProcessManager
+    with _processPoolLock:
+        if _globalProcessManager is None:
+            _globalProcessManager = multiprocessing.Manager()
+        return _globalProcessManager
+
+
 class OperationWidget(object):
+    """Base for widgets displaying operation state. Widget subscribes to change signals of state fields listed in
+    :deps: and updates itself from operation snapshot on next timer tick after any of them is changed.
+    """
+
     def __init__(self, deps):
         self._operation = None
         self._deps = deps
@@ -967,14 +1669,16 @@ class OperationWidget(object):
 
         self._setOperation(old_operation, new_operation)
 
-        self._updateState(self._operation.state if self._operation is not None else None)
+        self._stateChanged = False
+        self._updateState(self._operation.snapshot if self._operation is not None else None)
 
     def _onDepUpdated(self):
         self._stateChanged = True
 
     def timerEvent(self, event):
         if event.timerId() == self._queryTimer and self._stateChanged:
-            self._updateState(self._operation.state if self._operation is not None else None)
+            self._stateChanged = False
+            self._updateState(self._operation.snapshot if self._operation is not None else None)
 
     def _updateState(self, state):
         raise NotImplementedError()
@@ -1037,7 +1741,7 @@ class OperationRunButton(OperationWidget):
             return
 
         with self._operation.lock:
-            state = self._operation.state
+            state = self._operation.snapshot
             if not state.isStarted:
                 self._operation.run(self.runMode)
             elif state.status == OperationState.Running and state.canPause:
@@ -1059,7 +1763,7 @@ class OperationRunButton(OperationWidget):
         if state is None:
             if self.operation is None:
                 return
-            state = self.operation.state
+            state = self.operation.snapshot
 
         if state.status == OperationState.NotStarted:
             if not self._iconMode:
@@ -1109,7 +1813,7 @@ class OperationCancelButton(OperationWidget):
     def _onClicked(self):
         if self._operation is not None:
             with self._operation.lock:
-                state = self._operation.state
+                state = self._operation.snapshot
                 if state.isRunning and state.canCancel:
                     self._operation.sendCancel()
 
@@ -1253,7 +1957,7 @@ class OperationMessagesModel(QAbstractListModel):
         QAbstractListModel.__init__(self)
         self._operation = operation
         with operation.lock:
-            self._messages = copy.copy(operation.state.messages)
+            self._messages = operation.messagesPage(0, operation.snapshot.messageCount)
             operation.messageAdded.connect(self._onMessageAdded, Qt.QueuedConnection)
 
     def _onMessageAdded(self, text, level):
@@ -1348,11 +2052,11 @@ class OperationsModel(QAbstractTableModel):
             if column == 0:
                 return operation.title
             elif column == 1:
-                return operation.state.statusText
+                return operation.snapshot.statusText
             elif column == 2:
-                return round(operation.state.progress, 2)
+                return round(operation.snapshot.progress, 2)
             elif column == 3:
-                return operation.state.progressText
+                return operation.snapshot.progressText
         elif role == self.OperationRole:
             return self._operations[index.row()]
 
@@ -1452,7 +2156,7 @@ def onApplicationShutdown(mainWindow):
         message_text = utils.tr('There are {0} operations running in background. You should cancel them '
                         'or wait for them to finish before exiting application. Currently the following '
                         'operations are running or waiting to be started:\n\n{1}').format(
-            len(non_daemon), '\n'.join(op.state.title for op in non_daemon)
+            len(non_daemon), '\n'.join(op.snapshot.title for op in non_daemon)
         )
         msgbox = QMessageBox(mainWindow)
         msgbox.setWindowTitle(utils.tr('Background operations are running'))
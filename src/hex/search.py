@@ -1,7 +1,6 @@
-import threading
 from PyQt4.QtCore import Qt, QAbstractListModel, QModelIndex
 from PyQt4.QtGui import QVBoxLayout, QHBoxLayout, QDialogButtonBox, QLabel, QPushButton, QWidget, QTreeView, \
-                        QSizePolicy, qApp
+                        QSizePolicy, QCheckBox, qApp
 import hex.utils as utils
 import hex.hexlineedit as hexlineedit
 import hex.matchers as matchers
@@ -24,6 +23,9 @@ class SearchDialog(utils.Dialog):
         self.m_layout.addWidget(self.descLabel)
         self.hexInput = hexlineedit.HexLineEdit(self)
         self.m_layout.addWidget(self.hexInput)
+        self.chkWildcards = QCheckBox(utils.tr('Use wildcards (? matches any hex digit)'), self)
+        self.chkWildcards.toggled.connect(self._onWildcardsToggled)
+        self.m_layout.addWidget(self.chkWildcards)
         self.buttonBox = QDialogButtonBox(self)
         self.buttonBox.addButton(QDialogButtonBox.Close)
         self.searchButton = QPushButton(utils.tr('Search'), self)
@@ -35,7 +37,13 @@ class SearchDialog(utils.Dialog):
 
     @property
     def matcher(self):
-        return matchers.BinaryMatcher(self.hexWidget.document, self.hexInput.data)
+        if self.hexInput.allowWildcards and '?' in self.hexInput.text():
+            return matchers.MaskedMatcher(self.hexWidget.document, self.hexInput.text())
+        document = self.hexWidget.document
+        return matchers.BinaryMatcher(document, self.hexInput.data, search_index=matchers.documentSearchIndex(document))
+
+    def _onWildcardsToggled(self, checked):
+        self.hexInput.allowWildcards = checked
 
 
 class SearchResultsWidget(QWidget):
@@ -87,68 +95,57 @@ class SearchResultsWidget(QWidget):
 
 
 class SearchResultsModel(QAbstractListModel):
+    """Model shows matches stored in MatchStore of matcher. Rows are not backed by any objects: texts are generated
+    from store on request, and DataRange for match is created only when MatchRangeRole is requested.
+    """
+
     MatchRangeRole, MatchRole = Qt.UserRole, Qt.UserRole + 1
 
     def __init__(self, hex_widget, match_operation):
         QAbstractListModel.__init__(self)
-        self._lock = threading.RLock()
-        self._newResults = []
         self._matchOperation = match_operation
         self._hexWidget = hex_widget
-        self._results = []
-        if self._matchOperation is not None:
-            with self._matchOperation.lock:
-                self._matchOperation.newResults.connect(self._onNewMatches, Qt.DirectConnection)
-                self._matchOperation.finished.connect(self._onMatchFinished, Qt.QueuedConnection)
-
-                for match in self._matchOperation.state.results.values():
-                    self._results.append((match, self._createRange(match)))
+        self._rowCount = 0
+        self._revision = 0
+        self._updateRows()
         self.startTimer(400)
 
     def rowCount(self, index=QModelIndex()):
-        return len(self._results) if not index.isValid() else 0
+        return self._rowCount if not index.isValid() else 0
 
     def data(self, index, role=Qt.DisplayRole):
-        if index.isValid() and (0 <= index.row() < len(self._results)) and index.column() == 0:
+        if index.isValid() and (0 <= index.row() < self._rowCount) and index.column() == 0:
             if role == Qt.DisplayRole or role == Qt.EditRole:
-                rng = self._results[index.row()][1]
-                return utils.tr('Matched {0:#x} bytes at position {1:#x}').format(rng.size, rng.startPosition)
+                position, length = self._matchOperation.matches[index.row()]
+                return utils.tr('Matched {0:#x} bytes at position {1:#x}').format(length, position)
             elif role == self.MatchRangeRole:
-                return self._results[index.row()][1]
+                position, length = self._matchOperation.matches[index.row()]
+                return hexwidget.DataRange(self._hexWidget, position, length, hexwidget.DataRange.UnitBytes)
             elif role == self.MatchRole:
-                return self._results[index.row()][0]
-            elif role == Qt.ForegroundRole and not self._results[index.row()][1].size:
+                return self._matchOperation.matchAt(index.row())
+            elif role == Qt.ForegroundRole and not self._matchOperation.matches[index.row()][1]:
                 return Qt.red
 
     def headerData(self, section, orientation, role=Qt.DisplayRole):
         return None
 
-    def _onNewMatches(self, results):
-        with self._lock:
-            self._newResults += (result[1] for result in results)
-
     def timerEvent(self, event):
-        has_results = False
-        with self._lock:
-            if self._newResults:
-                self.beginInsertRows(QModelIndex(), len(self._results), len(self._results) + len(self._newResults) - 1)
-                self._results += ((match, self._createRange(match)) for match in self._newResults)
-                self._newResults = []
-                has_results = True
-        if has_results:
+        self._updateRows()
+
+    def _updateRows(self):
+        """Shows matches added to store since last update and refreshes rows if matches were moved by document
+        modifications.
+        """
+        if self._matchOperation is None:
+            return
+
+        matches = self._matchOperation.matches
+        row_count, revision = len(matches), matches.revision
+        if revision != self._revision:
+            self._revision = revision
+            if self._rowCount:
+                self.dataChanged.emit(self.index(0, 0), self.index(self._rowCount - 1, 0))
+        if row_count > self._rowCount:
+            self.beginInsertRows(QModelIndex(), self._rowCount, row_count - 1)
+            self._rowCount = row_count
             self.endInsertRows()
-
-    def _onMatchFinished(self, final_status):
-        pass
-
-    def _onRangeUpdated(self):
-        for row_index in range(len(self._results)):
-            if self._results[row_index][1] is self.sender():
-                index = self.index(row_index, 0)
-                self.dataChanged.emit(index, index)
-                break
-
-    def _createRange(self, match):
-        match_range = hexwidget.DataRange(self._hexWidget, match.position, match.length, hexwidget.DataRange.UnitBytes)
-        match_range.updated.connect(self._onRangeUpdated)
-        return match_range
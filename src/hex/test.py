@@ -5,6 +5,7 @@ import hex.tests.operations
 import hex.tests.hexcolumn
 import hex.tests.charcolumn
 import hex.tests.bigintscrollbar
+import hex.tests.matchers
 
 
 def runTests():
@@ -15,6 +16,7 @@ def runTests():
         hex.tests.hexcolumn,
         hex.tests.charcolumn,
         hex.tests.bigintscrollbar,
+        hex.tests.matchers,
     )
 
     for module in module_list:
@@ -25,3 +25,46 @@ class CharColumnTest(unittest.TestCase):
         self.assertEqual(delegate.previousEditIndex, hexwidget.ModelIndex())
 
         self.assertEqual(model.delegateForIndex(model.index(0, 1)).nextEditIndex, model.index(0, 2))
+
+    def test_single_byte(self):
+        doc = documents.Document(documents.deviceFromData(bytes(range(256))))
+        for encoding in ('ISO-8859-1', 'KOI8-R', 'Windows-1251'):
+            model = CharColumnModel(doc, encodings.getCodec(encoding), QFont())
+            decoded = model.decodeRow(bytes(range(256)))
+            self.assertEqual(len(decoded), 256)
+            for row_data in model.rowsData(0, 16):
+                for column in range(16):
+                    index = row_data.indexes[column]
+                    self.assertEqual(decoded[index.documentPosition], row_data.texts[column])
+                    self.assertEqual(row_data.texts[column], index.data())
+                    self.assertEqual(row_data.flags[column], index.flags)
+
+        model = CharColumnModel(doc, encodings.getCodec('utf-8'), QFont())
+        self.assertIsNone(model.decodeRow(b'abc'))
+        model.codec = encodings.getCodec('ISO-8859-1')
+        self.assertEqual(model.decodeRow(b'abc'), 'abc')
+
+    def test_decode_range(self):
+        test_data = data + b'\x80\xd1' + 'абв'.encode('utf-16le') + '\U0001f600'.encode('utf-16le') + b'\x00\xdc'
+        doc = documents.Document(documents.deviceFromData(test_data))
+        for encoding in ('UTF-8', 'UTF-16LE', 'UTF-32LE', 'KOI8-R'):
+            codec = encodings.getCodec(encoding)
+            for start in range(0, 8, codec.unitSize):
+                characters = codec.decodeRange(doc, start, len(test_data) + 8 - start)
+                for j, char_data in enumerate(characters):
+                    position = start + j * codec.unitSize
+                    try:
+                        expected = codec.getCharacterData(doc, position)
+                    except encodings.EncodingError:
+                        self.assertIsNotNone(char_data.error)
+                    else:
+                        self.assertIsNone(char_data.error)
+                        self.assertEqual(char_data.startPosition, expected.startPosition)
+                        self.assertEqual(char_data.bytesCount, expected.bytesCount)
+                        self.assertEqual(char_data.unicode, expected.unicode)
+
+            model = CharColumnModel(doc, codec, QFont())
+            for row_data in model.rowsData(0, model.realRowCount()):
+                for column in range(len(row_data)):
+                    self.assertEqual(row_data.texts[column], row_data.indexes[column].data())
+                    self.assertEqual(row_data.flags[column], row_data.indexes[column].flags)
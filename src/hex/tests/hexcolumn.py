@@ -89,3 +89,43 @@ class HexColumnTest(unittest.TestCase):
         self.assertIsNone(delegate)
         self.assertEqual(model.document.length, 256)
 
+
+    def test_rows_data(self):
+        doc = documents.Document(documents.deviceFromData(data))
+        model = HexColumnModel(doc, valuecodecs.IntegerCodec(signed=False),
+                               formatters.IntegerFormatter(base=16, padding=2))
+
+        rows = model.rowsData(14, 4)
+        self.assertEqual(len(rows), 4)
+        for row_data in rows:
+            self.assertEqual(len(row_data), 16)
+            for column in range(16):
+                index = model.index(row_data.row, column)
+                self.assertEqual(row_data.indexes[column], index)
+                self.assertEqual(row_data.texts[column], index.data())
+                self.assertEqual(row_data.flags[column], index.flags)
+                self.assertEqual(row_data.positions[column], index.documentPosition)
+
+        doc.writeSpan(20, documents.DataSpan(b'\x00'))
+        row_data = model.rowData(1)
+        self.assertEqual(row_data.texts[4], '00')
+        self.assertTrue(row_data.flags[4] & model.FlagModified)
+        self.assertFalse(row_data.flags[5] & model.FlagModified)
+        self.assertEqual(model.rowData(0).flags, [model.FlagEditable] * 16)
+        self.assertTrue(model.rowData(16).flags[0] & model.FlagVirtual)
+
+    def test_texts_for_document_data(self):
+        doc = documents.Document(documents.deviceFromData(data + b'\x01'))
+        for binary_format in (valuecodecs.IntegerCodec.Format8Bit, valuecodecs.IntegerCodec.Format16Bit,
+                              valuecodecs.IntegerCodec.Format32Bit):
+            for signed in (False, True):
+                for base in (2, 10, 16):
+                    model = HexColumnModel(doc, valuecodecs.IntegerCodec(binary_format, signed),
+                                           formatters.IntegerFormatter(base=base))
+                    real_indexes = []
+                    index = model.firstIndex
+                    while index and not index.virtual:
+                        real_indexes.append(index)
+                        index = index.next
+                    texts = model.textsForDocumentData(bytes(doc.read(0, doc.length)), real_indexes)
+                    self.assertEqual(texts, [index.data() for index in real_indexes])
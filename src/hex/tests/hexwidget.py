@@ -1,4 +1,7 @@
 import unittest
+import tempfile
+import shutil
+import os
 import hex.hexwidget as hexwidget
 import hex.hexcolumn as hexcolumn
 import hex.charcolumn as charcolumn
@@ -7,7 +10,8 @@ import hex.valuecodecs as valuecodecs
 import hex.formatters as formatters
 import hex.encodings as encodings
 import hex.documents as documents
-from PyQt4.QtCore import Qt
+from hex.operations import OperationState
+from PyQt4.QtCore import Qt, QUrl
 from PyQt4.QtGui import QFont, qApp
 from PyQt4.QtTest import QTest
 
@@ -112,3 +116,72 @@ class TestHexWidget(unittest.TestCase):
                                                           length=2, unit=hexwidget.DataRange.UnitCells))
         QTest.keyPress(self.w.view, Qt.Key_Delete)
         self.assertEqual(self.w.document.length, length - 2)
+
+    def test_static_text_backend(self):
+        column = self.w.leadingColumn
+        column.documentBackendType = hexwidget.TextDocumentBackend
+        index = column.dataModel.indexFromPosition(20)
+        text_rect = column.rectForIndex(index)
+
+        column.documentBackendType = hexwidget.StaticTextBackend
+        self.assertIs(column.documentBackendType, hexwidget.StaticTextBackend)
+        static_rect = column.rectForIndex(index)
+        self.assertAlmostEqual(static_rect.left(), text_rect.left(), delta=1)
+        self.assertAlmostEqual(static_rect.top(), text_rect.top(), delta=1)
+        self.assertEqual(column.indexFromPoint(static_rect.center()), index)
+        self.assertEqual(column.cursorPositionFromPoint(static_rect.topLeft()), 0)
+
+        column.documentBackendType = None
+
+
+class TestSaveOperation(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'data.bin')
+        with open(self.filename, 'wb') as f:
+            f.write(b'0123456789' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _openDocument(self):
+        doc = documents.Document(documents.deviceFromUrl(QUrl.fromLocalFile(self.filename),
+                                                         documents.FileLoadOptions()))
+        doc.insertSpan(5, documents.DataSpan(b'abc'))
+        return doc
+
+    def test(self):
+        doc = self._openDocument()
+        expected = bytes(doc.readAll())
+
+        operation = hexwidget.SaveOperation(doc)
+        operation.run()
+        self.assertEqual(operation.join(), OperationState.Completed)
+        self.assertEqual(operation.state.progress, 100)
+        self.assertFalse(doc.modified)
+        self.assertFalse(doc.saving)
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_cancel(self):
+        doc = self._openDocument()
+        progress = []
+
+        def on_progress(saved_length, total_length):
+            progress.append((saved_length, total_length))
+            # document can be read, but not modified while saving
+            self.assertTrue(doc.readOnly)
+            self.assertEqual(bytes(doc.read(5, 3)), b'abc')
+            doc.cancelSave()
+
+        doc.saveProgress.connect(on_progress, Qt.DirectConnection)
+        self.assertRaises(RuntimeError, doc.save)
+        self.assertTrue(progress)
+        self.assertEqual(progress[0][1], 1003)
+        self.assertTrue(doc.modified)
+        self.assertFalse(doc.readOnly)
+
+        # temporary file is removed and target file is not changed
+        self.assertEqual(os.listdir(self.directory), ['data.bin'])
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789' * 100)
@@ -0,0 +1,210 @@
+import unittest
+import io
+import array
+import hex.documents as documents
+import hex.matchers as matchers
+from hex.operations import Operation, OperationState
+
+
+class MatchStoreTest(unittest.TestCase):
+    def test(self):
+        store = matchers.MatchStore()
+        store.extend([(2, 4), (10, 2), (20, 3)])
+        store.append(30, 1)
+        self.assertEqual(len(store), 4)
+        self.assertEqual(store[1], (10, 2))
+
+        store.onBytesInserted(4, 5)
+        self.assertEqual([store[index] for index in range(len(store))], [(2, 9), (15, 2), (25, 3), (35, 1)])
+        store.onBytesInserted(15, 1)
+        self.assertEqual([store[index] for index in range(len(store))], [(2, 9), (16, 2), (26, 3), (36, 1)])
+
+        store.onBytesRemoved(8, 10)
+        self.assertEqual([store[index] for index in range(len(store))], [(2, 6), (8, 0), (16, 3), (26, 1)])
+        self.assertEqual(store.revision, 3)
+
+    def test_unordered(self):
+        store = matchers.MatchStore()
+        store.extend([(20, 3), (2, 4)])
+        store.onBytesInserted(3, 2)
+        store.onBytesRemoved(0, 1)
+        self.assertEqual([store[index] for index in range(len(store))], [(21, 3), (1, 6)])
+
+    def test_skip_stored(self):
+        store = matchers.MatchStore()
+        store.extendPositions([1, 2, 3], 3)
+        store.extendPositions([2, 4], 3, skip_stored=True)
+        store.extendPositions([4], 2, skip_stored=True)
+        self.assertEqual([store[index] for index in range(len(store))], [(1, 3), (2, 3), (3, 3), (4, 3), (4, 2)])
+
+
+class BinaryMatcherTest(unittest.TestCase):
+    def test_parallel(self):
+        data = b'xxabxxxabababxabx' * 5
+        doc = documents.Document(documents.deviceFromData(data))
+
+        expected = [position for position in range(len(data)) if data.startswith(b'abx', position)]
+        for worker_count in (1, 3):
+            matcher = matchers.BinaryMatcher(doc, b'abx', worker_count=worker_count)
+            # small chunks make matches cross chunk boundaries
+            matcher.ChunkSize = 4
+            matcher.run(Operation.RunModeNewThread)
+            self.assertEqual(matcher.join(), OperationState.Completed)
+            self.assertEqual(sorted(match.position for match in matcher.allMatches), expected)
+
+
+class SearchIndexTest(unittest.TestCase):
+    def test(self):
+        doc = documents.Document(documents.deviceFromData(b'xxabxxxabababxabx' * 3))
+        index = matchers.SearchIndex(doc)
+
+        def search():
+            matcher = matchers.BinaryMatcher(doc, b'abx', search_index=index)
+            matcher.run(Operation.RunModeNewThread)
+            self.assertEqual(matcher.join(), OperationState.Completed)
+            data = bytes(doc.readAll())
+            expected = [position for position in range(len(data)) if data.startswith(b'abx', position)]
+            self.assertEqual([match.position for match in matcher.allMatches], expected)
+
+        search()
+        entry = index.entry(b'abx')
+        self.assertTrue(entry.isComplete)
+        self.assertEqual(entry.findNext(0, None, doc.length), 11)
+
+        doc.insertSpan(3, documents.DataSpan(b'abx'))
+        doc.remove(20, 4)
+        doc.writeSpan(30, documents.DataSpan(b'ab'))
+        self.assertFalse(entry.isComplete)
+        self.assertIsNone(entry.findNext(0, None, doc.length))
+        search()
+        self.assertTrue(entry.isComplete)
+
+    def test_store_follows_index(self):
+        doc = documents.Document(documents.deviceFromData(b'xxabx' * 4))
+        index = matchers.SearchIndex(doc)
+        matcher = matchers.BinaryMatcher(doc, b'abx', search_index=index)
+        matcher.run(Operation.RunModeNewThread)
+        self.assertEqual(matcher.join(), OperationState.Completed)
+
+        # matches are shifted together with index positions, so adding known positions again does not duplicate them
+        doc.insertSpan(0, documents.DataSpan(b'yy'))
+        entry = index.entry(b'abx')
+        self.assertEqual([match.position for match in matcher.allMatches], list(entry.positions))
+        self.assertTrue(matcher._addKnownPositions(entry, 0, None, entry.revision, True))
+        self.assertEqual([match.position for match in matcher.allMatches], [4, 9, 14, 19])
+
+    def test_index_file(self):
+        identity = ('/tmp/file', 100, 1, 0, 100)
+        index_file = io.BytesIO()
+        matchers.SearchIndex._writeIndexFile(index_file, identity, {b'ab': array.array('Q', [1, 5, 9]),
+                                                                    b'c': array.array('Q', [2])})
+        data = index_file.getvalue()
+        self.assertEqual(list(matchers.SearchIndex._readIndexFile(io.BytesIO(data), identity, b'ab')), [1, 5, 9])
+        self.assertEqual(list(matchers.SearchIndex._readIndexFile(io.BytesIO(data), identity, b'c')), [2])
+        self.assertIsNone(matchers.SearchIndex._readIndexFile(io.BytesIO(data), identity, b'x'))
+        self.assertIsNone(matchers.SearchIndex._readIndexFile(io.BytesIO(data), identity[:-1] + (99,), b'c'))
+
+        # damaged file is reported as ValueError, and is not loaded
+        with self.assertRaises(ValueError):
+            matchers.SearchIndex._readIndexFile(io.BytesIO(data[:-4]), identity, b'c')
+        with self.assertRaises(ValueError):
+            matchers.SearchIndex._readIndexFile(io.BytesIO(b'garbage' + data), identity, b'c')
+
+
+class MultiPatternMatcherTest(unittest.TestCase):
+    def test(self):
+        data = b'\x4d\x5a\x90\x00PE\x00\x00\x7fELF\x00MZ\x90'
+        doc = documents.Document(documents.deviceFromData(data))
+        matcher = matchers.MultiPatternMatcher(doc, [b'MZ', b'\x7fELF', b'PE\x00\x00', b'ELF', b'NONE'])
+
+        matcher.run(Operation.RunModeNewThread)
+        self.assertEqual(matcher.join(), OperationState.Completed)
+        found = sorted((match.position, match.length, match.patternIndex) for match in matcher.allMatches)
+        self.assertEqual(found, [(0, 2, 0), (4, 4, 2), (8, 4, 1), (9, 3, 3), (13, 2, 0)])
+
+        match = matcher.findNext(1)
+        self.assertEqual((match.position, match.patternIndex), (4, 2))
+        match = matcher.findNext(9)
+        self.assertEqual((match.position, match.patternIndex), (9, 3))
+        self.assertFalse(matcher.findNext(14).valid)
+
+        match = matcher.findPrevious(len(data))
+        self.assertEqual((match.position, match.patternIndex), (13, 0))
+        match = matcher.findPrevious(12)
+        self.assertEqual((match.position, match.patternIndex), (9, 3))
+        match = matcher.findPrevious(11)
+        self.assertEqual((match.position, match.patternIndex), (4, 2))
+        self.assertFalse(matcher.findPrevious(1).valid)
+
+    def test_overlapping_patterns(self):
+        doc = documents.Document(documents.deviceFromData(b'aaaa'))
+        matcher = matchers.MultiPatternMatcher(doc, [b'aa', b'a', b''])
+        matcher.run(Operation.RunModeNewThread)
+        matcher.join()
+        found = sorted((match.position, match.patternIndex) for match in matcher.allMatches)
+        self.assertEqual(found, [(0, 0), (0, 1), (1, 0), (1, 1), (2, 0), (2, 1), (3, 1)])
+
+        self.assertRaises(ValueError, matchers.MultiPatternMatcher, doc, [b''])
+
+
+class MaskedMatcherTest(unittest.TestCase):
+    def test_pattern(self):
+        pattern = matchers.MaskedPattern.fromString('4d 5a ?? ?? 5 F?')
+        self.assertEqual(len(pattern), 6)
+        self.assertEqual(pattern.values, b'\x4d\x5a\x00\x00\x05\xf0')
+        self.assertEqual(pattern.masks, b'\xff\xff\x00\x00\xff\xf0')
+        self.assertEqual(str(pattern), '4D 5A ?? ?? 05 F?')
+
+        self.assertEqual(list(matchers.MaskedPattern.fromString('?1').findAll(b'\x01\x11\x12\xf1')), [0, 1, 3])
+        self.assertEqual(list(matchers.MaskedPattern.fromString('?? 1?').findAll(b'\x10\x10\x10', 1)), [1])
+
+        self.assertRaises(ValueError, matchers.MaskedPattern.fromString, '4d5')
+        self.assertRaises(ValueError, matchers.MaskedPattern.fromString, '4g')
+        self.assertRaises(ValueError, matchers.MaskedPattern.fromString, '')
+
+    def test(self):
+        data = b'MZ\x90\x00PE\x00\x00MZ\x00PE\x00MZ\x01\x02PE'
+        doc = documents.Document(documents.deviceFromData(data))
+        matcher = matchers.MaskedMatcher(doc, '4D 5A ?? ?? 50 45')
+
+        matcher.run(Operation.RunModeNewThread)
+        self.assertEqual(matcher.join(), OperationState.Completed)
+        self.assertEqual(sorted(match.position for match in matcher.allMatches), [0, 13])
+
+        self.assertEqual(matcher.findNext(0).position, 0)
+        self.assertEqual(matcher.findNext(1).position, 13)
+        self.assertFalse(matcher.findNext(14).valid)
+        self.assertEqual(matcher.findPrevious(len(data)).position, 13)
+        self.assertEqual(matcher.findPrevious(len(data) - 1).position, 0)
+        self.assertFalse(matcher.findPrevious(5).valid)
+
+
+class RegexMatcherTest(unittest.TestCase):
+    def test(self):
+        data = b'\x00\x01ERROR: disk\n\xffWARN: fan\n\x00ERROR: cpu\n'
+        doc = documents.Document(documents.deviceFromData(data))
+        matcher = matchers.RegexMatcher(doc, rb'(ERROR|WARN): \w+')
+        # small chunks make matches cross chunk boundaries
+        matcher.ChunkSize = 5
+
+        matcher.run(Operation.RunModeNewThread)
+        self.assertEqual(matcher.join(), OperationState.Completed)
+        found = sorted((match.position, match.length) for match in matcher.allMatches)
+        self.assertEqual(found, [(2, 11), (15, 9), (26, 10)])
+
+        match = matcher.findNext(3)
+        self.assertEqual((match.position, match.length), (15, 9))
+        self.assertFalse(matcher.findNext(27).valid)
+        match = matcher.findPrevious(len(data))
+        self.assertEqual((match.position, match.length), (26, 10))
+        match = matcher.findPrevious(30)
+        self.assertEqual((match.position, match.length), (15, 9))
+        self.assertFalse(matcher.findPrevious(12).valid)
+
+    def test_non_overlapping(self):
+        doc = documents.Document(documents.deviceFromData(b'aaaaa'))
+        matcher = matchers.RegexMatcher(doc, b'aa|b*')
+        matcher.ChunkSize = 3
+        matcher.run(Operation.RunModeNewThread)
+        matcher.join()
+        self.assertEqual(sorted(match.position for match in matcher.allMatches), [0, 2])
@@ -2,8 +2,14 @@ import unittest
 import uuid
 import logging
 import threading
-from hex.operations import Operation, OperationState, globalOperationContext, WrapperOperation, SequentialOperationGroup
+import time
+import tempfile
+import os
+import asyncio
+from hex.operations import Operation, OperationState, globalOperationContext, WrapperOperation, SequentialOperationGroup, \
+                           globalOperationPool, ProcessTask, DeviceRangeTask, runCoroutine, startCoroutine
 from PyQt4.QtGui import qApp
+from PyQt4.QtCore import QUrl, QEventLoop
 
 
 class GenerateUuidsOperation(Operation):
@@ -18,6 +24,48 @@ class GenerateUuidsOperation(Operation):
         self.requestDoWork = self.count < 10
 
 
+class WaitForCancelOperation(Operation):
+    def doWork(self):
+        while self.takeCommand(block=True, timeout=5) != self.CancelCommand:
+            pass
+        self._cancel()
+
+
+class SquaresTask(ProcessTask):
+    def __init__(self, count):
+        self.count = count
+
+    def execute(self, context):
+        for i in range(self.count):
+            if context.isCancelled:
+                return
+            context.addResult(str(i), i * i)
+            context.setProgress(i * 100 / self.count)
+        context.addMessage('squares calculated')
+
+
+class ByteSumTask(DeviceRangeTask):
+    def execute(self, context):
+        context.addResult('sum', sum(bytes(self.openDevice().readAll())))
+
+
+class DelayedResultsOperation(Operation):
+    def doWork(self):
+        # wait until test is ready to stop taking results
+        self.takeCommand(block=True, timeout=5)
+        for i in range(1000):
+            self.addResult('result_{0}'.format(i), i)
+
+
+class ProcessTaskOperation(Operation):
+    def __init__(self, task):
+        Operation.__init__(self, 'process_task')
+        self.task = task
+
+    def processTask(self):
+        return self.task
+
+
 class TestOperation(unittest.TestCase):
     def test(self):
         op = GenerateUuidsOperation()
@@ -148,3 +196,171 @@ class TestOperation(unittest.TestCase):
         while not wrapper_operation.state.isFinished:
             qApp.processEvents()
         self.assertTrue(callback_called)
+
+    def test_snapshot(self):
+        op = GenerateUuidsOperation()
+        snapshot = op.snapshot
+        self.assertEqual(snapshot.status, OperationState.NotStarted)
+        self.assertFalse(snapshot.isStarted)
+        self.assertEqual(snapshot.resultCount, 0)
+
+        op.run(Operation.RunModeNewThread)
+        op.join()
+        snapshot = op.snapshot
+        self.assertTrue(snapshot.isFinished)
+        self.assertEqual(snapshot.status, OperationState.Completed)
+        self.assertEqual(snapshot.resultCount, 1000)
+        self.assertGreater(snapshot.version, 1000)
+        self.assertEqual(op.stateVersion, snapshot.version)
+        self.assertRaises(AttributeError, setattr, snapshot, 'progress', 0)
+
+        page = op.resultsPage(990, 20)
+        self.assertEqual([name for name, value in page], ['uuid_9_{0}'.format(i) for i in range(90, 100)])
+        self.assertEqual(op.messagesPage(0, 10), [])
+
+    def test_results_delivery(self):
+        op = GenerateUuidsOperation()
+        op.ResultsBatchSize = 30
+        op.MaxPendingResults = 50
+        op.ResultsBackpressureTimeout = 0.05
+
+        batches = []
+        op.newResults.connect(batches.append)
+        op.run(Operation.RunModeNewThread)
+        while not op.snapshot.isFinished:
+            qApp.processEvents()
+        qApp.processEvents()
+
+        self.assertTrue(all(len(batch) <= 30 for batch in batches))
+        delivered = [name for batch in batches for name, value in batch]
+        self.assertEqual(delivered, list(op.state.results.keys()))
+        self.assertEqual(len(delivered), 1000)
+
+        # backpressure should not block operation forever when nobody takes results
+        op = GenerateUuidsOperation()
+        op.MaxPendingResults = 50
+        op.ResultsBackpressureTimeout = 0.001
+        op.run(Operation.RunModeNewThread)
+        self.assertEqual(op.join(), OperationState.Completed)
+
+        # after timeout expires once, operation is not blocked again while GUI thread is busy joining it
+        op = DelayedResultsOperation()
+        op.MaxPendingResults = 50
+        op.ResultsBackpressureTimeout = 1.0
+        op.run(Operation.RunModeNewThread)
+        while op._resultsTimer is None:
+            qApp.processEvents()
+        started = time.monotonic()
+        op.sendCommand('go')
+        self.assertEqual(op.join(), OperationState.Completed)
+        self.assertLess(time.monotonic() - started, 3 * op.ResultsBackpressureTimeout)
+        self.assertEqual(op.snapshot.resultCount, 1000)
+
+    def test_pool(self):
+        pool = globalOperationPool()
+        old_limit, pool._limit = pool._limit, 1
+        try:
+            unblock = threading.Event()
+            started = []
+
+            def make_operation(name, priority):
+                operation = WrapperOperation(lambda: started.append(name) or unblock.wait(5))
+                operation.priority = priority
+                return operation
+
+            long_operation = make_operation('long', Operation.PriorityBackground)
+            long_operation.run()
+            background_operation = make_operation('background', Operation.PriorityBackground)
+            background_operation.run()
+            normal_operation = make_operation('normal', Operation.PriorityNormal)
+            normal_operation.run()
+
+            # waiting operation is cancelled without being started
+            cancelled_operation = make_operation('cancelled', Operation.PriorityNormal)
+            cancelled_operation.run()
+            cancelled_operation.sendCancel()
+            self.assertEqual(cancelled_operation.snapshot.status, OperationState.Cancelled)
+
+            # interactive operation does not wait for long one
+            interactive_operation = WrapperOperation(lambda: 'done')
+            interactive_operation.priority = Operation.PriorityInteractive
+            interactive_operation.run()
+            self.assertEqual(interactive_operation.join(), OperationState.Completed)
+            self.assertFalse(long_operation.snapshot.isFinished)
+
+            unblock.set()
+            for operation in (long_operation, background_operation, normal_operation):
+                self.assertEqual(operation.join(), OperationState.Completed)
+            self.assertEqual(started, ['long', 'normal', 'background'])
+        finally:
+            pool._limit = old_limit
+
+    def test_pool_daemon_workers(self):
+        for daemon in (False, True):
+            operation = WrapperOperation(lambda: threading.current_thread().daemon)
+            operation.run(Operation.RunModeNewThread, daemon=daemon)
+            self.assertEqual(operation.join(), OperationState.Completed)
+            self.assertEqual(operation.state.results['result'], daemon)
+
+    def test_process_mode(self):
+        op = ProcessTaskOperation(SquaresTask(5000))
+        op.run(Operation.RunModeProcess)
+        self.assertEqual(op.join(), OperationState.Completed)
+        state = op.state
+        self.assertEqual(len(state.results), 5000)
+        self.assertEqual(state.results['70'], 4900)
+        self.assertEqual(state.messages, [('squares calculated', logging.INFO)])
+
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            temp_file.write(bytes(range(10)))
+        try:
+            op = ProcessTaskOperation(ByteSumTask(QUrl.fromLocalFile(temp_file.name).toString(), 2, 5))
+            op.run(Operation.RunModeProcess)
+            self.assertEqual(op.join(), OperationState.Completed)
+            self.assertEqual(op.state.results['sum'], 2 + 3 + 4 + 5 + 6)
+        finally:
+            os.remove(temp_file.name)
+
+    def test_async(self):
+        async def run_operations():
+            operations = [GenerateUuidsOperation() for j in range(3)]
+            statuses = await asyncio.gather(*(operation.runAsync() for operation in operations))
+            self.assertEqual(statuses, [OperationState.Completed] * 3)
+
+            operation = GenerateUuidsOperation()
+            batches = operation.resultBatches()
+            operation.run()
+            names = []
+            async for batch in batches:
+                names.extend(name for name, value in batch)
+            self.assertEqual(names, list(operation.state.results.keys()))
+            self.assertEqual(len(names), 1000)
+
+            # cancelling coroutine cancels operation
+            operation = WaitForCancelOperation()
+            task = asyncio.ensure_future(operation.runAsync())
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return await operation.runAsync()
+
+        self.assertEqual(runCoroutine(run_operations()), OperationState.Cancelled)
+
+    def test_start_coroutine(self):
+        async def run_operation():
+            return await GenerateUuidsOperation().runAsync()
+
+        # coroutine is run by Qt event loop, without nested asyncio loops
+        task = startCoroutine(run_operation())
+        self.assertFalse(task.done())
+        qt_loop = QEventLoop()
+        task.add_done_callback(lambda task: qt_loop.quit())
+        qt_loop.exec_()
+        self.assertEqual(task.result(), OperationState.Completed)
+
+        async def nested():
+            runCoroutine(run_operation())
+
+        with self.assertRaises(RuntimeError):
+            runCoroutine(nested())
@@ -14,6 +14,12 @@ class GenericCodec(object):
     def encode(self, value):
         return struct.pack(self.formatString, value)
 
+    def decodeMany(self, data):
+        """Decodes sequence of values stored one after another. Length of :data: should be multiple of dataSize.
+        """
+        format_string = self.formatString
+        return struct.unpack(format_string[0] + str(len(data) // self.dataSize) + format_string[1:], data)
+
 
 class IntegerCodec(GenericCodec):
     Format8Bit = 'b'